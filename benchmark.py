@@ -0,0 +1,214 @@
+"""
+Замер производительности xml_to_json_flat на синтетических XML разной формы.
+Время каждой фазы замеряется отдельно: parse - разбор XML, records - поиск тегов и получение плоских записей
+(Flattener.records), sync - синхронизация колонок (_json_fields_sync), dumps - сериализация в JSON.
+Каждый набор выполняется в отдельном процессе, чтобы пиковый расход памяти (RSS) относился только к нему.
+Результат сохраняется в JSON и сравнивается с базовым: при падении скорости больше чем на --threshold
+скрипт завершается с кодом 1
+Запуск:
+    python benchmark.py --save-baseline                  # сохранить базовый результат в benchmark_baseline.json
+    python benchmark.py [--records 10000] [--parser lxml] [--cases flat,deep] [--threshold 0.25]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from xml_to_json_flat import Flattener, _get_parser, _json_fields_sync
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+RESULTS_VERSION = 1
+PHASES = ('parse', 'records', 'sync', 'dumps')
+
+# Наборы: форма документа (параметры make_xml кроме inrecords)
+CASES = {
+    'flat': dict(indepth=1, infanout=10),
+    'deep': dict(indepth=6, infanout=2),
+    'wide': dict(indepth=1, infanout=100),
+    'attrs': dict(indepth=2, infanout=5, inattrs=1.0),
+    'sparse': dict(indepth=2, infanout=8, insparsity=0.7),
+    'cyrillic': dict(indepth=2, infanout=5, inattrs=0.3, incyrillic=True),
+}
+
+
+def make_xml(inrecords, indepth=2, infanout=5, inattrs=0.0, insparsity=0.0, incyrillic=False, inseed=0):
+    """
+    Создание синтетического XML: корневой тег с inrecords записями одинаковой формы
+    :param inrecords: Кол-во записей
+    :param indepth: Глубина вложенности тегов внутри записи
+    :param infanout: Кол-во дочерних тегов у каждого тега (кроме последнего уровня)
+    :param inattrs: Доля тегов с атрибутами (0..1), у тега с атрибутами их два
+    :param insparsity: Доля пропущенных тегов последнего уровня (0..1) - записи с разным набором полей
+    :param incyrillic: Имена тегов и атрибутов на кириллице
+    :param inseed: Начальное значение генератора случайных чисел
+    :return: XML в байтах (utf-8) и имя тега записи
+    :type inrecords: int
+    :type indepth: int
+    :type infanout: int
+    :type inattrs: float
+    :type insparsity: float
+    :type incyrillic: bool
+    :type inseed: int
+    :rtype: tuple
+    """
+    rnd = random.Random(inseed)
+    tag, item, attr = ('запись', 'поле', 'признак') if incyrillic else ('record', 'item', 'attr')
+    parts = ['<?xml version="1.0" encoding="utf-8"?>\n<root>\n']
+    write = parts.append
+
+    def write_tag(inname, inlevel, invalue):
+        if inlevel == indepth and insparsity and rnd.random() < insparsity:
+            return
+        write('<' + inname)
+        if inattrs and rnd.random() < inattrs:
+            write(' {0}1="{1}" {0}2="{2}"'.format(attr, invalue, inlevel))
+        write('>')
+        if inlevel < indepth:
+            for i in range(infanout):
+                write_tag('{}{}'.format(item, i), inlevel + 1, invalue)
+        else:
+            write('Значение {}'.format(invalue) if incyrillic else 'value {}'.format(invalue))
+        write('</{}>'.format(inname))
+
+    for i in range(inrecords):
+        write_tag(tag, 0, i)
+        write('\n')
+    write('</root>\n')
+    return ''.join(parts).encode('utf-8'), tag
+
+
+def _peak_rss_mb():
+    """ Пиковый расход памяти процесса в МБ. None - недоступно на этой платформе """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2 ** 20 if sys.platform == 'darwin' else maxrss / 2 ** 10  # macOS - байты, Linux - КБ
+
+
+def run_case(inname, inrecords, inparser, inrepeat):
+    """
+    Замер одного набора: лучшее время каждой фазы из inrepeat запусков
+    :rtype: dict
+    """
+    params = CASES[inname]
+    xml, tagname = make_xml(inrecords, **params)
+    parser = _get_parser(inparser)
+    times = dict.fromkeys(PHASES, float('inf'))
+    for i in range(inrepeat):
+        flattener = Flattener('root/' + tagname, parser=inparser)
+        t = time.perf_counter()
+        doc = parser.parse(xml)
+        t, times['parse'] = time.perf_counter(), min(times['parse'], time.perf_counter() - t)
+        records = flattener.records(doc, parser)
+        t, times['records'] = time.perf_counter(), min(times['records'], time.perf_counter() - t)
+        res = _json_fields_sync(records)
+        t, times['sync'] = time.perf_counter(), min(times['sync'], time.perf_counter() - t)
+        json.dumps(res, ensure_ascii=False)
+        times['dumps'] = min(times['dumps'], time.perf_counter() - t)
+        if len(res) != inrecords:
+            raise AssertionError('{}: найдено {} записей вместо {}'.format(inname, len(res), inrecords))
+        del doc, records, res
+    total = sum(times.values())
+    size = len(xml) / 2 ** 20
+    return {
+        'params': params,
+        'parser': inparser,
+        'records': inrecords,
+        'size_mb': round(size, 3),
+        'phases': {phase: round(value, 6) for phase, value in times.items()},
+        'total': round(total, 6),
+        'records_per_s': round(inrecords / total, 1),
+        'mb_per_s': round(size / total, 3),
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+
+
+def compare(inresults, inbaseline, inthreshold):
+    """
+    Сравнение с базовым результатом по скорости (записей в секунду) каждого набора
+    :param inresults: Текущий результат
+    :param inbaseline: Базовый результат
+    :param inthreshold: Допустимое падение скорости (0.2 - 20%)
+    :return: Список сообщений о замедлении
+    :rtype: list
+    """
+    regressions = []
+    for name, case in inresults['cases'].items():
+        base = inbaseline['cases'].get(name)
+        if base is None or base['parser'] != case['parser'] or base['records'] != case['records']:
+            print('{:<10} нет сопоставимого базового результата'.format(name))
+            continue
+        ratio = case['records_per_s'] / base['records_per_s']
+        phases = ' '.join('{}={:+.0%}'.format(phase, case['phases'][phase] / base['phases'][phase] - 1)
+                          for phase in PHASES if base['phases'].get(phase))
+        print('{:<10} x{:.2f} к базовому ({})'.format(name, ratio, phases))
+        if ratio < 1 - inthreshold:
+            regressions.append('{}: {:.0f} записей/с, базовый {:.0f} записей/с'.format(
+                name, case['records_per_s'], base['records_per_s']))
+    return regressions
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('--records', type=int, default=10000, help='Кол-во записей в каждом наборе')
+    argparser.add_argument('--parser', default='lxml', help='Парсер: bs4, lxml или etree')
+    argparser.add_argument('--cases', default=','.join(CASES), help='Наборы через запятую')
+    argparser.add_argument('--repeat', type=int, default=3, help='Кол-во запусков, берется лучшее время')
+    argparser.add_argument('-o', '--output', default='benchmark_results.json', help='Файл результата')
+    argparser.add_argument('--baseline', default='benchmark_baseline.json', help='Файл базового результата')
+    argparser.add_argument('--save-baseline', action='store_true', help='Сохранить результат как базовый')
+    argparser.add_argument('--threshold', type=float, default=0.25, help='Допустимое падение скорости')
+    args = argparser.parse_args(argv)
+
+    names = [name for name in args.cases.split(',') if name]
+    unknown = [name for name in names if name not in CASES]
+    if unknown:
+        argparser.error('Неизвестные наборы: {}. Доступны: {}'.format(', '.join(unknown), ', '.join(CASES)))
+
+    results = {
+        'version': RESULTS_VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'cases': {},
+    }
+    print('{:<10} {:>8} {:>8} {:>8} {:>8} {:>8} {:>12} {:>8} {:>8}'.format(
+        'набор', 'МБ', *PHASES, 'записей/с', 'МБ/с', 'RSS МБ'))
+    context = multiprocessing.get_context('spawn')
+    for name in names:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            case = executor.submit(run_case, name, args.records, args.parser, args.repeat).result()
+        results['cases'][name] = case
+        print('{:<10} {:>8.2f} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f} {:>12.0f} {:>8.2f} {:>8}'.format(
+            name, case['size_mb'], *[case['phases'][phase] for phase in PHASES], case['records_per_s'],
+            case['mb_per_s'], '-' if case['peak_rss_mb'] is None else '{:.0f}'.format(case['peak_rss_mb'])))
+
+    with open(args.output, 'w', encoding='utf-8') as fw:
+        json.dump(results, fw, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as fw:
+            json.dump(results, fw, ensure_ascii=False, indent=2)
+        print('Базовый результат сохранен: {}'.format(args.baseline))
+        return 0
+    if not os.path.exists(args.baseline):
+        print('Базовый результат {} не найден, сравнение пропущено'.format(args.baseline))
+        return 0
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+    for message in regressions:
+        print('Замедление: ' + message, file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,54 @@
+"""
+Замер ускорения xml_to_json_flat_parallel на 1/2/4/8 процессах
+Запуск: python benchmark_parallel.py [--records 200000] [--parser lxml]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from xml_to_json_flat import xml_to_json_flat, xml_to_json_flat_parallel
+
+
+def make_xml(inpath, inrecords):
+    """
+    Создание тестового XML: tag1 с inrecords тегами tag2
+    """
+    with open(inpath, 'w', encoding='utf-8') as fw:
+        fw.write('<?xml version="1.0" encoding="utf-8"?>\n<tag1>\n')
+        for i in range(inrecords):
+            fw.write('<tag2 id="{0}"><item1>{0}</item1><item2>Значение {0}</item2><item3 prop="{1}"/>'
+                     '<itemlist><item3>{1}</item3><item4>{2}</item4></itemlist></tag2>\n'.format(i, i % 7, i * 2))
+        fw.write('</tag1>\n')
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('--records', type=int, default=200000)
+    argparser.add_argument('--parser', default='lxml')
+    argparser.add_argument('--workers', default='1,2,4,8')
+    args = argparser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.xml')
+    os.close(fd)
+    try:
+        make_xml(path, args.records)
+        print('Файл: {:.1f} МБ, записей: {}, ядер: {}'.format(os.path.getsize(path) / 2 ** 20, args.records,
+                                                            os.cpu_count()))
+        t = time.perf_counter()
+        with open(path, 'rb') as f:
+            serial = xml_to_json_flat(f.read(), 'tag1/tag2', parser=args.parser)
+        serialtime = time.perf_counter() - t
+        print('{:>8} {:>10.2f} с'.format('serial', serialtime))
+        for workers in [int(item) for item in args.workers.split(',')]:
+            t = time.perf_counter()
+            res = xml_to_json_flat_parallel(path, 'tag1/tag2', parser=args.parser, workers=workers)
+            elapsed = time.perf_counter() - t
+            assert res == serial, 'Результат отличается от последовательной обработки'
+            print('{:>8} {:>10.2f} с  x{:.2f}'.format(workers, elapsed, serialtime / elapsed))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Замер стоимости одного вызова функций из xml_to_json_flat.sql (на строку SELECT) без PostgreSQL:
+тела функций выполняются так же, как в PL/Python (см. sql_functions.py).
+Сравниваются: вызов без кэша в GD (импорт и определение функций на каждый вызов), вызов с кэшем,
+xml_to_json_flat_rows и xml_to_json_flat_table. Для сравнения с прежней версией скрипта:
+    git show <коммит>:xml_to_json_flat.sql > old.sql
+    python benchmark_sql.py --before old.sql
+Запуск: python benchmark_sql.py [--rows 2000] [--before old.sql]
+"""
+import argparse
+import time
+
+from sql_functions import SQL_FILE, load_sql_functions
+
+XML = """<?xml version="1.0" encoding="utf-8"?>
+<tag1>
+    <tag2>
+        <item1>1</item1>
+        <item2>2</item2>
+        <item3 Свойство1="Значение1" prop2="Property2" />
+        <itemlist>
+            <item3>3</item3>
+            <item4>4</item4>
+        </itemlist>
+    </tag2>
+    <tag2>
+        <item1>11</item1>
+        <item2>22</item2>
+        <itemlist>
+            <item3>33</item3>
+            <item4>44</item4>
+        </itemlist>
+    </tag2>
+</tag1>"""
+
+
+def bench(inname, infunc, inrows):
+    t = time.perf_counter()
+    for i in range(inrows):
+        infunc()
+    elapsed = time.perf_counter() - t
+    print('{:<40} {:>10.1f} мкс/строку'.format(inname, elapsed / inrows * 1e6))
+    return elapsed
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('--rows', type=int, default=2000)
+    argparser.add_argument('--before', help='Прежняя версия xml_to_json_flat.sql')
+    args = argparser.parse_args()
+
+    functions = load_sql_functions(SQL_FILE)
+    fields = '["tag2_item1", "tag2_itemlist_item4"]'
+
+    def cold():
+        functions.gd.clear()
+        return functions['xml_to_json_flat'](XML, 'tag2', fields)
+
+    if args.before:
+        before = load_sql_functions(args.before)
+        bench('xml_to_json_flat (--before)', lambda: before['xml_to_json_flat'](XML, 'tag2', fields), args.rows)
+    cold_time = bench('xml_to_json_flat без кэша в GD', cold, args.rows)
+    warm_time = bench('xml_to_json_flat', lambda: functions['xml_to_json_flat'](XML, 'tag2', fields), args.rows)
+    bench('xml_to_json_flat_rows', lambda: list(functions['xml_to_json_flat_rows'](XML, 'tag2', fields)), args.rows)
+    bench('xml_to_json_flat_table', lambda: list(functions['xml_to_json_flat_table'](XML, 'tag2', fields)),
+          args.rows)
+    print('Без кэша / с кэшем: x{:.2f}'.format(cold_time / warm_time))
+
+
+if __name__ == '__main__':
+    main()
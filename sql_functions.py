@@ -0,0 +1,85 @@
+"""
+Выполнение функций PL/Python из xml_to_json_flat.sql без PostgreSQL: тело каждой функции становится функцией
+Python с теми же параметрами, общий словарь GD и plpy (execute для вызова функций скрипта, error) эмулируются.
+Используется в тестах (tests.py) и для замера стоимости вызова (benchmark_sql.py)
+"""
+import inspect
+import os
+import re
+import textwrap
+
+SQL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xml_to_json_flat.sql')
+
+
+class SqlFunctions(dict):
+    """
+    Функции PL/Python из sql-скрипта в виде функций Python. Общий словарь GD и plpy.execute для вызова
+    функций скрипта эмулируются. Для перегруженных функций (одно имя, разные параметры) вызов выполняет та,
+    с параметрами которой совпадают переданные, как в PostgreSQL: если подходят несколько или ни одной - ошибка
+    """
+    def __init__(self):
+        super().__init__()
+        self.init_calls = 0
+        self.gd = {}
+        self.overloads = {}  # Имя -> список функций с этим именем
+
+    class Error(Exception):
+        """ plpy.Error """
+
+    def error(self, message):
+        raise self.Error(message)
+
+    def execute(self, query):
+        name = re.match(r'SELECT public\.(\w+)\(\)', query).group(1)
+        if name == '_xml_to_json_flat_init':
+            self.init_calls += 1
+        return self[name]()
+
+
+def load_sql_functions(sqlfile=SQL_FILE):
+    """
+    Загрузка функций из sql-скрипта
+    :param sqlfile: Путь к sql-скрипту
+    :rtype: SqlFunctions
+    """
+    functions = SqlFunctions()
+    with open(sqlfile, 'r', encoding='utf-8') as f:
+        sql = f.read()
+    for name, args, body in re.findall(r'CREATE OR REPLACE FUNCTION public\.(\w+)\((.*?)\)\s+RETURNS .*? AS\s+'
+                                       r'\$BODY\$(.*?)\$BODY\$', sql, re.S):
+        params = []
+        for arg in [arg.strip() for arg in args.split(',') if arg.strip()]:
+            argname, _, default = arg.partition(' DEFAULT ')
+            default = default.split('::')[0]
+            value = {'true': True, 'false': False}.get(default, default)
+            if default.startswith("'"):
+                value = default.strip("'")
+            elif default.isdigit():
+                value = int(default)
+            params.append('{}={!r}'.format(argname.split()[0], value) if default else argname.split()[0])
+        code = 'def {}({}):\n{}'.format(name, ', '.join(params), textwrap.indent(textwrap.dedent(body), '    '))
+        namespace = {'GD': functions.gd, 'plpy': functions}
+        exec(code, namespace)
+        overloads = functions.overloads.setdefault(name, [])
+        overloads.append(namespace[name])
+        functions[name] = namespace[name] if len(overloads) == 1 else _overloaded(name, overloads)
+    return functions
+
+
+def _overloaded(inname, infunctions):
+    """
+    Вызов перегруженной функции: выполняется единственная функция, к параметрам которой подходят переданные
+    """
+    def call(*args, **kwargs):
+        matched = []
+        for func in infunctions:
+            try:
+                inspect.signature(func).bind(*args, **kwargs)
+            except TypeError:
+                continue
+            matched.append(func)
+        if len(matched) != 1:
+            raise TypeError('{}: подходящих перегрузок {} из {}'.format(inname, len(matched), len(infunctions)))
+        return matched[0](*args, **kwargs)
+
+    return call
@@ -1,7 +1,13 @@
+import os
 import unittest
 import json
 from bs4 import BeautifulSoup
 
+from sql_functions import SQL_FILE, load_sql_functions
+
+EXAMPLE01 = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xml_examples', 'example01.xml')
+
+
 class TestXmlToJsonFlat(unittest.TestCase):
     def setUp(self):
         self.xml = """<?xml version="1.0" encoding="utf-8"?>
@@ -65,6 +71,838 @@ class TestXmlToJsonFlat(unittest.TestCase):
         self.assertEqual(res5[0]['tag1_tag2_item1'], '1')
 
 
+    def test_iter_xml_to_json_flat(self):
+        import io
+        from xml_to_json_flat import xml_to_json_flat, iter_xml_to_json_flat, _json_fields_sync
+
+        # Потоковый вариант дает те же записи, что и xml_to_json_flat
+        for intagname in ['tag2', 'tag1/tag2', '', '[document]/tag1']:
+            for kwargs in [{}, {'inmaxlevel': 1}, {'inskipfirsttag': True}, {'infields': ['tag2_item1']}]:
+                res1 = xml_to_json_flat(self.xml, intagname, **kwargs)
+                source = io.BytesIO(self.xml.strip().encode('utf-8'))
+                res2 = _json_fields_sync(list(iter_xml_to_json_flat(source, intagname, **kwargs)))
+                self.assertEqual(res1, res2)
+
+        # Чтение из файла по пути, записи отдаются по одной
+        recs = iter_xml_to_json_flat(EXAMPLE01, 'tag1/tag2')
+        self.assertEqual(next(recs)['tag1_tag2_item3_attr_Свойство1'], 'Значение1')
+        self.assertEqual(next(recs)['tag1_tag2_itemlist_item4'], '44')
+        self.assertRaises(StopIteration, next, recs)
+
+
+    def test_parsers(self):
+        from xml_to_json_flat import xml_to_json_flat, PARSERS
+
+        with open(EXAMPLE01, 'r', encoding='utf-8') as f:
+            example01 = f.read()
+        xml_ns = """<?xml version="1.0" encoding="utf-8"?>
+        <!-- comment -->
+        <tag1 xmlns="http://default" xmlns:p="http://p">
+            <p:tag2 p:attr1="1" attr2="2">text<!-- comment -->tail</p:tag2>
+            <tag2><![CDATA[cdata]]></tag2>
+        </tag1>""".strip()
+
+        # Все парсеры дают одинаковый результат
+        for xml in [self.xml, example01, xml_ns]:
+            for intagname in ['tag2', 'tag1/tag2', '', '[document]/tag1', 'tag2/tag2', 'item3']:
+                for kwargs in [{}, {'inmaxlevel': 1}, {'inskipfirsttag': True}, {'infields': ['tag2_item1']},
+                               {'inuseattrs': False}]:
+                    res1 = xml_to_json_flat(xml, intagname, **kwargs)
+                    for parser in PARSERS:
+                        res2 = xml_to_json_flat(xml, intagname, parser=parser, **kwargs)
+                        self.assertEqual(res1, res2, (parser, intagname, kwargs))
+
+        res = xml_to_json_flat(xml_ns, 'tag2', parser='etree')
+        self.assertEqual(res[0]['tag2_attr_p:attr1'], '1')
+        self.assertEqual(res[0]['tag2'], 'texttail')
+        self.assertRaises(ValueError, xml_to_json_flat, self.xml, 'tag2', parser='unknown')
+
+        for name, parser in PARSERS.items():
+            self.assertEqual(parser.kind, name)
+
+        # Повторно используемый парсер etree не удерживает предыдущие документы
+        import weakref
+        from xml_to_json_flat import Flattener, _EtreeParser
+        parser = _EtreeParser()
+        flattener = Flattener('tag1/tag2', parser=parser)
+        res = flattener.convert(self.xml)
+        doc = weakref.ref(parser.parse(self.xml))
+        self.assertEqual(flattener.convert(self.xml), res)
+        self.assertIsNone(doc())
+
+
+    def test_flattener(self):
+        from xml_to_json_flat import xml_to_json_flat, Flattener
+
+        # Один план используется для нескольких документов
+        flattener = Flattener('tag1/tag2', infields=['tag1_tag2_item1', 'tag1_tag2_itemlist_Элемент4'],
+                              inuseattrs=False, parser='etree')
+        res1 = flattener.convert(self.xml)
+        res2 = flattener.convert(self.xml)
+        self.assertEqual(res1, [{'tag1_tag2_item1': '1', 'tag1_tag2_itemlist_Элемент4': '4'},
+                                {'tag1_tag2_item1': '11', 'tag1_tag2_itemlist_Элемент4': '44'}])
+        self.assertEqual(res1, res2)
+        self.assertEqual(res1, xml_to_json_flat(self.xml, 'tag1/tag2', infields=flattener.infields, inuseattrs=False))
+
+        # Ключи записей не создаются заново для каждой записи
+        keys1 = [key for key in res1[0] if key == 'tag1_tag2_item1']
+        keys2 = [key for key in res2[1] if key == 'tag1_tag2_item1']
+        self.assertIs(keys1[0], keys2[0])
+
+        # Атрибуты не фильтруются по infields
+        res3 = Flattener('tag2', infields=['tag2_item1']).convert(self.xml)
+        self.assertEqual(res3[0]['tag2_item3_attr_prop2'], 'Property2')
+        self.assertNotIn('tag2_item2', res3[0])
+
+        # Прежний интерфейс _get_records: один план на все записи, ключи общие
+        from xml_to_json_flat import _get_records, _get_parser, _json_fields_sync
+        parser = _get_parser('etree')
+        records = _get_records(parser.find_all(parser.parse(self.xml), 'tag2'), ['tag1'], inparser=parser)
+        self.assertEqual(_json_fields_sync(records), xml_to_json_flat(self.xml, 'tag1/tag2'))
+        self.assertIs([key for key in records[0] if key == 'tag1_tag2_item1'][0],
+                      [key for key in records[1] if key == 'tag1_tag2_item1'][0])
+
+    def test_projection(self):
+        import io
+        from xml_to_json_flat import xml_to_json_flat, iter_xml_to_json_flat, Flattener, _EtreeParser, _json_fields_sync
+
+        class CountingParser(_EtreeParser):
+            visited = 0
+
+            def children(self, innode):
+                self.visited += 1
+                return super().children(innode)
+
+        # Запись читается, пока не заполнены все поля infields (первые значения)
+        xml = '<r><rec><a>1</a><b><c>2</c></b><a>3</a><d><e/><e/></d></rec></r>'
+        parser = CountingParser()
+        flattener = Flattener('rec', infields=['rec_a', 'rec_b_c'], inuseattrs=False, parser=parser)
+        self.assertEqual(flattener.convert(xml), [{'rec_a': '1', 'rec_b_c': '2'}])
+        self.assertEqual(parser.visited, 4)  # rec, a, b, c
+        self.assertEqual(Flattener('rec', infields=['rec_a', 'rec_d_e'], inuseattrs=False).convert(xml),
+                         [{'rec_a': '1', 'rec_d_e': ''}])
+
+        # При потоковом разборе ненужные поддеревья очищаются сразу, в том числе во вложенных записях
+        xml = ('<r><tag2><x><tag2><_u>1</_u></tag2><y>-</y></x><tag2><tag2><_u>2</_u></tag2></tag2>'
+               '<a>3</a></tag2></r>')
+        for kwargs in [{}, {'inskipfirsttag': True}, {'repeated': 'join'}, {'repeated': 'explode'}]:
+            for infields in [['tag2_a', 'tag2_tag2__u'], ['tag2__u'], ['_u', '_tag2__u']]:
+                res = xml_to_json_flat(xml, 'tag2', infields=infields, inuseattrs=False, parser='etree', **kwargs)
+                source = io.BytesIO(xml.encode())
+                self.assertEqual(_json_fields_sync(list(iter_xml_to_json_flat(
+                    source, 'tag2', infields=infields, inuseattrs=False, **kwargs))), res, (kwargs, infields))
+
+    def test_selectors(self):
+        from xml_to_json_flat import xml_to_json_flat, iter_xml_to_json_flat, xml_to_json_flat_parallel, _Selector
+
+        xml = """<?xml version="1.0" encoding="utf-8"?>
+        <root>
+            <order id="1" type="a"><line><sku>A</sku></line><line><sku>B</sku></line></order>
+            <order id="2" type="b"><box><line><sku>C</sku></line></box></order>
+            <customer><line><sku>X</sku></line></customer>
+        </root>"""
+        cases = [
+            ('order/line', [{'order_line_sku': 'A'}, {'order_line_sku': 'B'}]),
+            ('*/line', [{'order_line_sku': 'A', 'box_line_sku': None, 'customer_line_sku': None},
+                        {'order_line_sku': 'B', 'box_line_sku': None, 'customer_line_sku': None},
+                        {'order_line_sku': None, 'box_line_sku': 'C', 'customer_line_sku': None},
+                        {'order_line_sku': None, 'box_line_sku': None, 'customer_line_sku': 'X'}]),
+            ('order//line', [{'order_line_sku': 'A'}, {'order_line_sku': 'B'}, {'order_line_sku': 'C'}]),
+            ('order[@type="b"]//sku', [{'order_sku': 'C'}]),
+            ('/root/order[@id]', [{'root_order_line_sku': 'A', 'root_order_attr_id': '1', 'root_order_attr_type': 'a',
+                                   'root_order_box_line_sku': None},
+                                  {'root_order_line_sku': None, 'root_order_attr_id': '2',
+                                   'root_order_attr_type': 'b', 'root_order_box_line_sku': 'C'}]),
+            ('/order', []),
+            ("//order[@id='2'][@type='b']/box", [{'order_box_line_sku': 'C'}]),
+        ]
+        for intagname, expected in cases:
+            for parser in ['bs4', 'lxml', 'etree']:
+                self.assertEqual(xml_to_json_flat(xml, intagname, parser=parser), expected, (intagname, parser))
+            stream = [{key: rec.get(key) for key in expected[0]}
+                      for rec in iter_xml_to_json_flat(xml.encode(), intagname)]
+            self.assertEqual(stream, expected, intagname)
+            self.assertEqual(xml_to_json_flat_parallel(xml.encode(), intagname, workers=1), expected, intagname)
+
+        # Простой путь проверяется как раньше, селекторы - через _Selector.match
+        self.assertTrue(_Selector('tag1/tag2').simple)
+        self.assertTrue(_Selector('[document]/tag1').simple)
+        self.assertFalse(_Selector('tag1/*').simple)
+        for selector in ['tag1/', 'tag1[@a=1]', '', 'tag1///tag2']:
+            with self.assertRaises(ValueError):
+                _Selector(selector)
+
+    def test_multi(self):
+        from xml_to_json_flat import xml_to_json_flat, xml_to_json_flat_multi, iter_xml_to_json_flat_multi
+
+        xml = """<?xml version="1.0" encoding="utf-8"?>
+        <root>
+            <Order id="1"><Line><Sku>A</Sku></Line><Line><Sku>B</Sku></Line></Order>
+            <Customer><Name>Иван</Name></Customer>
+            <Order id="2"><Line><Sku>C</Sku></Line></Order>
+        </root>"""
+        selectors = {
+            'orders': {'intagname': 'Order', 'inmaxlevel': 1},
+            'lines': {'intagname': 'Order/Line', 'infields': ['Order_Line_Sku'], 'parent': 'orders'},
+            'customers': {'intagname': 'Customer', 'inskipfirsttag': True},
+        }
+        # Результат каждого набора совпадает с отдельным вызовом xml_to_json_flat
+        for parser in ['bs4', 'lxml', 'etree']:
+            res = xml_to_json_flat_multi(xml, selectors, parser=parser)
+            self.assertEqual(list(res), ['orders', 'lines', 'customers'])
+            self.assertEqual(res['orders'], xml_to_json_flat(xml, 'Order', inmaxlevel=1, parser=parser))
+            self.assertEqual(res['lines'], xml_to_json_flat(xml, 'Order/Line', infields=['Order_Line_Sku']))
+            self.assertEqual(res['customers'], [{'Name': 'Иван'}])
+
+        # Связь дочерних записей с родительскими
+        res = xml_to_json_flat_multi(xml, selectors, parser='lxml', parentkey=True)
+        self.assertEqual([(rec['_id'], rec['_parent'], rec['_parent_id']) for rec in res['lines']],
+                         [(0, 'orders', 0), (1, 'orders', 0), (2, 'orders', 1)])
+        self.assertEqual([rec['Order_attr_id'] for rec in res['orders']], ['1', '2'])
+        self.assertEqual(res['customers'][0]['_parent'], None)
+
+        # Потоковый вариант: те же записи в порядке документа
+        stream = list(iter_xml_to_json_flat_multi(xml.encode(), selectors, parentkey=True))
+        self.assertEqual([name for name, rec in stream], ['orders', 'lines', 'lines', 'customers', 'orders', 'lines'])
+        for name in selectors:
+            self.assertEqual([rec for recname, rec in stream if recname == name],
+                             [{key: value for key, value in rec.items() if value is not None or key[0] == '_'}
+                              for rec in res[name]])
+
+        with self.assertRaises(ValueError):
+            xml_to_json_flat_multi(xml, {'lines': {'intagname': 'Line', 'parent': 'orders'}})
+
+    def test_repeated(self):
+        import itertools
+        from xml_to_json_flat import xml_to_json_flat, iter_xml_to_json_flat, Flattener
+
+        xml = """<?xml version="1.0" encoding="utf-8"?>
+        <root>
+            <order id="1">
+                <num>1</num>
+                <line n="1"><sku>A</sku></line>
+                <line n="2"><sku>B</sku></line>
+                <pay>cash</pay>
+                <pay>card</pay>
+            </order>
+            <order id="2"><num>2</num><line n="1"><sku>C</sku></line></order>
+        </root>"""
+        # По умолчанию - первый тег
+        res = xml_to_json_flat(xml, 'order', inuseattrs=False)
+        self.assertEqual(res[0], {'order_num': '1', 'order_line_sku': 'A', 'order_pay': 'cash'})
+
+        for parser in ['bs4', 'lxml', 'etree']:
+            res = xml_to_json_flat(xml, 'order', parser=parser, repeated='index')
+            self.assertEqual(res[0], {'order_attr_id': '1', 'order_num': '1',
+                                      'order_line_0_sku': 'A', 'order_line_0_attr_n': '1',
+                                      'order_line_1_sku': 'B', 'order_line_1_attr_n': '2',
+                                      'order_pay_0': 'cash', 'order_pay_1': 'card', 'order_line_sku': None,
+                                      'order_line_attr_n': None})
+            # Одиночный тег без номера
+            self.assertEqual(res[1]['order_line_sku'], 'C')
+
+            res = xml_to_json_flat(xml, 'order', parser=parser, repeated='join', separator='|')
+            self.assertEqual(res[0], {'order_attr_id': '1', 'order_num': '1', 'order_line_sku': 'A|B',
+                                      'order_line_attr_n': '1|2', 'order_pay': 'cash|card'})
+
+            res = xml_to_json_flat(xml, 'order', parser=parser, inuseattrs=False, repeated='explode')
+            self.assertEqual(res, [
+                {'order_num': '1', 'order_line_sku': 'A', 'order_pay': 'cash'},
+                {'order_num': '1', 'order_line_sku': 'A', 'order_pay': 'card'},
+                {'order_num': '1', 'order_line_sku': 'B', 'order_pay': 'cash'},
+                {'order_num': '1', 'order_line_sku': 'B', 'order_pay': 'card'},
+                {'order_num': '2', 'order_line_sku': 'C', 'order_pay': None},
+            ])
+
+        # infields учитывает номер в ключе
+        res = xml_to_json_flat(xml, 'order', infields=['order_line_1_sku'], inuseattrs=False, repeated='index')
+        self.assertEqual(res, [{'order_line_1_sku': 'B'}, {'order_line_1_sku': None}])
+
+        # Потоковый вариант совпадает с xml_to_json_flat
+        for repeated in ['index', 'join', 'explode']:
+            stream = list(iter_xml_to_json_flat(xml.encode(), 'order', repeated=repeated))
+            self.assertEqual([{key: value for key, value in rec.items() if value is not None}
+                              for rec in xml_to_json_flat(xml, 'order', repeated=repeated)], stream)
+
+        # explode не строит все сочетания сразу: 3 списка по 1000 тегов - миллиард записей
+        bigxml = '<r><o>{}{}{}</o></r>'.format('<a>1</a>' * 1000, '<b>2</b>' * 1000, '<c>3</c>' * 1000)
+        first = list(itertools.islice(iter_xml_to_json_flat(bigxml.encode(), 'o', repeated='explode'), 3))
+        self.assertEqual(first, [{'o_a': '1', 'o_b': '2', 'o_c': '3'}] * 3)
+
+        with self.assertRaises(ValueError):
+            Flattener('order', repeated='all')
+
+    def test_async(self):
+        import asyncio
+        from xml_to_json_flat import (xml_to_json_flat, iter_xml_to_json_flat, iter_xml_to_json_flat_multi,
+                                      aiter_xml_to_json_flat, aiter_xml_to_json_flat_multi, AsyncConverter)
+
+        class MemoryStream(object):
+            """ Замена asyncio.StreamReader: данные из памяти небольшими частями """
+            active = 0
+            maxactive = 0
+
+            def __init__(self, data, size=7):
+                self.data = data
+                self.size = size
+                self.pos = 0
+
+            async def read(self, n=-1):
+                if self.pos == 0:
+                    MemoryStream.active += 1
+                    MemoryStream.maxactive = max(MemoryStream.maxactive, MemoryStream.active)
+                await asyncio.sleep(0)
+                chunk = self.data[self.pos:self.pos + min(n, self.size)]
+                self.pos += len(chunk)
+                if not chunk:
+                    MemoryStream.active -= 1
+                return chunk
+
+        async def chunks(data):
+            for pos in range(0, len(data), 5):
+                yield data[pos:pos + 5]
+
+        async def collect(aiterator):
+            return [item async for item in aiterator]
+
+        data = self.xml.encode('utf-8')
+        expected = list(iter_xml_to_json_flat(data, 'tag1/tag2'))
+        self.assertEqual(asyncio.run(collect(aiter_xml_to_json_flat(MemoryStream(data), 'tag1/tag2'))), expected)
+        self.assertEqual(asyncio.run(collect(aiter_xml_to_json_flat(chunks(data), 'tag1/tag2'))), expected)
+        self.assertEqual(asyncio.run(collect(aiter_xml_to_json_flat(data, 'tag1/tag2', chunksize=3))), expected)
+        selectors = {'a': 'tag2', 'b': 'itemlist'}
+        self.assertEqual(asyncio.run(collect(aiter_xml_to_json_flat_multi(chunks(data), selectors, parentkey=True))),
+                         list(iter_xml_to_json_flat_multi(data, selectors, parentkey=True)))
+
+        # Разбор большого документа не останавливает цикл событий
+        bigdata = b'<r>' + b'<tag2><item1>1</item1></tag2>' * 20000 + b'</r>'
+
+        async def ticks():
+            count = 0
+            task = asyncio.ensure_future(collect(aiter_xml_to_json_flat(bigdata, 'tag2', chunksize=4096)))
+            while not task.done():
+                count += 1
+                await asyncio.sleep(0)
+            return count, len(task.result())
+
+        count, records = asyncio.run(ticks())
+        self.assertEqual(records, 20000)
+        self.assertGreater(count, 10)
+
+        # Ограничение кол-ва одновременных преобразований
+        async def limited():
+            async with AsyncConverter(workers=1, concurrency=2) as converter:
+                return await asyncio.gather(*[collect(converter.iter_records(MemoryStream(data), 'tag2'))
+                                              for i in range(5)])
+
+        results = asyncio.run(limited())
+        self.assertEqual(results, [list(iter_xml_to_json_flat(data, 'tag2'))] * 5)
+        self.assertEqual(MemoryStream.maxactive, 2)
+
+        # Большие документы - в пуле процессов
+        async def offload():
+            async with AsyncConverter(workers=1, offloadsize=100) as converter:
+                return await asyncio.gather(converter.convert(self.xml, 'tag2', parser='lxml'),
+                                            converter.convert('<a><tag2>1</tag2></a>', 'tag2'))
+
+        self.assertEqual(asyncio.run(offload()), [xml_to_json_flat(self.xml, 'tag2'), [{'tag2': '1'}]])
+
+        # Небольшие документы - в потоке: цикл событий продолжает работать
+        async def inthread():
+            async with AsyncConverter(workers=1, offloadsize=None) as converter:
+                task = asyncio.ensure_future(converter.convert(bigdata, 'tag2', parser='etree'))
+                count = 0
+                while not task.done():
+                    count += 1
+                    await asyncio.sleep(0.001)
+                return count, len(task.result())
+
+        count, records = asyncio.run(inthread())
+        self.assertEqual(records, 20000)
+        self.assertGreater(count, 1)
+
+    def test_cache(self):
+        import io
+        import pathlib
+        import pickle
+        import tempfile
+        from xml_to_json_flat import xml_to_json_flat, ResultCache
+
+        cache = ResultCache()
+        expected = xml_to_json_flat(self.xml, 'tag2')
+        res1 = xml_to_json_flat(self.xml, 'tag2', cache=cache)
+        res2 = xml_to_json_flat(self.xml, 'tag2', cache=cache)
+        self.assertEqual(res1, expected)
+        self.assertEqual(res2, expected)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # Изменение результата не меняет кэш
+        res2[0]['tag2_item1'] = 'изменено'
+        res2.append({})
+        self.assertEqual(xml_to_json_flat(self.xml, 'tag2', cache=cache), expected)
+
+        # Другие параметры или другой XML - другой ключ, порядок infields не важен
+        xml_to_json_flat(self.xml, 'tag2', inuseattrs=False, cache=cache)
+        xml_to_json_flat(self.xml.replace('11', '12'), 'tag2', cache=cache)
+        self.assertEqual(cache.misses, 3)
+        fields = ['tag2_item1', 'tag2_item2']
+        xml_to_json_flat(self.xml, 'tag2', infields=fields, cache=cache)
+        xml_to_json_flat(self.xml, 'tag2', infields=fields[::-1], cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (3, 4))
+        self.assertEqual(xml_to_json_flat(self.xml.encode(), 'tag2', output='columns', cache=cache).to_records(),
+                         expected)
+
+        # Файловые объекты не кэшируются
+        self.assertEqual(xml_to_json_flat(io.BytesIO(self.xml.encode()), 'tag2', parser='lxml', cache=cache),
+                         expected)
+        self.assertEqual((cache.hits, cache.misses), (3, 5))
+
+        # Вытеснение старых результатов по размеру
+        small = ResultCache(maxbytes=len(pickle.dumps(expected, protocol=pickle.HIGHEST_PROTOCOL)) * 2)
+        for i in range(3):
+            xml_to_json_flat(self.xml.replace('11', str(i)), 'tag2', cache=small)
+        self.assertEqual(len(small), 2)
+        self.assertEqual(small.evictions, 1)
+        self.assertLessEqual(small.bytes, small.maxbytes)
+        xml_to_json_flat(self.xml.replace('11', '0'), 'tag2', cache=small)
+        self.assertEqual(small.hits, 0)
+
+        # Результаты в файлах доступны новому экземпляру кэша
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cachedir = os.path.join(tmpdir, 'cache')
+            xml_to_json_flat(pathlib.Path(EXAMPLE01), 'tag1/tag2', cache=ResultCache(cachedir=cachedir))
+            diskcache = ResultCache(cachedir=cachedir)
+            self.assertEqual(xml_to_json_flat(pathlib.Path(EXAMPLE01), 'tag1/tag2', cache=diskcache),
+                             xml_to_json_flat(pathlib.Path(EXAMPLE01), 'tag1/tag2'))
+            self.assertEqual(diskcache.stats()['diskhits'], 1)
+            diskcache.clear()
+            self.assertEqual(os.listdir(cachedir), [])
+
+    def test_columns(self):
+        from xml_to_json_flat import xml_to_json_flat
+
+        res = xml_to_json_flat(self.xml, 'tag2', output='columns')
+        self.assertEqual(len(res), 3)
+        self.assertEqual(res.fields[:3], ['tag2_item1', 'tag2_item2', 'tag2_item3'])
+        self.assertEqual(res['tag2_item1'], ['1', '11', None])
+        self.assertEqual(res['tag2_item'], [None, None, 'tag2 in tag2'])
+        self.assertEqual(res['tag2_item3_attr_prop2'], ['Property2', None, None])
+        self.assertEqual(res.to_records(), xml_to_json_flat(self.xml, 'tag2'))
+        self.assertEqual(list(res.rows())[1][:2], ('11', '22'))
+        self.assertRaises(ValueError, xml_to_json_flat, self.xml, 'tag2', output='unknown')
+
+        # Порядок колонок в записях не зависит от запуска
+        self.assertEqual(list(xml_to_json_flat(self.xml, 'tag2')[0]), res.fields)
+
+        # Записи без полей: строки есть, колонок нет
+        xml = '<tag1><tag2 /><tag2></tag2></tag1>'
+        res = xml_to_json_flat(xml, 'tag2', infields=['tag2_item1'], output='columns')
+        self.assertEqual(len(res), 2)
+        self.assertEqual(list(res.rows()), [(), ()])
+        self.assertEqual(res.to_records(), xml_to_json_flat(xml, 'tag2', infields=['tag2_item1']))
+        self.assertEqual(res.to_records(), [{}, {}])
+
+    def test_rows(self):
+        import io
+        import json
+        import pickle
+        from xml_to_json_flat import xml_to_json_flat, xml_to_json_flat_multi, write_jsonl, Row
+
+        expected = xml_to_json_flat(self.xml, 'tag2')
+        res = xml_to_json_flat(self.xml, 'tag2', output='rows')
+        self.assertEqual(res, expected)
+        self.assertTrue(all(isinstance(row, Row) for row in res))
+        self.assertIs(res[0].schema, res[2].schema)
+        self.assertEqual(list(res[0].keys()), list(expected[0]))
+        self.assertEqual(res[1]['tag2_item1'], '11')
+        self.assertIsNone(res[0]['tag2_item'])  # Поле появилось после первой записи
+        self.assertIsNone(res[0].get('нет такого поля'))
+        self.assertRaises(KeyError, lambda: res[0]['нет такого поля'])
+        self.assertEqual([row.to_dict() for row in res], expected)
+        self.assertEqual(json.loads(json.dumps(res, default=dict)), expected)
+        self.assertEqual(pickle.loads(pickle.dumps(res)), expected)
+        buf = io.BytesIO()
+        write_jsonl(res, buf)
+        self.assertEqual([json.loads(line) for line in buf.getvalue().splitlines()], expected)
+
+        # Одинаковые значения - один объект строки
+        xml = '<a>' + '<b><status>OK</status><code>OK</code></b>' * 3 + '</a>'
+        res = xml_to_json_flat(xml, 'b', output='rows', intern=True)
+        self.assertEqual(len({id(row[field]) for row in res for field in row}), 1)
+        self.assertEqual(xml_to_json_flat(xml, 'b', intern=True), xml_to_json_flat(xml, 'b'))
+        multi = xml_to_json_flat_multi(xml, {'b': 'b', 'status': 'b/status'}, output='rows', intern=True)
+        self.assertIs(multi['b'][0]['b_status'], multi['status'][2]['b_status'])
+
+
+    def test_stats(self):
+        import contextlib
+        import io
+        import pstats
+        import tempfile
+        from xml_to_json_flat import xml_to_json_flat, main, ConversionStats
+
+        calls = []
+        stats = ConversionStats(callback=lambda stage, wall, cpu: calls.append(stage), memory=True)
+        for parser in ('bs4', 'lxml', 'etree'):
+            res = xml_to_json_flat(self.xml, 'tag2', parser=parser, stats=stats)
+            self.assertEqual(res, xml_to_json_flat(self.xml, 'tag2', parser=parser))
+        self.assertEqual(calls, list(ConversionStats.STAGES) * 3)
+        self.assertEqual(list(stats.stages), list(ConversionStats.STAGES))
+        self.assertEqual(stats.stages['parse']['calls'], 3)
+        self.assertEqual((stats.conversions, stats.records), (3, 9))
+        self.assertEqual(stats.bytes, len(self.xml) * 3)
+        self.assertGreater(stats.elements, stats.records)
+        self.assertEqual(stats.maxdepth, 3)  # tag2/itemlist/Элемент4
+        self.assertGreater(stats.peakmemory, 0)
+        self.assertIn('flatten', stats.report())
+
+        # Замер вызывающего кода через tracemalloc не сбрасывается
+        import tracemalloc
+        tracemalloc.start()
+        try:
+            block = bytearray(4 << 20)
+            del block
+            xml_to_json_flat(self.xml, 'tag2', parser='etree', stats=ConversionStats(memory=True))
+            self.assertGreaterEqual(tracemalloc.get_traced_memory()[1], 4 << 20)
+            self.assertTrue(tracemalloc.is_tracing())
+        finally:
+            tracemalloc.stop()
+
+        # Размер файлового объекта - по прочитанным байтам
+        stats = ConversionStats()
+        xml_to_json_flat(io.BytesIO(self.xml.encode()), 'tag2', parser='etree', stats=stats)
+        self.assertEqual(stats.bytes, len(self.xml.encode()))
+        self.assertEqual(stats.to_dict()['records'], 3)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'doc.xml')
+            with open(path, 'w', encoding='utf-8') as fw:
+                fw.write(self.xml)
+            profile = os.path.join(tmpdir, 'profile.pstats')
+            stderr = io.StringIO()
+            with contextlib.redirect_stderr(stderr):
+                code = main([path, '-t', 'tag2', '-o', os.path.join(tmpdir, 'res.jsonl'), '--profile', profile])
+            self.assertEqual(code, 0)
+            self.assertIn('parse', stderr.getvalue())
+            self.assertGreater(pstats.Stats(profile).total_calls, 0)
+
+    def test_cli(self):
+        import csv
+        import shutil
+        import tempfile
+        from xml_to_json_flat import main, convert_files
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for i in range(3):
+                with open(os.path.join(tmpdir, 'doc{}.xml'.format(i)), 'w', encoding='utf-8') as fw:
+                    fw.write(self.xml)
+            with open(os.path.join(tmpdir, 'bad.xml'), 'w', encoding='utf-8') as fw:
+                fw.write('not xml')
+
+            # Ошибка в одном файле не прерывает обработку остальных
+            results = list(convert_files([tmpdir], 'tag1/tag2', parser='etree', workers=2))
+            self.assertEqual([os.path.basename(path) for path, res, error in results],
+                             ['bad.xml', 'doc0.xml', 'doc1.xml', 'doc2.xml'])
+            self.assertIsNotNone(results[0][2])
+            self.assertEqual(results[1][1][1]['tag1_tag2_item1'], '11')
+
+            # Общий файл результата
+            output = os.path.join(tmpdir, 'res.jsonl')
+            code = main([os.path.join(tmpdir, 'doc*.xml'), '-t', 'tag1/tag2', '-f', 'tag1_tag2_item1', '--no-attrs',
+                         '-o', output, '-j', '2'])
+            self.assertEqual(code, 0)
+            with open(output, encoding='utf-8') as f:
+                lines = [json.loads(line) for line in f]
+            self.assertEqual(lines, [{'tag1_tag2_item1': '1'}, {'tag1_tag2_item1': '11'}] * 3)
+
+            # Файл результата для каждого XML
+            outdir = os.path.join(tmpdir, 'out')
+            code = main([tmpdir, '-t', 'tag2', '--parser', 'etree', '--format', 'csv', '-d', outdir, '-j', '1'])
+            self.assertEqual(code, 1)
+            self.assertEqual(sorted(os.listdir(outdir)), ['doc0.csv', 'doc1.csv', 'doc2.csv'])
+            with open(os.path.join(outdir, 'doc0.csv'), encoding='utf-8') as f:
+                rows = list(csv.DictReader(f))
+            self.assertEqual(len(rows), 3)
+            self.assertEqual(rows[1]['tag2_itemlist_Элемент4'], '44')
+
+            # Файлы с одинаковыми именами из разных каталогов не перезаписывают друг друга
+            for subdir in ['a', 'b']:
+                os.makedirs(os.path.join(tmpdir, 'in', subdir))
+                with open(os.path.join(tmpdir, 'in', subdir, 'x.xml'), 'w', encoding='utf-8') as fw:
+                    fw.write('<tag1><tag2>{}</tag2></tag1>'.format(subdir))
+            outdir = os.path.join(tmpdir, 'out2')
+            code = main([os.path.join(tmpdir, 'in'), '-t', 'tag2', '--parser', 'etree', '-d', outdir, '-j', '1'])
+            self.assertEqual(code, 0)
+            for subdir in ['a', 'b']:
+                with open(os.path.join(outdir, subdir, 'x.jsonl'), encoding='utf-8') as f:
+                    self.assertEqual(json.loads(f.read()), {'tag2': subdir})
+            # Несколько каталогов: имя каталога сохраняется в пути результата
+            outdir = os.path.join(tmpdir, 'out3')
+            code = main([os.path.join(tmpdir, 'in', 'a'), os.path.join(tmpdir, 'in', 'b'), '-t', 'tag2',
+                         '--parser', 'etree', '--format', 'csv', '-d', outdir, '-j', '1'])
+            self.assertEqual(code, 0)
+            self.assertEqual(sorted(os.listdir(outdir)), ['a', 'b'])
+            self.assertEqual(os.listdir(os.path.join(outdir, 'b')), ['x.csv'])
+            # Совпадающий путь результата - к следующему добавляется номер
+            outdir = os.path.join(tmpdir, 'out4')
+            paths = [os.path.join(tmpdir, 'in', subdir, 'x.xml') for subdir in ['a', 'b']]
+            results = list(convert_files(paths, 'tag2', parser='etree', outputdir=outdir, workers=1))
+            self.assertEqual([res for path, res, error in results], [1, 1])
+            with open(os.path.join(outdir, 'x_2.jsonl'), encoding='utf-8') as f:
+                self.assertEqual(json.loads(f.read()), {'tag2': 'b'})
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+    def test_parallel(self):
+        from xml_to_json_flat import xml_to_json_flat, xml_to_json_flat_parallel
+
+        xml_ns = b"""<?xml version="1.0" encoding="utf-8"?>
+        <!-- <tag2> -->
+        <tag1 xmlns="http://default" xmlns:p="http://p">
+            <p:tag2 p:attr1="1" attr2="2>">text<tag2>inner</tag2></p:tag2>
+            <tag2><![CDATA[</tag2>]]></tag2>
+            <other><tag2 p:attr1="3"/></other>
+        </tag1>""".strip()
+
+        # Результат совпадает с последовательной обработкой, в том числе для вложенных тегов
+        for xml in [self.xml.encode('utf-8'), xml_ns]:
+            for intagname in ['tag2', 'tag1/tag2', 'tag2/tag2', 'other/tag2', '']:
+                for parser in ['bs4', 'etree']:
+                    res1 = xml_to_json_flat(xml, intagname, parser=parser)
+                    res2 = xml_to_json_flat_parallel(xml, intagname, parser=parser, workers=2, chunks=3)
+                    self.assertEqual(res1, res2, (intagname, parser))
+
+        res = xml_to_json_flat_parallel(EXAMPLE01, 'tag1/tag2', workers=1, chunks=2)
+        self.assertEqual(res[1]['tag1_tag2_itemlist_item4'], '44')
+
+    def test_incremental(self):
+        import pathlib
+        import tempfile
+        from xml_to_json_flat import xml_to_json_flat, xml_to_json_flat_incremental
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'feed.xml')
+            checkpoint = os.path.join(tmpdir, 'feed.checkpoint.json')
+
+            def write(intext, inmode='a'):
+                with open(path, inmode, encoding='utf-8') as fw:
+                    fw.write(intext)
+
+            def convert(intagname='feed/record', **kwargs):
+                return xml_to_json_flat_incremental(path, intagname, checkpoint, parser='etree', **kwargs)
+
+            # Незаконченная запись в конце файла остается до следующего вызова
+            write('<?xml version="1.0" encoding="utf-8"?>\n<feed xmlns:p="http://p">\n<meta><record>-</record></meta>'
+                  '\n<record p:id="1">раз</record>\n<record p:id="2">дв', 'w')
+            self.assertEqual(convert(), [{'feed_record': 'раз', 'feed_record_attr_p:id': '1'}])
+            write('а</record>\n<record p:id="3"/>')
+            self.assertEqual([rec['feed_record_attr_p:id'] for rec in convert()], ['2', '3'])
+            self.assertEqual(convert(), [])
+            write('<group><record p:id="4">четыре</record></group><record p:id="5">пять</record>\n</feed>\n')
+            self.assertEqual(convert(), [{'feed_record': 'пять', 'feed_record_attr_p:id': '5'}])
+
+            # Все вызовы вместе дают то же, что и обработка файла целиком
+            os.remove(checkpoint)
+            self.assertEqual(convert(), xml_to_json_flat(pathlib.Path(path), 'feed/record', parser='etree'))
+
+            # Перезаписанный или укороченный файл и другие параметры - обработка с начала
+            write('<feed><record>новая</record></feed>', 'w')
+            self.assertEqual(convert(), [{'feed_record': 'новая'}])
+            write('<feed><record>x</record></feed>', 'w')
+            self.assertEqual(convert(), [{'feed_record': 'x'}])
+            write('<feed><record>y</record><record>z</record></feed>', 'w')
+            self.assertEqual(convert(), [{'feed_record': 'y'}, {'feed_record': 'z'}])
+            self.assertEqual(convert(inuseattrs=False), [{'feed_record': 'y'}, {'feed_record': 'z'}])
+            self.assertRaises(ValueError, convert, 'feed//record')
+
+
+    def test_bounded(self):
+        import tempfile
+        from xml_to_json_flat import xml_to_json_flat, xml_to_json_flat_bounded, Limits, LimitExceeded, Flattener
+
+        # Без ограничений результат тот же, что и у xml_to_json_flat
+        with open(EXAMPLE01, 'rb') as f:
+            data = f.read()
+        with xml_to_json_flat_bounded(EXAMPLE01, 'tag1/tag2') as res:
+            self.assertEqual(list(res), xml_to_json_flat(data, 'tag1/tag2'))
+            self.assertEqual(res.oversized, [])
+
+        # Большая, глубокая и широкая записи пропускаются со смещениями в документе
+        big = '<rec><a>' + 'x' * 2000 + '</a></rec>'
+        deep = '<rec>' + '<d>' * 20 + '1' + '</d>' * 20 + '</rec>'
+        wide = '<rec>' + ''.join('<f{0}>{0}</f{0}>'.format(i) for i in range(50)) + '</rec>'
+        parts = ['<root>'] + ['<rec><a>{}</a><b k="{}"/></rec>'.format(i, i) for i in range(20)] + [big, deep, wide]
+        parts += ['<rec><a>last</a></rec>', '</root>']
+        xml = ''.join(parts).encode('utf-8')
+        limits = Limits(maxdepth=10, maxrecordsize=1000, maxfields=20)
+        with xml_to_json_flat_bounded(xml, 'root/rec', parser='etree', limits=limits) as res:
+            self.assertEqual([(item['start'], item['end'], item['reason']) for item in res.oversized], [
+                (xml.index(part.encode()), xml.index(part.encode()) + len(part), reason)
+                for part, reason in [(big, 'size'), (deep, 'depth'), (wide, 'fields')]])
+            self.assertEqual(len(res), 21)
+            self.assertEqual(res.fields, ['root_rec_a', 'root_rec_b', 'root_rec_b_attr_k'])
+            records = list(res)
+            self.assertEqual(records[-1], {'root_rec_a': 'last', 'root_rec_b': None, 'root_rec_b_attr_k': None})
+            self.assertEqual(res.spilled, 0)
+
+        # Записи сверх maxmemory выгружаются во временный файл, порядок сохраняется
+        with tempfile.TemporaryDirectory() as tmpdir:
+            limits = Limits(maxrecordsize=1000, maxdepth=10, maxfields=20, maxmemory=1000, spilldir=tmpdir)
+            with xml_to_json_flat_bounded(xml, 'root/rec', parser='etree', limits=limits) as spilled:
+                self.assertGreater(spilled.spilled, 0)
+                self.assertEqual(len(spilled), 21)
+                self.assertEqual(list(spilled), records)
+        self.assertRaises(ValueError, xml_to_json_flat_bounded, xml, 'root//rec')
+
+        # Запись, которую не разбирает парсер (lxml: глубже 2048 уровней), пропускается, обработка продолжается
+        deep = '<rec>' + '<d>' * 3000 + '1' + '</d>' * 3000 + '</rec>'
+        xml = ('<root><rec><a>1</a></rec>' + deep + '<rec><a>2</a></rec></root>').encode('utf-8')
+        with xml_to_json_flat_bounded(xml, 'root/rec', parser='lxml') as res:
+            self.assertEqual(list(res), [{'root_rec_a': '1'}, {'root_rec_a': '2'}])
+            start = xml.index(deep.encode())
+            self.assertEqual([(item['start'], item['end'], item['reason']) for item in res.oversized],
+                             [(start, start + len(deep), 'parse')])
+
+        # Ограничения в Flattener и обход без рекурсии: глубина не ограничена стеком Python
+        depth = 5000
+        xml = '<root><rec>' + '<d>' * depth + '1' + '</d>' * depth + '</rec></root>'
+        self.assertEqual(xml_to_json_flat(xml, 'rec', parser='etree', inskipfirsttag=True),
+                         [{'_'.join(['d'] * depth): '1'}])
+        flattener = Flattener('rec', parser='etree', limits=Limits(maxdepth=100))
+        self.assertRaises(LimitExceeded, flattener.convert, xml)
+
+    def test_mmap_input(self):
+        import mmap
+        import pathlib
+        from xml_to_json_flat import xml_to_json_flat, iter_xml_to_json_flat, _json_fields_sync
+
+        with open(EXAMPLE01, 'r', encoding='utf-8') as f:
+            res = xml_to_json_flat(f.read(), 'tag1/tag2')
+
+        # Путь, mmap и memoryview разбираются без чтения файла в str
+        with open(EXAMPLE01, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for parser in ['bs4', 'lxml', 'etree']:
+                    self.assertEqual(xml_to_json_flat(pathlib.Path(EXAMPLE01), 'tag1/tag2', parser=parser), res)
+                    self.assertEqual(xml_to_json_flat(data, 'tag1/tag2', parser=parser), res)
+                    view = memoryview(data)
+                    self.assertEqual(xml_to_json_flat(view, 'tag1/tag2', parser=parser), res)
+                    view.release()
+                self.assertEqual(_json_fields_sync(list(iter_xml_to_json_flat(data, 'tag1/tag2'))), res)
+            finally:
+                data.close()
+
+        # Кодировка берется из объявления XML
+        xml = '<?xml version="1.0" encoding="windows-1251"?><Записи><Запись Имя="ё">1</Запись></Записи>'
+        for parser in ['bs4', 'lxml', 'etree']:
+            res = xml_to_json_flat(memoryview(xml.encode('cp1251')), 'Запись', parser=parser)
+            self.assertEqual(res, [{'Запись': '1', 'Запись_attr_Имя': 'ё'}])
+
+
+    def test_writers(self):
+        import csv
+        import io
+        from xml_to_json_flat import write_jsonl, write_csv, write_parquet, iter_xml_to_json_flat, xml_to_json_flat
+
+        # Записи пишутся по мере получения из генератора
+        f = io.BytesIO()
+        count = write_jsonl(iter_xml_to_json_flat(EXAMPLE01, 'tag1/tag2'), f)
+        self.assertEqual(count, 2)
+        lines = [json.loads(line) for line in f.getvalue().decode('utf-8').splitlines()]
+        self.assertEqual(lines[0]['tag1_tag2_item3_attr_Свойство1'], 'Значение1')
+        self.assertNotIn('tag1_tag2_item3', lines[1])
+
+        # С infields во всех строках одинаковые поля
+        f = io.StringIO()
+        write_jsonl(iter_xml_to_json_flat(EXAMPLE01, 'tag2'), f, infields=['tag2_item1', 'tag2_item3'])
+        self.assertEqual([json.loads(line) for line in f.getvalue().splitlines()],
+                         [{'tag2_item1': '1', 'tag2_item3': ''}, {'tag2_item1': '11', 'tag2_item3': None}])
+
+        f = io.StringIO(newline='')
+        write_csv(iter_xml_to_json_flat(EXAMPLE01, 'tag2'), f, infields=['tag2_item1', 'tag2_itemlist_item4'])
+        self.assertEqual(list(csv.reader(io.StringIO(f.getvalue()))),
+                         [['tag2_item1', 'tag2_itemlist_item4'], ['1', '4'], ['11', '44']])
+
+        # Без infields заголовок берется из первой записи
+        f = io.StringIO(newline='')
+        write_csv(xml_to_json_flat(self.xml, 'tag1/tag2'), f)
+        self.assertEqual(len(list(csv.DictReader(io.StringIO(f.getvalue())))), 2)
+        recs = list(iter_xml_to_json_flat(EXAMPLE01, 'tag2'))[::-1]  # Во второй записи есть новые поля
+        self.assertRaises(ValueError, write_csv, recs, io.StringIO())
+
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            return
+        f = io.BytesIO()
+        write_parquet(xml_to_json_flat(self.xml, 'tag2'), f, inbatchsize=2)
+        table = pyarrow.parquet.read_table(io.BytesIO(f.getvalue()))
+        self.assertEqual(table.column('tag2_item1').to_pylist(), ['1', '11', None])
+
+        # Без -o parquet пишется в байтовый поток stdout
+        from unittest import mock
+        from xml_to_json_flat import main
+        stdout = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+        with mock.patch('sys.stdout', stdout):
+            self.assertEqual(main([EXAMPLE01, '-t', 'tag1/tag2', '--format', 'parquet', '-j', '1']), 0)
+        table = pyarrow.parquet.read_table(io.BytesIO(stdout.buffer.getvalue()))
+        self.assertEqual(table.column('tag1_tag2_item1').to_pylist(), ['1', '11'])
+
+
+    def test_discover_schema(self):
+        import shutil
+        import tempfile
+        from xml_to_json_flat import discover_schema, load_schema, xml_to_json_flat, main
+
+        res = xml_to_json_flat(self.xml, 'tag2')
+        fields = discover_schema(self.xml.strip().encode('utf-8'), 'tag2')
+        self.assertEqual(fields, list(res[0]))
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            source = os.path.join(tmpdir, 'doc.xml')
+            schemafile = os.path.join(tmpdir, 'doc.schema.json')
+            with open(source, 'w', encoding='utf-8') as fw:
+                fw.write(self.xml.strip())
+            self.assertEqual(discover_schema(source, 'tag2', schemafile=schemafile), fields)
+            self.assertEqual(load_schema(schemafile), fields)
+
+            # Файл схемы новее XML: XML не читается
+            with open(schemafile, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            cached['fields'] = ['cached']
+            with open(schemafile, 'w', encoding='utf-8') as fw:
+                json.dump(cached, fw)
+            self.assertEqual(discover_schema(source, 'tag2', schemafile=schemafile), ['cached'])
+
+            # XML новее, но содержимое не изменилось: схема берется по хэшу
+            os.utime(schemafile, (1, 1))
+            self.assertEqual(discover_schema(source, 'tag2', schemafile=schemafile), ['cached'])
+
+            # Другие параметры или другое содержимое: схема определяется заново
+            self.assertEqual(discover_schema(source, 'tag2', inuseattrs=False, schemafile=schemafile),
+                             [field for field in fields if '_attr_' not in field])
+            with open(source, 'w', encoding='utf-8') as fw:
+                fw.write('<tag1><tag2><new>1</new></tag2></tag1>')
+            os.utime(schemafile, (1, 1))
+            self.assertEqual(discover_schema(source, 'tag2', schemafile=schemafile), ['tag2_new'])
+
+            # Колонки результата из файла схемы
+            output = os.path.join(tmpdir, 'res.jsonl')
+            with open(source, 'w', encoding='utf-8') as fw:
+                fw.write(self.xml.strip())
+            discover_schema(source, 'tag2', schemafile=schemafile)
+            self.assertEqual(main([source, '-t', 'tag2', '--schema', schemafile, '-o', output]), 0)
+            with open(output, encoding='utf-8') as f:
+                lines = [json.loads(line) for line in f]
+            self.assertEqual(lines, res)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
     def test_check_parent(self):
         from xml_to_json_flat import _check_parent
         xml = '''
@@ -92,200 +930,10 @@ class TestXmlToJsonFlat(unittest.TestCase):
 
 
     def test_sql_function(self):
-        # CREATE OR REPLACE FUNCTION public.xml_to_json_flat(
-        #     inxml text,
-        #     intagname character varying,
-        #     inmaxlevel integer DEFAULT 0,
-        #     infields jsonb DEFAULT '[]'::jsonb)
-        #     inuseattrs - Добавлять данные из атрибутов тега
-        #     inskipfirsttag - Исключить из ключа словаря имя искомого тега
-        #   RETURNS jsonb AS
-        # $BODY$
-        def sql_function(inxml, intagname, inmaxlevel=0, infields='[]', inuseattrs=True, inskipfirsttag=False):  # for test
-            # --- BEGIN BODY FUNCTION --- #
-            import json
-            from bs4 import BeautifulSoup
-
-            def _xmlobj_to_jsonobj_flat(inxmlobj, inpreffix='', infields=[], inmaxlevel=0, inuseattrs=True,
-                                        inskipfirsttag=False):
-                """
-                Получение одной плоской записи из тега
-                Пример XML: <parent1><parent2><item1>123</item1></parent2><parent21>456</parent21></parent1>
-                Результат при передаче тега parent1: {"parent1_parent2_item1": "123", "parent1_parent21": "456"}
-                :param inxmlobj: XML-тег
-                :type inxmlobj: bs4.element.Tag
-                :param inpreffix: Строка префикса для json поля
-                :type inpreffix: str
-                :param infields: Список наименований полей которые должны быть в результате. Пустой список - все поля
-                :type infields: list
-                :param inmaxlevel: Максимальное кол-во погружения в xml
-                :type inmaxlevel: int
-                :param inuseattrs: Выводить аттрибуты или нет
-                :type inuseattrs: bool
-                :param inskipfirsttag: Убрать из начала ключа словаря имя искомого тега
-                :type inskipfirsttag: bool
-                :return: Плоский словарь с полями из имен тегов через _
-                :rtype: dict
-                """
-                # Получаем json из одного тега в плоском виде
-                data = {}
-
-                def get_json_rec(inxmlobj, inpreffix, level):
-                    if inxmlobj.findChildren(recursive=False):
-                        if inmaxlevel == 0 or inmaxlevel >= level:
-                            for item in inxmlobj.findChildren(recursive=False):
-                                get_json_rec(item, inpreffix + '_' + item.name, level + 1)
-                    else:
-                        if inpreffix not in data:  # Добавлять только если данных нет
-                            if not infields or inpreffix in infields:  # Добавлять только если поле есть в infields
-                                key = inpreffix.lstrip(' _')
-                                data[key] = inxmlobj.text
-                    if inuseattrs and inxmlobj.attrs:
-                        for attr in inxmlobj.attrs:
-                            key = '{}_attr_{}'.format(inpreffix, attr).lstrip(' _')
-                            data[key] = inxmlobj.attrs[attr]
-
-                if inskipfirsttag:
-                    get_json_rec(inxmlobj, '', 1)
-                else:
-                    get_json_rec(inxmlobj, inpreffix + inxmlobj.name, 1)
-                return data
-
-            def _check_parent(inxmlobj, inparenttags):
-                """
-                Проверка что тег inxmlobj вложен в родительские теги inparenttags
-                Пример XML: <parent1><parent2><item1>123</item1></parent2><parent21>456</parent21></parent1>
-                Результат при передаче тега item1, inparenttags='parent1/parent2': True
-                :param inxmlobj: XML-тег
-                :type inxmlobj: bs4.element.Tag
-                :param inparenttags: Родительские теги в виде списка или текста разделенного слэшами /
-                :type inparenttags: str|list
-                :return: Тег inxmlobj вложен в родительские теги inparenttags
-                :rtype: bool
-                """
-
-                if type(inparenttags) == str:
-                    if inparenttags:
-                        inparenttags = inparenttags.split('/')  # Приводим inparenttags к списку, если передана строка
-                    else:
-                        inparenttags = []
-                parenttag = inxmlobj.parent
-                for parenttagname in inparenttags[::-1]:
-                    if parenttag and parenttag.name == parenttagname:
-                        parenttag = parenttag.parent
-                    else:
-                        return False
-                return True
-
-            def _get_records(xml_item_list, inparenttags=[], infields=[], inmaxlevel=0, inuseattrs=True,
-                             inskipfirsttag=False):
-                """
-                Получение записей c проверкой на соответствие переданным родительским тегам
-                :param xml_item_list: Список XML-объектов, которые необходимо преобразовать в JSON
-                :param inparenttags: Список родительских тегов которые должен иметь рассматриваемый тег
-                :param infields: Список имен полей, которые должны попасть в результат
-                :param inmaxlevel: Максимальный уровень погружения. 0 - без ограничений
-                :param inuseattrs: Добавлять данные из атрибутов
-                :param inskipfirsttag: Убрать из начала ключа словаря имя искомого тега
-                :return: Список плоских словарей с данными
-                :type xml_item_list: list
-                :type inparenttags: list
-                :type infields: list
-                :type inmaxlevel: int
-                :type inuseattrs: bool
-                :type inskipfirsttag: bool
-                :rtype: list
-                """
-                res = []
-                for item in xml_item_list:
-                    # Проверяем соответствуют ли родительские теги переданным
-                    if _check_parent(item, inparenttags):
-                        preffix = ''
-                        if inparenttags:
-                            preffix = '_'.join(inparenttags) + '_'
-                        rec = _xmlobj_to_jsonobj_flat(item, preffix, infields=infields, inmaxlevel=inmaxlevel,
-                                                      inuseattrs=inuseattrs, inskipfirsttag=inskipfirsttag)
-                        res.append(rec)
-                return res
-
-            def _json_fields_sync(inlist):
-                """
-                Синхронизация колонок (приведение к одинаковому количеству во всех строках)
-                :param inlist: Список словарей
-                :return: Список словарей с одинаковым кол-вом ключей
-                :type inlist: list
-                :rtype: list
-                """
-
-                res = []
-                fields = set()
-                for rec in inlist:
-                    fields.update(rec.keys())
-                for rec in inlist:
-                    new_rec = {}
-                    for fieldname in fields:
-                        if fieldname in rec:
-                            new_rec[fieldname] = rec[fieldname]
-                        else:
-                            new_rec[fieldname] = None
-                    res.append(new_rec)
-                return res
-
-            def xml_to_json_flat(inxml, intagname, infields=[], inmaxlevel=0, inuseattrs=True, inskipfirsttag=False):
-                """
-                Основная функция принимает XML в виде текста. Ищет теги с именем intagname и выводит список
-                    найденного в виде плоского словаря
-                Внимание: Если внутри тега есть несколько рядом стоящих одинаковых тегов, то будет использован только первый
-                :param inxm: XML текст
-                :param intagname: Наименование тега, список которых необходимо найти в xml. Если значение пустое, использовать
-                    тег верхнего уровня
-                :param infields: Список полей, которые должны быть выведены в результате. Пустой список - все поля
-                :param inmaxlevel: Максимальный уровень погружения. 0 - без ограничений
-                :param inuseattrs: Выводить аттрибуты или нет
-                :param inskipfirsttag: Убрать из начала ключа словаря имя искомого тега
-                :return: Список json строк
-                :type intagname: str
-                :type infields: list
-                :type inmaxlevel: int
-                :type inuseattrs: bool
-                :type inxm: str
-                :type inskipfirsttag: bool
-                :rtype: list
-                """
-                soup = BeautifulSoup(inxml, 'xml')
-                if intagname:
-                    # Разделяем parent-тег
-                    tagnamesplit = intagname.split('/')
-                    tagname = tagnamesplit[-1]
-                    parenttags = tagnamesplit[:-1]
-                    tags = soup.find_all(tagname)  # Список тегов
-                else:
-                    tags = soup.contents
-                    parenttags = []
-
-                json_list = _get_records(tags, inparenttags=parenttags, infields=infields, inmaxlevel=inmaxlevel,
-                                         inuseattrs=inuseattrs, inskipfirsttag=inskipfirsttag)
-                json_list = _json_fields_sync(json_list)
-                return json_list
-
-
-            fields = json.loads(infields)
-            res = xml_to_json_flat(inxml, intagname, infields=fields, inmaxlevel=inmaxlevel, inuseattrs=inuseattrs,
-                                   inskipfirsttag=inskipfirsttag)
-
-            # Если тег не нашелся, возвращаем NULL
-            if not res:
-                return None
-
-            res = json.dumps(res, ensure_ascii=False, sort_keys=True)
-            #plpy.info(res)
-
-            return res
-            # --- END BODY FUNCTION --- #
-        # $BODY$
-        # LANGUAGE plpython3u VOLATILE
-        # COST 100;
-        
+        # Функции из xml_to_json_flat.sql выполняются так же, как в PL/Python (см. load_sql_functions)
+        functions = load_sql_functions(SQL_FILE)
+        sql_function = functions['xml_to_json_flat']
+
         # Проверка нахождения tag2
         res_json = sql_function(self.xml, 'tag2')
         self.assertIsNotNone(res_json)
@@ -332,6 +980,36 @@ class TestXmlToJsonFlat(unittest.TestCase):
             self.assertEqual(obj[0]['item1'], '1')
             self.assertEqual(obj[1]['item2'], '22')
 
+        # Модули и план преобразования загружаются один раз на сессию
+        self.assertEqual(functions.init_calls, 1)
+        self.assertIsNone(sql_function(self.xml, 'notfound'))
+        self.assertIsNone(sql_function(None, 'tag2'))
+
+        # По одной строке jsonb на запись
+        rows = [json.loads(row) for row in functions['xml_to_json_flat_rows'](self.xml, 'tag1/tag2')]
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1]['tag1_tag2_itemlist_Элемент4'], '44')
+        self.assertNotIn('tag1_tag2_item3', rows[1])
+
+        # Таблица с колонками из infields
+        rows = list(functions['xml_to_json_flat_table'](self.xml, 'tag2',
+                                                        '["tag2_item1", "tag2_item3_attr_prop2", "tag2_item"]'))
+        self.assertEqual([list(row) for row in rows],
+                         [['1', 'Property2', None], ['11', None, None], [None, None, 'tag2 in tag2']])
+        self.assertEqual(functions.init_calls, 1)
+
+        # Ограничения глубины, кол-ва полей и длины XML - отдельная перегрузка со всеми параметрами,
+        # вызовы с 2-6 параметрами работают без ограничений
+        deep = '<tag2>' + '<d>' * 300 + '1' + '</d>' * 300 + '</tag2>'
+        self.assertIsNotNone(sql_function(deep, 'tag2'))
+        self.assertRaises(functions.Error, sql_function, deep, 'tag2', '[]', 0, True, False, 256, 0, 0)
+        self.assertRaises(functions.Error, sql_function, self.xml, 'tag2', '[]', 0, True, False, 2, 0, 0)
+        self.assertIsNotNone(sql_function(self.xml, 'tag2', '[]', 0, True, False, 3, 0, 0))
+        self.assertRaises(functions.Error, sql_function, self.xml, 'tag2', '[]', 0, True, False, 0, 3, 0)
+        rows = functions['xml_to_json_flat_rows'](self.xml, 'tag2', '[]', 0, True, False, 0, 0, 100)
+        self.assertRaises(functions.Error, list, rows)
+        self.assertEqual(sql_function(self.xml, 'tag2', '[]', 0, True, False, 0, 0, 0), sql_function(self.xml, 'tag2'))
+        self.assertRaises(TypeError, sql_function, self.xml, 'tag2', '[]', 0, True, False, 256)
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,21 +1,368 @@
-from json import encoder
+import argparse
+import asyncio
+import collections
+import collections.abc
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import csv
+import functools
+import glob
+import hashlib
+import io
+import itertools
+import mmap
 import os
-from pprint import pprint
+import pathlib
+import pickle
+import re
+import sys
+import threading
+import time
+import tracemalloc
 
 import json
-from typing import Optional
-#import xml.etree.ElementTree as ET
+import xml.etree.ElementTree as ET
 from bs4 import BeautifulSoup
-from bs4.element import ResultSet
+from bs4.element import Tag
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
-def _xmlobj_to_jsonobj_flat(inxmlobj, inpreffix='', infields=[], inmaxlevel=0, inuseattrs=True, inskipfirsttag=False):
+def _etree_localname(intag):
+    """
+    Имя тега без пространства имен: '{http://ns}tag' -> 'tag' (как tag.name в BeautifulSoup)
+    :param intag: Имя тега ElementTree
+    :type intag: str
+    :rtype: str
+    """
+    if intag[:1] == '{':
+        return intag.rpartition('}')[2]
+    return intag
+
+
+def _etree_normalize(inelem, innsprefixes, innsdecl):
+    """
+    Приведение имени и атрибутов элемента ElementTree к виду BeautifulSoup:
+    имя без пространства имен, атрибуты вида 'prefix:attr', объявления xmlns в атрибутах
+    :param inelem: Элемент ElementTree
+    :param innsprefixes: Словарь uri -> префикс пространства имен
+    :param innsdecl: Список объявлений пространств имен (prefix, uri) на этом элементе
+    :type innsprefixes: dict
+    :type innsdecl: list
+    """
+    inelem.tag = _etree_localname(inelem.tag)
+    if innsdecl or inelem.attrib:
+        attrs = {}
+        for prefix, uri in innsdecl:
+            attrs['xmlns:' + prefix if prefix else 'xmlns'] = uri
+        for attr, value in inelem.attrib.items():
+            if attr[:1] == '{':
+                uri, _, attr = attr[1:].partition('}')
+                if innsprefixes.get(uri):
+                    attr = innsprefixes[uri] + ':' + attr
+            attrs[attr] = value
+        inelem.attrib = attrs
+
+
+
+_READ_SIZE = 1 << 20  # Размер части при чтении XML из файла или памяти
+
+
+def _iter_xml_chunks(inxml, insize=_READ_SIZE):
+    """
+    XML по частям без создания полной копии: путь (pathlib.Path), бинарный файловый объект,
+    mmap, memoryview, bytes. Текст (str) и bytes отдаются целиком
+    :param inxml: XML
+    :param insize: Размер части в байтах
+    :type inxml: str|bytes|os.PathLike|mmap.mmap|memoryview|file
+    :rtype: generator
+    """
+    if isinstance(inxml, (str, bytes)):
+        yield inxml
+    elif isinstance(inxml, os.PathLike):
+        with open(inxml, 'rb') as f:
+            for chunk in iter(functools.partial(f.read, insize), b''):
+                yield chunk
+    elif hasattr(inxml, 'read') and not isinstance(inxml, mmap.mmap):
+        for chunk in iter(functools.partial(inxml.read, insize), b''):
+            yield chunk
+    else:
+        with memoryview(inxml) as view:
+            for pos in range(0, len(view), insize):
+                yield view[pos:pos + insize].tobytes()
+
+
+def _read_xml(inxml):
+    """
+    XML целиком в виде str или bytes (для парсеров, которые не умеют читать по частям)
+    :type inxml: str|bytes|os.PathLike|mmap.mmap|memoryview|file
+    :rtype: str|bytes
+    """
+    if isinstance(inxml, (str, bytes)):
+        return inxml
+    return b''.join(_iter_xml_chunks(inxml))
+
+
+class _BufferReader(object):
+    """
+    Файловый объект для чтения из memoryview/mmap без копирования всего буфера (для iterparse)
+    """
+
+    def __init__(self, inbuffer):
+        self._view = memoryview(inbuffer)
+        self._pos = 0
+
+    def read(self, size=-1):
+        start = self._pos
+        end = len(self._view) if size is None or size < 0 else min(len(self._view), start + size)
+        self._pos = end
+        return self._view[start:end].tobytes()
+
+    def close(self):
+        self._view.release()
+
+
+class _DocumentNode(object):
+    """
+    Узел документа для ElementTree/lxml: родитель тега верхнего уровня (аналог [document] в BeautifulSoup)
+    """
+    tag = '[document]'
+
+    def getparent(self):
+        return None
+
+
+_DOCUMENT = _DocumentNode()
+
+
+class _BS4Parser(object):
+    """
+    Разбор XML через BeautifulSoup. Используется по умолчанию
+    """
+    kind = 'bs4'  # Имя парсера в PARSERS (name - метод: имя тега)
+
+    def parse(self, inxml):
+        # BeautifulSoup разбирает только документ целиком
+        return BeautifulSoup(_read_xml(inxml), 'xml')
+
+    def roots(self, indoc):
+        return [item for item in indoc.contents if isinstance(item, Tag)]
+
+    def find_all(self, indoc, intagname):
+        # intagname None - все теги
+        return indoc.find_all(intagname if intagname is not None else True)
+
+    def select(self, indoc, inselector):
+        return _select(indoc, inselector, self)
+
+    def children(self, innode):
+        return innode.find_all(recursive=False)
+
+    def name(self, innode):
+        return innode.name
+
+    def attrs(self, innode):
+        return innode.attrs
+
+    def text(self, innode):
+        return innode.text
+
+    def parent(self, innode):
+        return innode.parent
+
+
+class _EtreeParser(object):
+    """
+    Разбор XML через стандартный xml.etree.ElementTree.
+    Имена тегов и атрибутов приводятся к виду BeautifulSoup (см. _etree_normalize).
+    Родители (parent) известны только для последнего разобранного документа: при повторном использовании
+    экземпляра предыдущие документы не удерживаются в памяти
+    """
+    kind = 'etree'
+
+    def __init__(self):
+        self._parents = {}  # Тег -> родительский тег
+
+    def parse(self, inxml):
+        self._parents = parents = {}
+        parser = ET.XMLPullParser(events=('start-ns', 'start', 'end'))
+        root = None
+        stack = [_DOCUMENT]
+        nsprefixes = {}
+        nsdecl = []
+        chunks = _iter_xml_chunks(inxml)
+        while parser is not None:
+            chunk = next(chunks, None)
+            if chunk is None:
+                parser.close()
+            else:
+                parser.feed(chunk)
+            for event, elem in parser.read_events():
+                if event == 'start-ns':
+                    nsprefixes[elem[1]] = elem[0]
+                    nsdecl.append(elem)
+                elif event == 'start':
+                    _etree_normalize(elem, nsprefixes, nsdecl)
+                    nsdecl = []
+                    parents[elem] = stack[-1]
+                    stack.append(elem)
+                    if root is None:
+                        root = elem
+                else:
+                    stack.pop()
+            if chunk is None:
+                parser = None
+        return root
+
+    def roots(self, indoc):
+        return [indoc]
+
+    def find_all(self, indoc, intagname):
+        return list(indoc.iter(intagname))
+
+    def select(self, indoc, inselector):
+        return _select(indoc, inselector, self)
+
+    def children(self, innode):
+        return list(innode)
+
+    def name(self, innode):
+        return innode.tag
+
+    def attrs(self, innode):
+        return innode.attrib
+
+    def text(self, innode):
+        return innode.text or ''
+
+    def parent(self, innode):
+        return self._parents.get(innode)
+
+
+class _LxmlParser(object):
+    """
+    Разбор XML через lxml.etree. Имена тегов и атрибутов приводятся к виду BeautifulSoup
+    """
+    kind = 'lxml'
+
+    def __init__(self):
+        if lxml_etree is None:
+            raise ImportError('Для parser="lxml" необходимо установить lxml: pip install lxml')
+        self._usens = False
+
+    def parse(self, inxml):
+        if isinstance(inxml, str):
+            # lxml не принимает str с объявлением кодировки
+            parser = lxml_etree.XMLParser(encoding='utf-8', huge_tree=True)
+            root = lxml_etree.fromstring(inxml.encode('utf-8'), parser)
+        elif isinstance(inxml, bytes):
+            root = lxml_etree.fromstring(inxml, lxml_etree.XMLParser(huge_tree=True))
+        elif isinstance(inxml, os.PathLike):
+            # Файл читает сам libxml2, кодировка берется из объявления XML
+            root = lxml_etree.parse(os.fspath(inxml), lxml_etree.XMLParser(huge_tree=True)).getroot()
+        else:
+            parser = lxml_etree.XMLParser(huge_tree=True)
+            for chunk in _iter_xml_chunks(inxml):
+                parser.feed(chunk)
+            root = parser.close()
+        # Пространства имен разбираются только если они объявлены в документе
+        self._usens = root.xpath('boolean(//namespace::*[name() != "xml"])')
+        return root
+
+    def roots(self, indoc):
+        return [indoc]
+
+    def find_all(self, indoc, intagname):
+        if intagname is None:
+            return list(indoc.iter(lxml_etree.Element))
+        return list(indoc.iter('{*}' + intagname))
+
+    def select(self, indoc, inselector):
+        xpath = inselector.xpath(self._usens)
+        if xpath is None:
+            return _select(indoc, inselector, self)
+        nodes = xpath[0](indoc, **xpath[1])
+        if inselector.simple:
+            return [(node, inselector.preffix) for node in nodes]
+        match, parent, name, attrs = inselector.match, self.parent, self.name, self.attrs
+        return [(node, match(node, parent, name, attrs)) for node in nodes]
+
+    def children(self, innode):
+        return list(innode.iterchildren('*'))
+
+    def name(self, innode):
+        return _etree_localname(innode.tag)
+
+    def attrs(self, innode):
+        if not self._usens:
+            return innode.attrib
+        attrs = {}
+        nsmap = innode.nsmap
+        parent = innode.getparent()
+        parentnsmap = parent.nsmap if parent is not None else {}
+        for prefix, uri in nsmap.items():
+            if parentnsmap.get(prefix) != uri:
+                attrs['xmlns:' + prefix if prefix else 'xmlns'] = uri
+        if innode.attrib:
+            nsprefixes = {uri: prefix for prefix, uri in nsmap.items()}
+            for attr, value in innode.attrib.items():
+                if attr[:1] == '{':
+                    uri, _, attr = attr[1:].partition('}')
+                    if nsprefixes.get(uri):
+                        attr = nsprefixes[uri] + ':' + attr
+                attrs[attr] = value
+        return attrs
+
+    def text(self, innode):
+        if len(innode):
+            # Лист может содержать комментарии, текст после них хранится в tail
+            return (innode.text or '') + ''.join(item.tail or '' for item in innode)
+        return innode.text or ''
+
+    def parent(self, innode):
+        parent = innode.getparent()
+        if parent is None and innode is not _DOCUMENT:
+            return _DOCUMENT
+        return parent
+
+
+PARSERS = {
+    'bs4': _BS4Parser,
+    'etree': _EtreeParser,
+    'lxml': _LxmlParser,
+}
+
+
+def _get_parser(inparser):
+    """
+    Получение экземпляра парсера по имени
+    :param inparser: Имя парсера из PARSERS или экземпляр парсера
+    :type inparser: str
+    :rtype: _BS4Parser|_EtreeParser|_LxmlParser
+    """
+    if inparser is None:
+        inparser = 'bs4'
+    if not isinstance(inparser, str):
+        return inparser
+    if inparser not in PARSERS:
+        raise ValueError('Неизвестный парсер: {}. Доступны: {}'.format(inparser, ', '.join(sorted(PARSERS))))
+    return PARSERS[inparser]()
+
+
+def _xmlobj_to_jsonobj_flat(inxmlobj, inpreffix='', infields=[], inmaxlevel=0, inuseattrs=True, inskipfirsttag=False,
+                            inparser=None):
     """
     Получение одной плоской записи из тега
     Пример XML: <parent1><parent2><item1>123</item1></parent2><parent21>456</parent21></parent1>
     Результат при передаче тега parent1: {"parent1_parent2_item1": "123", "parent1_parent21": "456"}
     :param inxmlobj: XML-тег
-    :type inxmlobj: bs4.element.Tag
+    :type inxmlobj: bs4.element.Tag|xml.etree.ElementTree.Element|lxml.etree._Element
     :param inpreffix: Строка префикса для json поля
     :type inpreffix: str
     :param infields: Список наименований полей которые должны быть в результате. Пустой список - все поля
@@ -26,33 +373,16 @@ def _xmlobj_to_jsonobj_flat(inxmlobj, inpreffix='', infields=[], inmaxlevel=0, i
     :type inuseattrs: bool
     :param inskipfirsttag: Убрать из начала ключа словаря имя искомого тега
     :type inskipfirsttag: bool
+    :param inparser: Парсер, которым получен inxmlobj. None - BeautifulSoup
+    :type inparser: _BS4Parser|_EtreeParser|_LxmlParser
     :return: Плоский словарь с полями из имен тегов через _
     :rtype: dict
     """
-    # Получаем json из одного тега в плоском виде
-    data = {}
-    def get_json_rec(inxmlobj, inpreffix, level):
-        if inxmlobj.findChildren(recursive=False):
-            if inmaxlevel == 0 or inmaxlevel >= level:
-                for item in inxmlobj.findChildren(recursive=False):
-                    get_json_rec(item, inpreffix + '_'+item.name, level+1)
-        else:
-            if inpreffix not in data:  # Добавлять только если данных нет
-                if not infields or inpreffix in infields:  # Добавлять только если поле есть в infields
-                    key = inpreffix.lstrip(' _')
-                    data[key] = inxmlobj.text
-        if inuseattrs and inxmlobj.attrs:
-            for attr in inxmlobj.attrs:
-                key = '{}_attr_{}'.format(inpreffix, attr).lstrip(' _')
-                data[key] = inxmlobj.attrs[attr]
-    if inskipfirsttag:
-        get_json_rec(inxmlobj, '', 1)
-    else:
-        get_json_rec(inxmlobj, inpreffix + inxmlobj.name, 1)
-    return data
+    flattener = Flattener('', infields=infields, inmaxlevel=inmaxlevel, inuseattrs=inuseattrs,
+                          inskipfirsttag=inskipfirsttag)
+    return flattener.flatten(inxmlobj, _get_parser(inparser), inpreffix)
 
-
-def _check_parent(inxmlobj, inparenttags):
+def _check_parent(inxmlobj, inparenttags, inparser=None):
     """
     Проверка что тег inxmlobj вложен в родительские теги inparenttags
     Пример XML: <parent1><parent2><item1>123</item1></parent2><parent21>456</parent21></parent1>
@@ -61,6 +391,8 @@ def _check_parent(inxmlobj, inparenttags):
     :type inxmlobj: bs4.element.Tag
     :param inparenttags: Родительские теги в виде списка или текста разделенного слэшами /
     :type inparenttags: str|list
+    :param inparser: Парсер, которым получен inxmlobj. None - BeautifulSoup
+    :type inparser: _BS4Parser|_EtreeParser|_LxmlParser
     :return: Тег inxmlobj вложен в родительские теги inparenttags
     :rtype: bool
     """
@@ -70,16 +402,18 @@ def _check_parent(inxmlobj, inparenttags):
             inparenttags = inparenttags.split('/') # Приводим inparenttags к списку, если передана строка
         else:
             inparenttags = []
-    parenttag = inxmlobj.parent
+    parser = _get_parser(inparser)
+    parenttag = parser.parent(inxmlobj)
     for parenttagname in inparenttags[::-1]:
-        if parenttag and parenttag.name == parenttagname:
-            parenttag = parenttag.parent
+        if parenttag is not None and parser.name(parenttag) == parenttagname:
+            parenttag = parser.parent(parenttag)
         else:
             return False
     return True
 
 
-def _get_records(xml_item_list, inparenttags=[], infields=[], inmaxlevel=0, inuseattrs=True, inskipfirsttag=False):
+def _get_records(xml_item_list, inparenttags=[], infields=[], inmaxlevel=0, inuseattrs=True, inskipfirsttag=False,
+                 inparser=None):
     """
     Получение записей c проверкой на соответствие переданным родительским тегам
     :param xml_item_list: Список XML-объектов, которые необходимо преобразовать в JSON
@@ -88,6 +422,7 @@ def _get_records(xml_item_list, inparenttags=[], infields=[], inmaxlevel=0, inus
     :param inmaxlevel: Максимальный уровень погружения. 0 - без ограничений
     :param inuseattrs: Добавлять данные из атрибутов
     :param inskipfirsttag: Убрать из начала ключа словаря имя искомого тега
+    :param inparser: Парсер, которым получены XML-объекты. None - BeautifulSoup
     :return: Список плоских словарей с данными
     :type xml_item_list: list
     :type inparenttags: list
@@ -95,18 +430,21 @@ def _get_records(xml_item_list, inparenttags=[], infields=[], inmaxlevel=0, inus
     :type inmaxlevel: int
     :type inuseattrs: bool
     :type inskipfirsttag: bool
+    :type inparser: _BS4Parser|_EtreeParser|_LxmlParser
     :rtype: list
     """
+    parser = _get_parser(inparser)
+    # План преобразования создается один раз на все записи (см. _xmlobj_to_jsonobj_flat)
+    flattener = Flattener('', infields=infields, inmaxlevel=inmaxlevel, inuseattrs=inuseattrs,
+                          inskipfirsttag=inskipfirsttag)
+    preffix = ''
+    if inparenttags:
+        preffix = '_'.join(inparenttags) + '_'
     res = []
     for item in xml_item_list:
         # Проверяем соответствуют ли родительские теги переданным
-        if _check_parent(item, inparenttags):
-            preffix = ''
-            if inparenttags:
-                preffix = '_'.join(inparenttags) + '_'
-            rec = _xmlobj_to_jsonobj_flat(item, preffix, infields=infields, inmaxlevel=inmaxlevel,
-                                          inuseattrs=inuseattrs, inskipfirsttag=inskipfirsttag)
-            res.append(rec)
+        if _check_parent(item, inparenttags, inparser=parser):
+            res.append(flattener.flatten(item, parser, preffix))
     return res
 
 
@@ -120,9 +458,9 @@ def _json_fields_sync(inlist):
     """
 
     res = []
-    fields = set()
+    fields = {}  # Порядок колонок - порядок первого появления
     for rec in inlist:
-        fields.update(rec.keys())
+        fields.update(dict.fromkeys(rec))
     for rec in inlist:
         new_rec = {}
         for fieldname in fields:
@@ -134,64 +472,2777 @@ def _json_fields_sync(inlist):
     return res
 
 
-def xml_to_json_flat(inxml, intagname, infields=[], inmaxlevel=0, inuseattrs=True, inskipfirsttag=False):
+class Columns(object):
+    """
+    Результат в виде колонок: упорядоченный список полей и по одному списку значений на поле.
+    Отсутствующие значения заполняются None без создания словаря на каждую строку
+    Пример:
+        res = xml_to_json_flat(xml, 'tag2', output='columns')
+        res.fields  # ['tag2_item1', 'tag2_item2', ...]
+        res['tag2_item1']  # ['1', '11']
+    """
+
+    def __init__(self):
+        self.fields = []  # Порядок колонок - порядок первого появления
+        self.columns = {}  # Имя поля -> список значений
+        self._count = 0
+
+    @classmethod
+    def from_records(cls, inrecords):
+        """
+        Построение колонок из плоских записей. Записи могут поступать генератором, в памяти они не накапливаются
+        :param inrecords: Итерируемый объект плоских словарей
+        :rtype: Columns
+        """
+        res = cls()
+        for rec in inrecords:
+            res.append(rec)
+        return res
+
+    def append(self, inrec):
+        """
+        Добавление одной записи
+        :param inrec: Плоский словарь
+        :type inrec: dict
+        """
+        columns = self.columns
+        count = self._count
+        for fieldname in inrec:
+            column = columns.get(fieldname)
+            if column is None:
+                column = columns[fieldname] = [None] * count
+                self.fields.append(fieldname)
+            elif len(column) < count:
+                column.extend([None] * (count - len(column)))
+            column.append(inrec[fieldname])
+        self._count = count + 1
+
+    def _fill(self):
+        # Дополнение колонок, в которых не было значений в последних записях
+        count = self._count
+        for column in self.columns.values():
+            if len(column) < count:
+                column.extend([None] * (count - len(column)))
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, infieldname):
+        self._fill()
+        return self.columns[infieldname]
+
+    def rows(self):
+        """
+        Строки в виде кортежей значений в порядке self.fields
+        :rtype: generator
+        """
+        if not self.fields:
+            return iter([()] * self._count)  # zip() без колонок не дает ни одной строки
+        self._fill()
+        return zip(*[self.columns[fieldname] for fieldname in self.fields])
+
+    def to_records(self):
+        """
+        Преобразование в список словарей (как результат xml_to_json_flat)
+        :rtype: list
+        """
+        fields = self.fields
+        return [dict(zip(fields, row)) for row in self.rows()]
+
+    def to_dict(self):
+        """
+        Словарь колонок {имя поля: список значений}
+        :rtype: dict
+        """
+        self._fill()
+        return {fieldname: self.columns[fieldname] for fieldname in self.fields}
+
+    def to_pandas(self):
+        """
+        Преобразование в pandas.DataFrame (необходим pandas)
+        :rtype: pandas.DataFrame
+        """
+        import pandas
+        return pandas.DataFrame(self.to_dict(), columns=self.fields)
+
+    def to_arrow(self):
+        """
+        Преобразование в pyarrow.Table (необходим pyarrow)
+        :rtype: pyarrow.Table
+        """
+        import pyarrow
+        self._fill()
+        return pyarrow.table([pyarrow.array(self.columns[fieldname], type=pyarrow.string())
+                              for fieldname in self.fields], names=self.fields)
+
+
+class RowSchema(object):
+    """
+    Общий для всех строк результата список полей (см. Row). Поля только добавляются: строки, созданные до
+    появления поля, возвращают по нему None
+    """
+    __slots__ = ('fields', 'index')
+
+    def __init__(self, infields=()):
+        self.fields = []  # Порядок колонок - порядок первого появления
+        self.index = {}  # Имя поля -> позиция значения в Row.values
+        for fieldname in infields:
+            self.add(fieldname)
+
+    def add(self, infieldname):
+        """
+        Добавление поля, если его еще нет
+        :type infieldname: str
+        """
+        if infieldname not in self.index:
+            self.index[infieldname] = len(self.fields)
+            self.fields.append(infieldname)
+
+    def __len__(self):
+        return len(self.fields)
+
+
+class Row(collections.abc.Mapping):
+    """
+    Плоская запись без собственного словаря: ключи хранятся один раз в общей RowSchema, значения - в кортеже.
+    Поддерживает интерфейс словаря только для чтения (row['tag2_item1'], keys(), items(), get(), сравнение
+    со словарем). json и orjson сериализуют Row через default=dict
+    Пример:
+        res = xml_to_json_flat(xml, 'tag2', output='rows')
+        res[0]['tag2_item1']  # '1'
+        json.dumps(res, default=dict)
+    """
+    __slots__ = ('schema', 'values')
+
+    def __init__(self, schema, values):
+        """
+        :param schema: Список полей
+        :param values: Значения в порядке schema.fields. Недостающие в конце значения считаются None
+        :type schema: RowSchema
+        :type values: tuple
+        """
+        self.schema = schema
+        self.values = values
+
+    def __getitem__(self, infieldname):
+        pos = self.schema.index[infieldname]
+        values = self.values
+        return values[pos] if pos < len(values) else None
+
+    def __iter__(self):
+        return iter(self.schema.fields)
+
+    def __len__(self):
+        return len(self.schema.fields)
+
+    def __repr__(self):
+        return 'Row({!r})'.format(dict(self))
+
+    def to_dict(self):
+        """
+        Преобразование в обычный словарь
+        :rtype: dict
+        """
+        fields = self.schema.fields
+        values = self.values
+        res = dict(zip(fields, values))
+        if len(values) < len(fields):
+            res.update(dict.fromkeys(fields[len(values):]))
+        return res
+
+
+def _rows(inrecords):
+    """
+    Построение строк Row с общей схемой из плоских записей (аналог _json_fields_sync без словаря на строку).
+    Записи могут поступать генератором
+    :param inrecords: Итерируемый объект плоских словарей
+    :return: Список Row
+    :rtype: list
+    """
+    schema = RowSchema()
+    fields = schema.fields
+    index = schema.index
+    res = []
+    for rec in inrecords:
+        for fieldname in rec:
+            if fieldname not in index:
+                index[fieldname] = len(fields)
+                fields.append(fieldname)
+        res.append(Row(schema, tuple(map(rec.get, fields))))
+    return res
+
+
+_INTERN_MAXLEN = 64  # Значения длиннее не интернируются (повторяются редко)
+
+
+def _intern_records(inrecords, intable=None):
+    """
+    Замена одинаковых строковых значений в записях одним объектом строки (коды статусов, признаки и т.п.).
+    Таблица значений живет, пока обрабатываются записи, и не переживает результат
+    :param inrecords: Итерируемый объект плоских словарей
+    :param intable: Таблица значений (словарь значение -> значение). None - новая таблица
+    :rtype: generator
+    """
+    table = {} if intable is None else intable
+    setdefault = table.setdefault
+    for rec in inrecords:
+        for fieldname, value in rec.items():
+            if value.__class__ is str and len(value) <= _INTERN_MAXLEN:
+                rec[fieldname] = setdefault(value, value)
+        yield rec
+
+
+_OUTPUTS = ('records', 'columns', 'rows')
+
+
+def _output_result(inrecords, output='records', intern=False):
+    """
+    Результат нужного вида из потока плоских записей
+    :param inrecords: Итерируемый объект плоских словарей
+    :param output: 'records' - список словарей, 'columns' - Columns, 'rows' - список Row с общей схемой
+    :param intern: Заменять одинаковые строковые значения одним объектом строки
+    :rtype: list|Columns
+    """
+    if intern:
+        inrecords = _intern_records(inrecords)
+    if output == 'columns':
+        return Columns.from_records(inrecords)
+    if output == 'rows':
+        return _rows(inrecords)
+    return _json_fields_sync(list(inrecords))
+
+
+def _check_output(output):
+    if output not in _OUTPUTS:
+        raise ValueError('Неизвестный вид результата: {}. Доступны: {}'.format(output, ', '.join(_OUTPUTS)))
+
+
+_SELECTOR_STEP_RE = re.compile(r'([^/\[\]]+)((?:\[[^\]]*\])*)')
+_SELECTOR_PREDICATE_RE = re.compile(r'\[\s*@([^\s=\]]+)\s*(?:=\s*(?:"([^"]*)"|\'([^\']*)\'))?\s*\]')
+_XPATH_NAME_RE = re.compile(r'[^\W\d][\w.-]*')
+
+
+class _SelectorStep(object):
+    """
+    Шаг селектора: имя тега (None - любой тег), условия на атрибуты и признак '//' перед шагом
+    """
+    __slots__ = ('name', 'predicates', 'descendant')
+
+    def __init__(self, inname, inpredicates, indescendant):
+        self.name = inname
+        self.predicates = inpredicates  # Список (атрибут, значение). Значение None - атрибут есть
+        self.descendant = indescendant  # Между предыдущим шагом и этим может быть сколько угодно тегов
+
+    def check(self, inattrs):
+        for attr, value in self.predicates:
+            if attr not in inattrs or (value is not None and inattrs[attr] != value):
+                return False
+        return True
+
+
+class _Selector(object):
+    """
+    Скомпилированный селектор тегов intagname. Разбирается один раз при создании Flattener.
+    Синтаксис: шаги через /, как в пути tag1/tag2:
+        * - любой тег,
+        // - любое кол-во промежуточных тегов (tag1//tag3),
+        [@attr] и [@attr="значение"] - условия на атрибуты (tag2[@type="a"]),
+        / в начале - путь от тега верхнего уровня (/tag1/tag2), без него путь может начинаться на любом уровне.
+    Тег проверяется с конца пути: сначала имя и атрибуты самого тега, затем родители, поэтому теги с тем же
+    именем в других родителях отбрасываются на первом несовпадении. Для lxml селектор выполняется как XPath
+    """
+
+    def __init__(self, inselector):
+        """
+        :param inselector: Селектор
+        :type inselector: str
+        """
+        self.selector = inselector
+        self.anchored = inselector.startswith('/') and not inselector.startswith('//')
+        # [document]/tag1 - как в _check_parent: путь от тега верхнего уровня, [document] входит в префикс ключей
+        self.document = inselector.startswith('[document]/')
+        self.steps = []
+        pos = 1 if self.anchored else 2 if inselector.startswith('//') else 0
+        if self.document:
+            self.anchored = True
+            pos = len('[document]/')
+        descendant = False
+        while True:
+            match = _SELECTOR_STEP_RE.match(inselector, pos)
+            name = match.group(1).strip() if match else ''
+            if not name:
+                raise ValueError('Некорректный селектор: {} (позиция {})'.format(inselector, pos))
+            predicates = []
+            for predicate in re.findall(r'\[[^\]]*\]', match.group(2)):
+                predicatematch = _SELECTOR_PREDICATE_RE.fullmatch(predicate)
+                if predicatematch is None:
+                    raise ValueError('Некорректное условие {} в селекторе {}'.format(predicate, inselector))
+                attr, value1, value2 = predicatematch.groups()
+                predicates.append((attr, value1 if value1 is not None else value2))
+            self.steps.append(_SelectorStep(None if name == '*' else name, predicates, descendant))
+            pos = match.end()
+            if pos == len(inselector):
+                break
+            descendant = inselector.startswith('//', pos)
+            pos += 2 if descendant else 1
+        # Простой путь tag1/tag2 без условий - проверяется как раньше (_check_parent, _check_path)
+        self.simple = (not self.anchored or self.document) and all(
+            step.name is not None and not step.predicates and not step.descendant for step in self.steps)
+        self.tagname = self.steps[-1].name
+        self.parenttags = ['[document]'] * self.document + [step.name or '*' for step in self.steps[:-1]]
+        self.preffix = '_'.join(self.parenttags) + '_' if self.parenttags else ''
+        self._xpath = {}
+
+    def match(self, innode, inparent, inname, inattrs):
+        """
+        Проверка тега. Доступ к дереву через функции, поэтому подходит и для любого парсера,
+        и для стека открытых тегов при потоковой обработке
+        :param innode: Тег
+        :param inparent: Функция получения родителя (None или '[document]' - документ)
+        :param inname: Функция получения имени тега
+        :param inattrs: Функция получения атрибутов тега
+        :return: Префикс ключей записи из имен тегов, совпавших с шагами селектора. None - тег не подходит
+        :rtype: str
+        """
+        names = self._match(len(self.steps) - 1, innode, inparent, inname, inattrs)
+        if names is None:
+            return None
+        return '[document]_' * self.document + ''.join(name + '_' for name in names[:-1])
+
+    def _match(self, instep, innode, inparent, inname, inattrs):
+        """
+        Совпадение шагов с первого по instep, последний из них - тег innode
+        :return: Имена совпавших тегов от верхнего к innode. None - не совпадает
+        :rtype: list
+        """
+        steps = self.steps
+        names = []
+        node = innode
+        k = instep
+        while True:
+            step = steps[k]
+            name = inname(node)
+            if (step.name is not None and name != step.name) or (step.predicates and not step.check(inattrs(node))):
+                return None
+            names.append(name)
+            parent = inparent(node)
+            isdocument = parent is None or inname(parent) == '[document]'
+            if k == 0:
+                if self.anchored and not isdocument:
+                    return None
+                names.reverse()
+                return names
+            if isdocument:
+                return None
+            if step.descendant:
+                while not isdocument:
+                    parentnames = self._match(k - 1, parent, inparent, inname, inattrs)
+                    if parentnames is not None:
+                        names.reverse()
+                        return parentnames + names
+                    parent = inparent(parent)
+                    isdocument = parent is None or inname(parent) == '[document]'
+                return None
+            node = parent
+            k -= 1
+
+    def xpath(self, inusens):
+        """
+        Селектор в виде скомпилированного XPath lxml
+        :param inusens: В документе есть пространства имен - имена сверяются через local-name()
+        :return: (XPath, переменные XPath). None - селектор не выражается в XPath
+        :rtype: tuple
+        """
+        if inusens not in self._xpath:
+            parts = ['/' if self.anchored else 'descendant-or-self::']
+            variables = {}
+            for i, step in enumerate(self.steps):
+                if i:
+                    parts.append('//' if step.descendant else '/')
+                if step.name is None:
+                    parts.append('*')
+                elif not inusens and _XPATH_NAME_RE.fullmatch(step.name):
+                    parts.append(step.name)
+                else:
+                    parts.append('*[local-name()=$n{}]'.format(i))
+                    variables['n{}'.format(i)] = step.name
+                for j, (attr, value) in enumerate(step.predicates):
+                    if not _XPATH_NAME_RE.fullmatch(attr):
+                        self._xpath[inusens] = None  # Атрибуты с пространством имен проверяются через _match
+                        return None
+                    if value is None:
+                        parts.append('[@{}]'.format(attr))
+                    else:
+                        parts.append('[@{}=$v{}_{}]'.format(attr, i, j))
+                        variables['v{}_{}'.format(i, j)] = value
+            self._xpath[inusens] = (lxml_etree.XPath(''.join(parts)), variables)
+        return self._xpath[inusens]
+
+
+def _select(indoc, inselector, inparser):
+    """
+    Поиск тегов по селектору: теги с именем последнего шага, проверенные с конца пути
+    :param indoc: Документ, полученный inparser.parse
+    :param inselector: Селектор
+    :param inparser: Парсер
+    :return: Список (тег, префикс ключей)
+    :type inselector: _Selector
+    :rtype: list
+    """
+    match, parent, name, attrs = inselector.match, inparser.parent, inparser.name, inparser.attrs
+    res = []
+    if inselector.simple:
+        # Простой путь: сверка имен родителей без вызова _Selector.match для каждого тега
+        parenttags = inselector.parenttags[::-1]
+        preffix = inselector.preffix
+        for node in inparser.find_all(indoc, inselector.tagname):
+            parenttag = parent(node)
+            for parenttagname in parenttags:
+                if parenttag is None or name(parenttag) != parenttagname:
+                    break
+                parenttag = parent(parenttag)
+            else:
+                res.append((node, preffix))
+        return res
+    for node in inparser.find_all(indoc, inselector.tagname):
+        preffix = match(node, parent, name, attrs)
+        if preffix is not None:
+            res.append((node, preffix))
+    return res
+
+
+class _PathNode(object):
+    """
+    Узел плана преобразования: путь к тегу внутри записи с заранее вычисленными ключами
+    """
+    __slots__ = ('preffix', 'key', 'children', 'attrkeys', 'infields', 'usetext')
+
+    def __init__(self, inpreffix, infields, infieldpreffixes):
+        self.preffix = inpreffix  # Префикс в том виде, в котором он сверяется с infields
+        self.key = inpreffix.lstrip(' _')  # Ключ в результирующем словаре
+        self.children = {}  # Имя дочернего тега -> _PathNode
+        self.attrkeys = {}  # Имя атрибута -> ключ в результирующем словаре
+        self.infields = not infields or inpreffix in infields  # Значение тега попадает в результат
+        self.usetext = not infields or inpreffix in infieldpreffixes  # В поддереве есть поля из infields
+
+
+# Обработка одинаковых соседних тегов (например нескольких <item> внутри одного <list>):
+REPEATED_MODES = {
+    'first': 'значение первого тега (как раньше)',
+    'index': 'номер в ключе: list_item_0, list_item_1 (только если тег повторяется)',
+    'join': 'значения всех тегов через separator в одном ключе',
+    'explode': 'по записи на каждый тег, остальные поля повторяются (при нескольких списках - все сочетания)',
+}
+
+
+def _indexed_names(innames):
+    """
+    Имена тегов с номером для повторяющихся: ['a', 'b', 'a'] -> ['a_0', 'b', 'a_1']
+    :type innames: list
+    :rtype: list
+    """
+    counts = {}
+    for itemname in innames:
+        counts[itemname] = counts.get(itemname, 0) + 1
+    if len(counts) == len(innames):
+        return innames
+    seen = {}
+    res = []
+    for itemname in innames:
+        if counts[itemname] > 1:
+            index = seen.get(itemname, 0)
+            seen[itemname] = index + 1
+            itemname = '{}_{}'.format(itemname, index)
+        res.append(itemname)
+    return res
+
+
+def _expand(intemplate):
+    """
+    Записи из шаблона repeated='explode': все сочетания вариантов групп, по одной записи за раз
+    :param intemplate: (поля, группы): группа - список вариантов повторяющегося тега, вариант - такой же шаблон
+    :rtype: generator
+    """
+    data, groups = intemplate
+
+    def combine(ingroup, inrec):
+        if ingroup == len(groups):
+            yield inrec
+            return
+        for variant in groups[ingroup]:
+            for variantrec in _expand(variant):
+                rec = dict(inrec)
+                rec.update(variantrec)
+                yield from combine(ingroup + 1, rec)
+
+    return combine(0, data)
+
+
+class Limits(object):
+    """
+    Ограничения для документов с произвольным содержимым (см. xml_to_json_flat_bounded). 0 - без ограничения
+    Пример:
+        limits = Limits(maxdepth=100, maxrecordsize=16 << 20, maxfields=10000, maxmemory=256 << 20)
+    """
+
+    def __init__(self, maxdepth=0, maxrecordsize=0, maxfields=0, maxmemory=0, spilldir=None):
+        """
+        :param maxdepth: Максимальная глубина записи (1 - тег записи без вложенных тегов)
+        :param maxrecordsize: Максимальный размер тега записи в байтах. Большие записи не разбираются
+        :param maxfields: Максимальное кол-во полей в записи
+        :param maxmemory: Примерный размер записей в памяти в байтах, после которого они выгружаются
+            во временный файл
+        :param spilldir: Каталог для временных файлов. None - системный каталог временных файлов
+        :type maxdepth: int
+        :type maxrecordsize: int
+        :type maxfields: int
+        :type maxmemory: int
+        :type spilldir: str
+        """
+        self.maxdepth = maxdepth
+        self.maxrecordsize = maxrecordsize
+        self.maxfields = maxfields
+        self.maxmemory = maxmemory
+        self.spilldir = spilldir
+
+
+class LimitExceeded(ValueError):
+    """
+    Запись превышает ограничение Limits
+    """
+
+    def __init__(self, reason, message):
+        """
+        :param reason: Ограничение: 'depth', 'size' или 'fields'
+        :param message: Текст ошибки
+        """
+        super().__init__(message)
+        self.reason = reason
+
+
+class Flattener(object):
+    """
+    Скомпилированный план преобразования XML в плоские записи.
+    Разбор intagname/infields выполняется один раз при создании, ключи записей вычисляются один раз
+    для каждого пути и переиспользуются во всех записях и во всех вызовах convert.
+    Поддеревья, в которых не может быть полей из infields, не обходятся (если не нужны атрибуты -
+    атрибуты в infields не фильтруются)
+    Пример:
+        flattener = Flattener('tag1/tag2', infields=['tag1_tag2_item1'])
+        for xml in xml_list:
+            json_list = flattener.convert(xml)
+    """
+
+    def __init__(self, intagname, infields=[], inmaxlevel=0, inuseattrs=True, inskipfirsttag=False, parser='bs4',
+                 repeated='first', separator='; ', limits=None):
+        """
+        :param intagname: Наименование тега, путь к тегу tag1/tag2 или селектор (см. _Selector).
+            Пустое значение - тег верхнего уровня
+        :param infields: Список полей, которые должны быть выведены в результате. Пустой список - все поля
+        :param inmaxlevel: Максимальный уровень погружения. 0 - без ограничений
+        :param inuseattrs: Выводить аттрибуты или нет
+        :param inskipfirsttag: Убрать из начала ключа словаря имя искомого тега
+        :param parser: Парсер XML: 'bs4', 'lxml' или 'etree'
+        :param repeated: Обработка одинаковых соседних тегов (см. REPEATED_MODES)
+        :param separator: Разделитель значений для repeated='join'
+        :param limits: Ограничения глубины и кол-ва полей записи: при превышении flatten вызывает LimitExceeded
+        :type intagname: str
+        :type infields: list
+        :type inmaxlevel: int
+        :type inuseattrs: bool
+        :type inskipfirsttag: bool
+        :type parser: str
+        :type repeated: str
+        :type separator: str
+        :type limits: Limits
+        """
+        if repeated not in REPEATED_MODES:
+            raise ValueError('Неизвестный режим repeated: {}. Доступны: {}'.format(repeated, ', '.join(REPEATED_MODES)))
+        self.intagname = intagname
+        self.infields = list(infields)
+        self.inmaxlevel = inmaxlevel
+        self.inuseattrs = inuseattrs
+        self.inskipfirsttag = inskipfirsttag
+        self.parser = parser
+        self.repeated = repeated
+        self.separator = separator
+        self.limits = limits
+        self._maxdepth = limits.maxdepth if limits is not None else 0
+        self._maxfields = limits.maxfields if limits is not None else 0
+        if intagname:
+            self.selector = _Selector(intagname)
+            self.tagname = self.selector.tagname
+            self.parenttags = self.selector.parenttags
+        else:
+            self.selector = None
+            self.tagname = None
+            self.parenttags = []
+        self.preffix = '_'.join(self.parenttags) + '_' if self.parenttags else ''
+        self._fields = frozenset(infields)
+        # Все префиксы полей по границе '_': поддерево с таким префиксом может содержать поле из infields
+        fieldpreffixes = set(self._fields)
+        for field in self._fields:
+            pos = field.find('_')
+            while pos != -1:
+                fieldpreffixes.add(field[:pos])
+                pos = field.find('_', pos + 1)
+        self._fieldpreffixes = frozenset(fieldpreffixes)
+        self._roots = {}  # Префикс искомого тега -> _PathNode
+        # Без атрибутов в записи попадают только поля из infields: когда они все заполнены (первыми значениями),
+        # остаток записи не читается. 0 - запись читается целиком
+        self._stopfields = (len(self._fields) if self._fields and not inuseattrs and repeated == 'first' and
+                            not inskipfirsttag else 0)
+
+    def _path(self, inpreffix):
+        path = self._roots.get(inpreffix)
+        if path is None:
+            path = self._roots[inpreffix] = _PathNode(inpreffix, self._fields, self._fieldpreffixes)
+        return path
+
+    def _child_path(self, inpath, inname):
+        path = _PathNode(inpath.preffix + '_' + inname, self._fields, self._fieldpreffixes)
+        inpath.children[inname] = path
+        return path
+
+    def flatten(self, innode, inparser, inpreffix=None, invalues=True):
+        """
+        Получение одной плоской записи из тега (см. _xmlobj_to_jsonobj_flat)
+        :param innode: XML-тег
+        :param inparser: Парсер, которым получен innode
+        :param inpreffix: Строка префикса для json поля. None - родительские теги из intagname
+        :param invalues: Получать значения тегов. False - только ключи (значения тегов None)
+        :return: Плоский словарь с полями из имен тегов через _
+        :rtype: dict
+        """
+        if self.repeated == 'explode':
+            raise ValueError('Для repeated="explode" записи получаются через iter_flatten')
+        children, name, attrs, text = inparser.children, inparser.name, inparser.attrs, inparser.text
+        inmaxlevel = self.inmaxlevel
+        inuseattrs = self.inuseattrs
+        child_path = self._child_path
+        indexed = self.repeated == 'index'
+        join = self.repeated == 'join'
+        separator = self.separator
+        maxdepth = self._maxdepth
+        data = {}
+
+        if self.inskipfirsttag:
+            path = self._path('')
+        else:
+            if inpreffix is None:
+                inpreffix = self.preffix
+            path = self._path(inpreffix + name(innode))
+        # Первое значение поля не перезаписывается, только если префиксы совпадают с ключами (нет '_' в начале)
+        stopfields = self._stopfields if path.preffix == path.key else 0
+
+        # Обход без рекурсии (глубина XML не ограничена стеком Python): (тег, путь, уровень).
+        # Уровень 0 - атрибуты тега, они добавляются после его поддерева
+        stack = [(innode, path, 1)]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            innode, inpath, level = pop()
+            if level:
+                items = children(innode)
+                if items:
+                    if inmaxlevel == 0 or inmaxlevel >= level:
+                        if maxdepth and level >= maxdepth:
+                            raise LimitExceeded('depth', 'Глубина записи больше {}'.format(maxdepth))
+                        if inuseattrs:
+                            push((innode, inpath, 0))
+                        pathchildren = inpath.children
+                        if indexed and len(items) > 1:
+                            itemnames = _indexed_names([name(item) for item in items])
+                        else:
+                            itemnames = map(name, items)
+                        itemlevel = level + 1
+                        pending = []
+                        for item, itemname in zip(items, itemnames):
+                            itempath = pathchildren.get(itemname)
+                            if itempath is None:
+                                itempath = child_path(inpath, itemname)
+                            if itempath.usetext or inuseattrs:
+                                pending.append((item, itempath, itemlevel))
+                        pending.reverse()
+                        stack.extend(pending)
+                        continue
+                elif join:
+                    if inpath.infields:
+                        key = inpath.key
+                        if key in data and invalues:
+                            data[key] += separator + text(innode)
+                        else:
+                            data[key] = text(innode) if invalues else None
+                elif inpath.infields and inpath.preffix not in data:  # Добавлять только если данных нет
+                    data[inpath.key] = text(innode) if invalues else None
+                    if len(data) == stopfields:
+                        break
+            if inuseattrs:
+                itemattrs = attrs(innode)
+                if itemattrs:
+                    attrkeys = inpath.attrkeys
+                    for attr in itemattrs:
+                        key = attrkeys.get(attr)
+                        if key is None:
+                            key = attrkeys[attr] = '{}_attr_{}'.format(inpath.preffix, attr).lstrip(' _')
+                        if join and key in data and invalues:
+                            data[key] += separator + itemattrs[attr]
+                        else:
+                            data[key] = itemattrs[attr]
+        if self._maxfields and len(data) > self._maxfields:
+            raise LimitExceeded('fields', 'Полей в записи больше {}'.format(self._maxfields))
+        return data
+
+    def template(self, innode, inparser, inpreffix=None, invalues=True):
+        """
+        Шаблон записей тега для repeated='explode' (см. _expand): поля без повторов и группы повторяющихся тегов.
+        Дерево читается один раз, сочетания групп получаются при обходе _expand
+        :param innode: XML-тег
+        :param inparser: Парсер, которым получен innode
+        :param inpreffix: Строка префикса для json поля. None - родительские теги из intagname
+        :param invalues: Получать значения тегов. False - только ключи
+        :return: (поля, группы)
+        :rtype: tuple
+        """
+        children, name, attrs, text = inparser.children, inparser.name, inparser.attrs, inparser.text
+        inmaxlevel = self.inmaxlevel
+        inuseattrs = self.inuseattrs
+        child_path = self._child_path
+        maxdepth = self._maxdepth
+
+        res = ({}, [])
+        if self.inskipfirsttag:
+            path = self._path('')
+        else:
+            if inpreffix is None:
+                inpreffix = self.preffix
+            path = self._path(inpreffix + name(innode))
+
+        # Обход без рекурсии: (тег, путь, уровень, шаблон). Уровень 0 - атрибуты тега после его поддерева,
+        # -1 - добавление группы вариантов (тег - список вариантов) в шаблон после предшествующих тегов
+        stack = [(innode, path, 1, res)]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            innode, inpath, level, intemplate = pop()
+            data, groups = intemplate
+            if level < 0:
+                groups.append(innode)
+                continue
+            if level:
+                items = children(innode)
+                if items:
+                    if inmaxlevel == 0 or inmaxlevel >= level:
+                        if maxdepth and level >= maxdepth:
+                            raise LimitExceeded('depth', 'Глубина записи больше {}'.format(maxdepth))
+                        if inuseattrs:
+                            push((innode, inpath, 0, intemplate))
+                        pathchildren = inpath.children
+                        itemgroups = {}  # Имя тега -> теги с этим именем в порядке документа
+                        for item in items:
+                            itemgroups.setdefault(name(item), []).append(item)
+                        itemlevel = level + 1
+                        pending = []
+                        for itemname, group in itemgroups.items():
+                            itempath = pathchildren.get(itemname)
+                            if itempath is None:
+                                itempath = child_path(inpath, itemname)
+                            if not (itempath.usetext or inuseattrs):
+                                continue
+                            if len(group) == 1:
+                                pending.append((group[0], itempath, itemlevel, intemplate))
+                            else:
+                                variants = []
+                                for item in group:
+                                    variant = ({}, [])
+                                    pending.append((item, itempath, itemlevel, variant))
+                                    variants.append(variant)
+                                pending.append((variants, None, -1, intemplate))
+                        pending.reverse()
+                        stack.extend(pending)
+                        continue
+                elif inpath.infields and inpath.key not in data:
+                    data[inpath.key] = text(innode) if invalues else None
+            if inuseattrs:
+                itemattrs = attrs(innode)
+                if itemattrs:
+                    attrkeys = inpath.attrkeys
+                    for attr in itemattrs:
+                        key = attrkeys.get(attr)
+                        if key is None:
+                            key = attrkeys[attr] = '{}_attr_{}'.format(inpath.preffix, attr).lstrip(' _')
+                        data[key] = itemattrs[attr]
+        return res
+
+    def iter_flatten(self, innode, inparser, inpreffix=None, invalues=True):
+        """
+        Записи одного тега: для repeated='explode' - по записи на каждое сочетание повторяющихся тегов
+        (получаются по одной), для остальных режимов - одна запись (см. flatten)
+        :rtype: iterable
+        """
+        if self.repeated == 'explode':
+            records = _expand(self.template(innode, inparser, inpreffix, invalues))
+            if self._maxfields:
+                records = self._check_fields(records)
+            return records
+        return (self.flatten(innode, inparser, inpreffix, invalues),)
+
+    def _check_fields(self, inrecords):
+        for rec in inrecords:
+            if len(rec) > self._maxfields:
+                raise LimitExceeded('fields', 'Полей в записи больше {}'.format(self._maxfields))
+            yield rec
+
+    def _projectable(self):
+        """
+        Теги, в поддереве которых нет полей infields, не нужны для записи и могут быть очищены при разборе:
+        заданы infields, не нужны атрибуты, ключи дочерних тегов не зависят от соседних (не repeated='index')
+        и префикс записи известен заранее (путь без *, // и условий)
+        :rtype: bool
+        """
+        return (bool(self._fields) and not self.inuseattrs and self.repeated != 'index' and
+                (self.selector is None or self.selector.simple))
+
+    def find(self, indoc, inparser):
+        """
+        Поиск тегов intagname в разобранном документе с проверкой родительских тегов
+        :param indoc: Документ, полученный inparser.parse
+        :param inparser: Парсер
+        :return: Список найденных тегов
+        :rtype: list
+        """
+        return [item for item, preffix in self._find(indoc, inparser)]
+
+    def _find(self, indoc, inparser):
+        """
+        Поиск тегов intagname
+        :return: Список (тег, префикс ключей записи)
+        :rtype: list
+        """
+        if self.selector is None:
+            return [(item, self.preffix) for item in inparser.roots(indoc)]
+        return inparser.select(indoc, self.selector)
+
+    def iter_records(self, indoc, inparser):
+        """
+        Плоские записи из разобранного документа без синхронизации колонок по одной
+        :rtype: generator
+        """
+        if self.repeated == 'explode':
+            for item, preffix in self._find(indoc, inparser):
+                yield from self.iter_flatten(item, inparser, preffix)
+            return
+        flatten = self.flatten
+        for item, preffix in self._find(indoc, inparser):
+            yield flatten(item, inparser, preffix)
+
+    def records(self, indoc, inparser):
+        """
+        Плоские записи из разобранного документа без синхронизации колонок
+        :rtype: list
+        """
+        return list(self.iter_records(indoc, inparser))
+
+    def convert(self, inxml, output='records', cache=None, intern=False, stats=None):
+        """
+        Преобразование XML текста в список плоских словарей (как xml_to_json_flat)
+        :param inxml: XML текст, байты, путь к файлу (pathlib.Path), файловый объект, mmap или memoryview
+        :param output: 'records' - список словарей, 'columns' - колонки (Columns), 'rows' - список Row
+        :param cache: Кэш результатов (см. ResultCache). None - без кэша
+        :param intern: Заменять одинаковые строковые значения одним объектом строки
+        :param stats: Статистика по этапам (см. ConversionStats). None - без замеров
+        :type inxml: str|bytes|os.PathLike|file|mmap.mmap|memoryview
+        :type output: str
+        :type cache: ResultCache
+        :type intern: bool
+        :type stats: ConversionStats
+        :rtype: list|Columns
+        """
+        if cache is not None:
+            key = cache.key(inxml, self._options(output, intern))
+            if key is not None:
+                res = cache.get(key)
+                if res is None:
+                    res = self.convert(inxml, output=output, intern=intern, stats=stats)
+                    cache.put(key, res)
+                return res
+        _check_output(output)
+        if stats is not None:
+            return self._convert_stats(inxml, output, intern, stats)
+        parser = _get_parser(self.parser)
+        doc = parser.parse(inxml)
+        return _output_result(self.iter_records(doc, parser), output, intern)
+
+    def _convert_stats(self, inxml, output, intern, stats):
+        """
+        convert с замером этапов: записи получаются списком, чтобы отделить flatten от output
+        :rtype: list|Columns
+        """
+        with stats.conversion(inxml):
+            parser = _get_parser(self.parser)
+            with stats.stage('parse'):
+                doc = parser.parse(inxml)
+            with stats.stage('find'):
+                items = self._find(doc, parser)
+            with stats.stage('flatten'):
+                iter_flatten = self.iter_flatten
+                records = [rec for item, preffix in items for rec in iter_flatten(item, parser, preffix)]
+            with stats.stage('output'):
+                res = _output_result(records, output, intern)
+            stats.records += len(records)
+            stats.count([item for item, preffix in items], parser)
+        return res
+
+    def _options(self, output, intern=False):
+        """
+        Параметры, от которых зависит результат convert (ключ ResultCache)
+        :rtype: dict
+        """
+        return {'intagname': self.intagname, 'infields': sorted(self.infields), 'inmaxlevel': self.inmaxlevel,
+                'inuseattrs': bool(self.inuseattrs), 'inskipfirsttag': bool(self.inskipfirsttag),
+                'parser': self.parser if isinstance(self.parser, str) else type(self.parser).__name__,
+                'output': output, 'repeated': self.repeated,
+                'separator': self.separator if self.repeated == 'join' else None, 'intern': bool(intern)}
+
+
+def _xml_size(inxml):
+    """
+    Размер XML до разбора: байты, для текста - символы. Для файловых объектов - None (размер считается
+    по позиции после разбора)
+    :type inxml: str|bytes|os.PathLike|file|mmap.mmap|memoryview
+    :rtype: int
+    """
+    if isinstance(inxml, memoryview):
+        return inxml.nbytes
+    if isinstance(inxml, (str, bytes, bytearray, mmap.mmap)):
+        return len(inxml)
+    if isinstance(inxml, os.PathLike):
+        return os.path.getsize(inxml)
+    return None
+
+
+class ConversionStats(object):
+    """
+    Статистика преобразования по этапам: parse - разбор XML, find - поиск тегов intagname и проверка
+    родительских тегов, flatten - получение плоских записей, output - синхронизация колонок (или построение
+    Columns/Row). По каждому этапу - время (wall) и процессорное время (cpu), а также кол-во записей, тегов
+    в записях, максимальная глубина записи, размер XML и пиковый расход памяти (memory=True, через tracemalloc).
+    Один объект можно передавать в несколько преобразований - значения суммируются.
+    Без stats преобразование выполняется как обычно, без замеров
+    Пример:
+        stats = ConversionStats(callback=lambda stage, wall, cpu: log.debug('%s %.3f', stage, wall))
+        res = xml_to_json_flat(xml, 'tag1/tag2', stats=stats)
+        print(stats.report())
+    """
+    STAGES = ('parse', 'find', 'flatten', 'output')
+
+    def __init__(self, callback=None, memory=False):
+        """
+        :param callback: Функция callback(этап, wall, cpu), вызывается после каждого этапа
+        :param memory: Замерять пиковый расход памяти через tracemalloc (замедляет преобразование)
+        :type callback: callable
+        :type memory: bool
+        """
+        self.callback = callback
+        self.memory = memory
+        self.stages = {}  # Этап -> {'wall': сек, 'cpu': сек, 'calls': кол-во}
+        self.conversions = 0
+        self.records = 0
+        self.elements = 0  # Теги внутри найденных записей, включая сами теги записей
+        self.maxdepth = 0  # Максимальная глубина записи: 1 - тег записи без вложенных тегов
+        self.bytes = 0  # Размер XML: байты, для текста - символы
+        self.peakmemory = None  # Пиковый расход памяти в байтах (memory=True)
+
+    @contextlib.contextmanager
+    def stage(self, inname):
+        """
+        Замер этапа: with stats.stage('parse'): ...
+        :param inname: Имя этапа
+        :type inname: str
+        """
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            stage = self.stages.get(inname)
+            if stage is None:
+                stage = self.stages[inname] = {'wall': 0.0, 'cpu': 0.0, 'calls': 0}
+            stage['wall'] += wall
+            stage['cpu'] += cpu
+            stage['calls'] += 1
+            if self.callback is not None:
+                self.callback(inname, wall, cpu)
+
+    @contextlib.contextmanager
+    def conversion(self, inxml):
+        """
+        Замер одного преобразования: размер XML и пиковый расход памяти
+        :param inxml: XML (см. xml_to_json_flat)
+        """
+        size = _xml_size(inxml)
+        pos = inxml.tell() if size is None and hasattr(inxml, 'tell') else None
+        started = self.memory and not tracemalloc.is_tracing()
+        current = 0
+        if started:
+            tracemalloc.start()
+        elif self.memory:
+            # tracemalloc уже запущен вызывающим кодом: его пик не сбрасывается, считается прирост от текущего
+            # объема (если пик вызывающего кода был выше, значение завышено)
+            current = tracemalloc.get_traced_memory()[0]
+        try:
+            yield
+        finally:
+            if self.memory:
+                peak = max(tracemalloc.get_traced_memory()[1] - current, 0)
+                self.peakmemory = max(self.peakmemory or 0, peak)
+                if started:
+                    tracemalloc.stop()
+            if size is None and pos is not None:
+                size = inxml.tell() - pos
+            self.bytes += size or 0
+            self.conversions += 1
+
+    def count(self, innodes, inparser):
+        """
+        Подсчет тегов и глубины найденных записей (обход без рекурсии)
+        :param innodes: Теги записей
+        :param inparser: Парсер, которым получены теги
+        """
+        children = inparser.children
+        elements = 0
+        maxdepth = self.maxdepth
+        stack = [(node, 1) for node in innodes]
+        while stack:
+            node, depth = stack.pop()
+            elements += 1
+            if depth > maxdepth:
+                maxdepth = depth
+            stack.extend((item, depth + 1) for item in children(node))
+        self.elements += elements
+        self.maxdepth = maxdepth
+
+    def to_dict(self):
+        """
+        Статистика в виде словаря (например для json или логов)
+        :rtype: dict
+        """
+        return {'stages': {name: dict(stage) for name, stage in self.stages.items()},
+                'conversions': self.conversions, 'records': self.records, 'elements': self.elements,
+                'maxdepth': self.maxdepth, 'bytes': self.bytes, 'peakmemory': self.peakmemory}
+
+    def report(self):
+        """
+        Статистика в виде текста: по строке на этап и итоговые значения
+        :rtype: str
+        """
+        total = sum(stage['wall'] for stage in self.stages.values()) or 1.0
+        lines = ['{:<10} {:>10} {:>10} {:>6}'.format('этап', 'wall, с', 'cpu, с', '%')]
+        for name, stage in self.stages.items():
+            lines.append('{:<10} {:>10.4f} {:>10.4f} {:>6.1f}'.format(name, stage['wall'], stage['cpu'],
+                                                                     stage['wall'] / total * 100))
+        lines.append('записей: {}, тегов: {}, глубина: {}, размер: {}'.format(
+            self.records, self.elements, self.maxdepth, self.bytes))
+        if self.peakmemory is not None:
+            lines.append('пик памяти: {:.1f} МБ'.format(self.peakmemory / 2 ** 20))
+        return '\n'.join(lines)
+
+
+_CACHE_MAXBYTES = 64 << 20  # Размер ResultCache в памяти по умолчанию
+
+
+def _xml_hash(inxml):
+    """
+    Хэш содержимого XML (blake2b): текста, байтов, файла по пути. Для файловых объектов - None
+    :type inxml: str|bytes|os.PathLike|file|mmap.mmap|memoryview
+    :rtype: str
+    """
+    if isinstance(inxml, str):
+        return hashlib.blake2b(inxml.encode('utf-8', 'surrogatepass'), digest_size=16).hexdigest()
+    if isinstance(inxml, (bytes, bytearray, memoryview, mmap.mmap)):
+        return hashlib.blake2b(inxml, digest_size=16).hexdigest()
+    if isinstance(inxml, os.PathLike):
+        return _file_hash(inxml)
+    return None
+
+
+class ResultCache(object):
+    """
+    Кэш результатов преобразования: ключ - хэш содержимого XML и параметры преобразования.
+    Результаты хранятся сериализованными (pickle), поэтому каждое получение из кэша возвращает новые объекты
+    и изменение результата вызывающим кодом не меняет кэш. В памяти - LRU с ограничением по размеру
+    в байтах, при заданном cachedir результаты также сохраняются в файлы и переживают перезапуск процесса.
+    Файловые объекты не кэшируются (содержимое нельзя прочитать повторно)
+    Пример:
+        cache = ResultCache(maxbytes=256 << 20, cachedir='/var/cache/xml_to_json_flat')
+        res = xml_to_json_flat(xml, 'tag1/tag2', cache=cache)
+        print(cache.stats())
+    """
+
+    def __init__(self, maxbytes=_CACHE_MAXBYTES, cachedir=None):
+        """
+        :param maxbytes: Максимальный размер результатов в памяти в байтах
+        :param cachedir: Каталог для хранения результатов в файлах. None - только в памяти
+        :type maxbytes: int
+        :type cachedir: str
+        """
+        self.maxbytes = maxbytes
+        self.cachedir = cachedir
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.diskhits = 0  # Из hits: результат прочитан из cachedir
+        self.bytes = 0
+        self._items = collections.OrderedDict()  # Ключ -> результат в pickle, от старых к новым
+        self._lock = threading.Lock()
+        if cachedir:
+            os.makedirs(cachedir, exist_ok=True)
+
+    def key(self, inxml, inoptions):
+        """
+        Ключ кэша: хэш содержимого XML и нормализованные параметры
+        :param inxml: XML
+        :param inoptions: Параметры преобразования
+        :return: Ключ. None - XML не кэшируется
+        :type inoptions: dict
+        :rtype: str
+        """
+        xmlhash = _xml_hash(inxml)
+        if xmlhash is None:
+            return None
+        options = json.dumps(inoptions, sort_keys=True, ensure_ascii=False)
+        return hashlib.blake2b((xmlhash + options).encode('utf-8'), digest_size=16).hexdigest()
+
+    def _path(self, inkey):
+        return os.path.join(self.cachedir, inkey + '.pickle')
+
+    def get(self, inkey):
+        """
+        Результат из кэша
+        :param inkey: Ключ (см. key)
+        :return: Копия результата. None - результата нет в кэше
+        :rtype: list|Columns
+        """
+        with self._lock:
+            data = self._items.get(inkey)
+            if data is not None:
+                self._items.move_to_end(inkey)
+                self.hits += 1
+        if data is None and self.cachedir:
+            try:
+                with open(self._path(inkey), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                data = None
+            if data is not None:
+                with self._lock:
+                    self.hits += 1
+                    self.diskhits += 1
+                self._store(inkey, data)
+        if data is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        return pickle.loads(data)
+
+    def put(self, inkey, invalue):
+        """
+        Сохранение результата в кэш
+        :param inkey: Ключ (см. key)
+        :param invalue: Результат преобразования
+        :type invalue: list|Columns
+        """
+        data = pickle.dumps(invalue, protocol=pickle.HIGHEST_PROTOCOL)
+        self._store(inkey, data)
+        if self.cachedir:
+            # Запись во временный файл и переименование: другие процессы не увидят файл частично
+            path = self._path(inkey)
+            tmppath = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmppath, 'wb') as fw:
+                fw.write(data)
+            os.replace(tmppath, path)
+
+    def _store(self, inkey, indata):
+        if len(indata) > self.maxbytes:
+            return
+        with self._lock:
+            old = self._items.pop(inkey, None)
+            if old is not None:
+                self.bytes -= len(old)
+            self._items[inkey] = indata
+            self.bytes += len(indata)
+            while self.bytes > self.maxbytes:
+                key, data = self._items.popitem(last=False)
+                self.bytes -= len(data)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Очистка кэша в памяти и в cachedir
+        """
+        with self._lock:
+            self._items.clear()
+            self.bytes = 0
+        if self.cachedir:
+            for path in glob.glob(os.path.join(self.cachedir, '*.pickle')):
+                os.remove(path)
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        """
+        Счетчики кэша
+        :rtype: dict
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'diskhits': self.diskhits,
+                'items': len(self._items), 'bytes': self.bytes}
+
+
+def xml_to_json_flat(inxml, intagname, infields=[], inmaxlevel=0, inuseattrs=True, inskipfirsttag=False,
+                     parser='bs4', output='records', repeated='first', separator='; ', cache=None, intern=False,
+                     stats=None):
     """
     Основная функция принимает XML в виде текста. Ищет теги с именем intagname и выводит список
         найденного в виде плоского словаря
-    Внимание: Если внутри тега есть несколько рядом стоящих одинаковых тегов, то будет использован только первый
-    :param inxm: XML текст
+    Внимание: Если внутри тега есть несколько рядом стоящих одинаковых тегов, то по умолчанию будет использован
+        только первый (см. repeated)
+    :param inxm: XML текст. Также принимается XML в байтах, путь к файлу (pathlib.Path), бинарный файловый объект,
+        mmap и memoryview - парсеры lxml и etree читают их по частям, без создания полной копии в памяти.
+        Кодировка определяется по объявлению XML
     :param intagname: Наименование тега, список которых необходимо найти в xml. Если значение пустое, использовать
-        тег верхнего уровня
+        тег верхнего уровня. Также принимается путь tag1/tag2 и селектор: * - любой тег, // - любая вложенность,
+        [@attr="значение"] - условие на атрибут, / в начале - от тега верхнего уровня (см. _Selector).
+        В префикс ключей попадают имена тегов, совпавших с шагами селектора
     :param infields: Список полей, которые должны быть выведены в результате. Пустой список - все поля
     :param inmaxlevel: Максимальный уровень погружения. 0 - без ограничений
     :param inuseattrs: Выводить аттрибуты или нет
     :param inskipfirsttag: Убрать из начала ключа словаря имя искомого тега
+    :param parser: Парсер XML: 'bs4' (BeautifulSoup, по умолчанию), 'lxml' или 'etree' (xml.etree.ElementTree).
+        lxml и etree в несколько раз быстрее, но не исправляют некорректный XML
+    :param output: Вид результата: 'records' - список словарей (по умолчанию), 'columns' - колонки (Columns):
+        список полей и по одному списку значений на поле, 'rows' - список Row: записи с общим списком полей
+        и значениями в кортеже, со словарным интерфейсом только для чтения
+    :param repeated: Обработка одинаковых соседних тегов: 'first' - первый тег (по умолчанию), 'index' - номер
+        в ключе (item_0, item_1), 'join' - значения через separator, 'explode' - по записи на каждый тег
+        (см. REPEATED_MODES)
+    :param separator: Разделитель значений для repeated='join'
+    :param cache: Кэш результатов (ResultCache): повторное преобразование того же XML с теми же параметрами
+        берется из кэша. None - без кэша
+    :param intern: Заменять одинаковые строковые значения (коды, признаки) одним объектом строки
+    :param stats: Статистика по этапам: время, кол-во записей и тегов, размер, память (см. ConversionStats).
+        None - без замеров
     :return: Список json строк
     :type intagname: str
     :type infields: list
     :type inmaxlevel: int
     :type inuseattrs: bool
-    :type inxm: str
+    :type inxm: str|bytes|os.PathLike|file|mmap.mmap|memoryview
     :type inskipfirsttag: bool
-    :rtype: list
+    :type parser: str
+    :type output: str
+    :type repeated: str
+    :type separator: str
+    :type cache: ResultCache
+    :type intern: bool
+    :type stats: ConversionStats
+    :rtype: list|Columns
     """
-    soup = BeautifulSoup(inxml, 'xml')
-    if intagname:
-        # Разделяем parent-тег
-        tagnamesplit = intagname.split('/')
-        tagname = tagnamesplit[-1]
-        parenttags = tagnamesplit[:-1]
-        tags = soup.find_all(tagname)  # Список тегов
+    flattener = Flattener(intagname, infields=infields, inmaxlevel=inmaxlevel, inuseattrs=inuseattrs,
+                          inskipfirsttag=inskipfirsttag, parser=parser, repeated=repeated, separator=separator)
+    return flattener.convert(inxml, output=output, cache=cache, intern=intern, stats=stats)
+
+
+def _check_path(inpath, inparenttags):
+    """
+    Проверка что путь из открытых тегов inpath заканчивается родительскими тегами inparenttags
+    (аналог _check_parent для потоковой обработки). Первый элемент пути - '[document]'
+    :param inpath: Список имен открытых тегов, начиная с '[document]'
+    :param inparenttags: Список родительских тегов
+    :type inpath: list
+    :type inparenttags: list
+    :rtype: bool
+    """
+    start = len(inpath) - len(inparenttags)
+    return start >= 0 and inpath[start:] == inparenttags
+
+
+def iter_xml_to_json_flat(source, intagname, infields=[], inmaxlevel=0, inuseattrs=True, inskipfirsttag=False,
+                          repeated='first', separator='; '):
+    """
+    Потоковый вариант xml_to_json_flat. XML читается по частям (iterparse), полное дерево документа не строится.
+    Каждая найденная запись отдается сразу после закрытия тега intagname, после чего поддерево освобождается,
+    поэтому расход памяти зависит от размера записи, а не документа.
+    Ключи записей совпадают с xml_to_json_flat, но колонки не синхронизируются (см. _json_fields_sync)
+    :param source: Путь к файлу, файловый объект, открытый в бинарном режиме, bytes, mmap или memoryview
+    :param intagname: Наименование тега, путь к тегу tag1/tag2 или селектор (см. _Selector).
+        Пустое значение - тег верхнего уровня
+    :param infields: Список полей, которые должны быть выведены в результате. Пустой список - все поля
+    :param inmaxlevel: Максимальный уровень погружения. 0 - без ограничений
+    :param inuseattrs: Выводить аттрибуты или нет
+    :param inskipfirsttag: Убрать из начала ключа словаря имя искомого тега
+    :param repeated: Обработка одинаковых соседних тегов (см. xml_to_json_flat). Для 'explode' сочетания
+        получаются по одной записи, без списка всех сочетаний в памяти
+    :param separator: Разделитель значений для repeated='join'
+    :return: Генератор плоских словарей
+    :type source: str|os.PathLike|file|bytes|mmap.mmap|memoryview
+    :type intagname: str
+    :type infields: list
+    :type inmaxlevel: int
+    :type inuseattrs: bool
+    :type inskipfirsttag: bool
+    :type repeated: str
+    :type separator: str
+    :rtype: generator
+    """
+    flattener = Flattener(intagname, infields=infields, inmaxlevel=inmaxlevel, inuseattrs=inuseattrs,
+                          inskipfirsttag=inskipfirsttag, repeated=repeated, separator=separator)
+    return _iterparse_records(source, flattener)
+
+
+def _iterparse_records(source, inflattener, invalues=True):
+    """
+    Потоковое получение записей через iterparse (см. iter_xml_to_json_flat)
+    :param source: Путь, файловый объект, bytes, mmap или memoryview
+    :param inflattener: План преобразования
+    :param invalues: Получать значения тегов. False - только ключи
+    :rtype: generator
+    """
+    for name, rec in _iterparse_multi(source, [(None, inflattener, None)], invalues=invalues):
+        yield rec
+
+
+def _iterparse_multi(source, inplans, invalues=True, inparentkey=False):
+    """
+    Потоковое получение записей нескольких наборов за один проход iterparse
+    :param source: Путь, файловый объект, bytes, mmap или memoryview
+    :param inplans: Список (имя набора, Flattener, имя родительского набора) (см. _multi_plans)
+    :param invalues: Получать значения тегов. False - только ключи
+    :param inparentkey: Добавлять в записи ключи _id, _parent, _parent_id (см. xml_to_json_flat_multi)
+    :return: Генератор (имя набора, запись) в порядке документа
+    :rtype: generator
+    """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    elif isinstance(source, (memoryview, mmap.mmap)):
+        source = _BufferReader(source)
+    return _event_records(ET.iterparse(source, events=('start-ns', 'start', 'end')), inplans, invalues=invalues,
+                          inparentkey=inparentkey)
+
+
+_NEED_DATA = ('', None)  # Событие для _event_records: события закончились, нужна следующая часть XML
+_PRUNED = object()  # Тег внутри записи, в поддереве которого нет полей infields (см. _event_records)
+_KEPT = object()  # Тег внутри вложенной записи: поддерево не очищается (см. _event_records)
+
+
+def _event_records(events, inplans, invalues=True, inparentkey=False):
+    """
+    Получение записей из событий разбора ('start-ns', 'start', 'end') iterparse или XMLPullParser.
+    На событие _NEED_DATA отдается None - генератор можно продолжить после передачи парсеру следующей части
+    :param events: Итератор (событие, элемент)
+    :param inplans: Список (имя набора, Flattener, имя родительского набора) (см. _multi_plans)
+    :param invalues: Получать значения тегов. False - только ключи
+    :param inparentkey: Добавлять в записи ключи _id, _parent, _parent_id (см. xml_to_json_flat_multi)
+    :return: Генератор (имя набора, запись) в порядке документа и None на _NEED_DATA
+    :rtype: generator
+    """
+    parser = _EtreeParser()
+    plans = [(name, flattener, flattener.selector, flattener.selector is None or flattener.selector.simple,
+              flattener.tagname, flattener.parenttags, parentname) for name, flattener, parentname in inplans]
+    counters = {name: 0 for name, flattener, parentname in inplans}  # Следующий _id каждого набора
+
+    path = ['[document]']  # Имена открытых тегов
+    elems = []  # Открытые элементы
+    # Открытые найденные теги: (элемент, индекс в pending, префикс ключей, план, ключи _id/_parent)
+    matches = []
+    # Доступ к стеку открытых тегов для _Selector.match: тег - индекс в elems
+    stackparent = lambda i: i - 1 if i else None
+    stackname = lambda i: elems[i].tag
+    stackattrs = lambda i: elems[i].attrib
+    pending = []  # Записи в порядке документа, ожидающие закрытия внешнего найденного тега
+    nsprefixes = {}
+    nsdecl = []
+    # Проекция infields для одного набора: _PathNode открытых тегов внутри записи (None - вне записи,
+    # _PRUNED - поддерево не нужно, _KEPT - внутри вложенной записи).
+    # Теги, в поддереве которых нет полей infields, очищаются сразу при закрытии, а не после закрытия записи
+    projection = plans[0] if len(plans) == 1 and plans[0][1]._projectable() else None
+    nodes = []
+    for event, elem in events:
+        if event == 'start-ns':
+            prefix, uri = elem
+            nsprefixes[uri] = prefix
+            nsdecl.append(elem)
+        elif event == 'start':
+            _etree_normalize(elem, nsprefixes, nsdecl)
+            nsdecl = []
+            path.append(elem.tag)
+            elems.append(elem)
+            found = []
+            for plan in plans:
+                name, flattener, selector, simple, tagname, parenttags, parentname = plan
+                if selector is None:
+                    if len(path) == 2:
+                        found.append((elem, len(pending), None, plan, None))
+                        pending.append(None)
+                elif simple:
+                    if elem.tag == tagname and _check_path(path[:-1], parenttags):
+                        found.append((elem, len(pending), None, plan, None))
+                        pending.append(None)
+                else:
+                    preffix = selector.match(len(elems) - 1, stackparent, stackname, stackattrs)
+                    if preffix is not None:
+                        found.append((elem, len(pending), preffix, plan, None))
+                        pending.append(None)
+            if inparentkey:
+                for i, (elem, index, preffix, plan, keys) in enumerate(found):
+                    name, parentname = plan[0], plan[6]
+                    keys = {_ID_KEY: counters[name], _PARENT_KEY: None, _PARENT_ID_KEY: None}
+                    counters[name] += 1
+                    for parent in reversed(matches):
+                        if parentname is None or parent[3][0] == parentname:
+                            keys[_PARENT_KEY], keys[_PARENT_ID_KEY] = parent[3][0], parent[4][_ID_KEY]
+                            break
+                    found[i] = (elem, index, preffix, plan, keys)
+            matches.extend(found)
+            if projection is not None:
+                flattener = projection[1]
+                parentnode = nodes[-1] if nodes else None
+                if found and (parentnode is None or parentnode is _PRUNED):
+                    node = flattener._path('' if flattener.inskipfirsttag else flattener.preffix + elem.tag)
+                elif found:
+                    # Запись внутри другой записи нужна обеим с разными путями - ее поддерево не очищается
+                    node = _KEPT
+                elif parentnode is None or parentnode is _PRUNED or parentnode is _KEPT:
+                    node = parentnode
+                else:
+                    node = parentnode.children.get(elem.tag)
+                    if node is None:
+                        node = flattener._child_path(parentnode, elem.tag)
+                    if not node.usetext:
+                        node = _PRUNED
+                nodes.append(node)
+        elif event == 'end':
+            path.pop()
+            elems.pop()
+            if projection is not None and nodes.pop() is _PRUNED:
+                elem.clear()
+            while matches and matches[-1][0] is elem:
+                index, preffix, plan, keys = matches.pop()[1:]
+                flattener = plan[1]
+                if flattener.repeated == 'explode':
+                    records = _expand(flattener.template(elem, parser, inpreffix=preffix, invalues=invalues))
+                else:
+                    records = (flattener.flatten(elem, parser, inpreffix=preffix, invalues=invalues),)
+                pending[index] = (plan[0], records, keys)
+            if not matches:
+                # Вне найденных тегов поддерево больше не нужно
+                for name, records, keys in pending:
+                    for rec in records:
+                        if keys is not None:
+                            rec.update(keys)
+                        yield name, rec
+                pending = []
+                elem.clear()
+                if elems:
+                    del elems[-1][-1]
+        else:
+            yield None
+
+
+_ID_KEY = '_id'  # Номер записи в наборе
+_PARENT_KEY = '_parent'  # Имя набора, в теге записи которого находится запись
+_PARENT_ID_KEY = '_parent_id'  # _id родительской записи
+
+
+def _multi_plans(inselectors, parser='bs4'):
+    """
+    Планы преобразования для нескольких наборов записей
+    :param inselectors: Словарь имя набора -> селектор (str) или словарь параметров Flattener
+        (intagname, infields, inmaxlevel, inuseattrs, inskipfirsttag) и parent - имя родительского набора
+    :param parser: Парсер XML
+    :return: Список (имя набора, Flattener, имя родительского набора)
+    :type inselectors: dict
+    :type parser: str
+    :rtype: list
+    """
+    plans = []
+    for name, options in inselectors.items():
+        options = {'intagname': options} if isinstance(options, str) else dict(options)
+        parentname = options.pop('parent', None)
+        if parentname is not None and parentname not in inselectors:
+            raise ValueError('Набор {}: неизвестный родительский набор {}'.format(name, parentname))
+        plans.append((name, Flattener(parser=parser, **options), parentname))
+    return plans
+
+
+def xml_to_json_flat_multi(inxml, inselectors, parser='bs4', output='records', parentkey=False, intern=False):
+    """
+    Получение нескольких наборов записей из одного XML: документ разбирается один раз, для каждого набора
+    свой селектор и свои параметры
+    Пример:
+        res = xml_to_json_flat_multi(xml, {
+            'orders': 'Order',
+            'lines': {'intagname': 'Order/Line', 'infields': ['Order_Line_Sku'], 'parent': 'orders'},
+            'customers': {'intagname': 'Customer', 'inuseattrs': False},
+        }, parentkey=True)
+        res['lines'] -> [{'Order_Line_Sku': ..., '_id': 0, '_parent': 'orders', '_parent_id': 0}, ...]
+    :param inxml: XML текст, байты, путь к файлу (pathlib.Path), файловый объект, mmap или memoryview
+    :param inselectors: Словарь имя набора -> селектор (str) или словарь параметров xml_to_json_flat
+        (intagname, infields, inmaxlevel, inuseattrs, inskipfirsttag) и parent - имя родительского набора
+    :param parser: Парсер XML: 'bs4', 'lxml' или 'etree'
+    :param output: 'records' - списки словарей, 'columns' - колонки (Columns), 'rows' - списки Row
+    :param parentkey: Добавить в записи ключи для связи наборов: _id - номер записи в наборе, _parent - набор
+        ближайшего внешнего найденного тега (только набор parent, если он задан), _parent_id - _id его записи
+    :param intern: Заменять одинаковые строковые значения одним объектом строки (общая таблица для всех наборов)
+    :return: Словарь имя набора -> результат (как у xml_to_json_flat)
+    :type inxml: str|bytes|os.PathLike|file|mmap.mmap|memoryview
+    :type inselectors: dict
+    :type parser: str
+    :type output: str
+    :type parentkey: bool
+    :type intern: bool
+    :rtype: dict
+    """
+    _check_output(output)
+    plans = _multi_plans(inselectors, parser)
+    xmlparser = _get_parser(parser)
+    doc = xmlparser.parse(inxml)
+    found = [(name, flattener, parentname, flattener._find(doc, xmlparser))
+             for name, flattener, parentname in plans]
+    if parentkey:
+        # Тег -> [(набор, _id)] в порядке наборов
+        nodeids = {}
+        for name, flattener, parentname, items in found:
+            for i, (item, preffix) in enumerate(items):
+                nodeids.setdefault(id(item), []).append((name, i))
+    res = {}
+    table = {} if intern else None
+    for name, flattener, parentname, items in found:
+        records = []
+        for i, (item, preffix) in enumerate(items):
+            keys = None
+            if parentkey:
+                keys = {_ID_KEY: i, _PARENT_KEY: None, _PARENT_ID_KEY: None}
+                parent = xmlparser.parent(item)
+                while parent is not None and keys[_PARENT_KEY] is None:
+                    for parentset, parentid in reversed(nodeids.get(id(parent), ())):
+                        if parentname is None or parentset == parentname:
+                            keys[_PARENT_KEY], keys[_PARENT_ID_KEY] = parentset, parentid
+                            break
+                    parent = xmlparser.parent(parent)
+            for rec in flattener.iter_flatten(item, xmlparser, preffix):
+                if keys is not None:
+                    rec.update(keys)
+                records.append(rec)
+        res[name] = _output_result(records if table is None else _intern_records(records, table), output)
+    return res
+
+
+def iter_xml_to_json_flat_multi(source, inselectors, parentkey=False):
+    """
+    Потоковый вариант xml_to_json_flat_multi: один проход iterparse для всех наборов.
+    Записи отдаются в порядке документа, колонки не синхронизируются (см. iter_xml_to_json_flat)
+    :param source: Путь к файлу, файловый объект, открытый в бинарном режиме, bytes, mmap или memoryview
+    :param inselectors: Словарь имя набора -> селектор или словарь параметров (см. xml_to_json_flat_multi)
+    :param parentkey: Добавить в записи ключи _id, _parent, _parent_id (см. xml_to_json_flat_multi)
+    :return: Генератор (имя набора, запись)
+    :type source: str|os.PathLike|file|bytes|mmap.mmap|memoryview
+    :type inselectors: dict
+    :type parentkey: bool
+    :rtype: generator
+    """
+    return _iterparse_multi(source, _multi_plans(inselectors), inparentkey=parentkey)
+
+
+_SCHEMA_VERSION = 1
+
+
+def _file_hash(inpath):
+    """
+    Хэш содержимого файла (blake2b), файл читается по частям
+    :rtype: str
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(inpath, 'rb') as f:
+        for chunk in iter(functools.partial(f.read, _READ_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _source_hash(source):
+    """
+    Хэш содержимого XML: файла по пути или данных в памяти. Для файловых объектов - None
+    :rtype: str
+    """
+    if isinstance(source, (str, os.PathLike)):
+        return _file_hash(source)
+    if isinstance(source, (bytes, memoryview, mmap.mmap)):
+        return hashlib.blake2b(source, digest_size=16).hexdigest()
+    return None
+
+
+def load_schema(inschemafile):
+    """
+    Список полей из файла схемы, сохраненного discover_schema
+    :param inschemafile: Путь к файлу схемы
+    :rtype: list
+    """
+    with open(inschemafile, 'r', encoding='utf-8') as f:
+        return json.load(f)['fields']
+
+
+def discover_schema(source, intagname, infields=[], inmaxlevel=0, inuseattrs=True, inskipfirsttag=False,
+                    schemafile=None, repeated='first'):
+    """
+    Получение списка полей записей (в порядке первого появления) без получения значений.
+    Документ читается потоково (iterparse), значения тегов не извлекаются.
+    Если задан schemafile, схема сохраняется в него, а при повторном вызове берется из него без чтения XML,
+    если параметры совпадают и файл схемы новее source или совпадает хэш содержимого source
+    :param source: Путь к файлу, файловый объект, bytes, mmap или memoryview
+    :param intagname: Наименование тега или путь к тегу tag1/tag2. Пустое значение - тег верхнего уровня
+    :param infields: Список полей, которые должны быть выведены в результате. Пустой список - все поля
+    :param inmaxlevel: Максимальный уровень погружения. 0 - без ограничений
+    :param inuseattrs: Выводить аттрибуты или нет
+    :param inskipfirsttag: Убрать из начала ключа словаря имя искомого тега
+    :param schemafile: Путь к файлу схемы (json)
+    :param repeated: Обработка одинаковых соседних тегов (см. xml_to_json_flat)
+    :return: Список полей
+    :type source: str|os.PathLike|file|bytes|mmap.mmap|memoryview
+    :type schemafile: str
+    :type repeated: str
+    :rtype: list
+    """
+    options = dict(intagname=intagname, infields=list(infields), inmaxlevel=inmaxlevel, inuseattrs=inuseattrs,
+                   inskipfirsttag=inskipfirsttag)
+    if repeated != 'first':
+        # Ключ options в уже сохраненных схемах не меняется
+        options['repeated'] = repeated
+    path = os.fspath(source) if isinstance(source, (str, os.PathLike)) else None
+    sourcehash = None
+    if schemafile and os.path.exists(schemafile):
+        try:
+            with open(schemafile, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+        except ValueError:
+            cached = None
+        if cached and cached.get('version') == _SCHEMA_VERSION and cached.get('options') == options:
+            if path is not None and os.path.getmtime(schemafile) >= os.path.getmtime(path):
+                return cached['fields']
+            sourcehash = _source_hash(source)
+            if sourcehash is not None and sourcehash == cached.get('hash'):
+                return cached['fields']
+
+    flattener = Flattener(**options)
+    fields = {}  # Порядок полей - порядок первого появления
+    for rec in _iterparse_records(source, flattener, invalues=False):
+        fields.update(rec)
+    fields = list(fields)
+
+    if schemafile:
+        if sourcehash is None:
+            sourcehash = _source_hash(source)
+        with open(schemafile, 'w', encoding='utf-8') as fw:
+            json.dump({'version': _SCHEMA_VERSION, 'options': options, 'hash': sourcehash, 'fields': fields},
+                      fw, ensure_ascii=False, indent=4)
+    return fields
+
+
+_WRITE_BUFFER = 1 << 20  # Размер буфера записи в байтах
+_BATCH_SIZE = 65536  # Кол-во записей в пакете для parquet
+
+
+def _open_output(outfile, inbinary):
+    """
+    Открытие файла результата. Если передан открытый файловый объект, он не закрывается
+    :param outfile: Путь или файловый объект
+    :param inbinary: Открывать путь в бинарном режиме
+    :return: (файловый объект, закрыть после записи)
+    :rtype: tuple
+    """
+    if isinstance(outfile, (str, os.PathLike)):
+        if inbinary:
+            return open(outfile, 'wb', buffering=_WRITE_BUFFER), True
+        return open(outfile, 'w', encoding='utf-8', newline='', buffering=_WRITE_BUFFER), True
+    return outfile, False
+
+
+def _batches(inrecords, insize):
+    """
+    Разбиение потока записей на списки по insize записей
+    :rtype: generator
+    """
+    iterator = iter(inrecords)
+    while True:
+        batch = list(itertools.islice(iterator, insize))
+        if not batch:
+            return
+        yield batch
+
+
+def write_jsonl(inrecords, outfile, infields=None):
+    """
+    Запись плоских словарей в JSON Lines по мере их получения, без накопления всего результата в памяти.
+    Строки пишутся пачками по _WRITE_BUFFER байт. Если установлен orjson, используется он
+    :param inrecords: Итерируемый объект плоских словарей (например iter_xml_to_json_flat) или Row
+    :param outfile: Путь или файловый объект (текстовый или бинарный)
+    :param infields: Список полей. Если задан, в каждой строке будут ровно эти поля (отсутствующие - null)
+    :return: Кол-во записанных записей
+    :type inrecords: iterable
+    :type outfile: str|os.PathLike|file
+    :type infields: list
+    :rtype: int
+    """
+    f, close = _open_output(outfile, True)
+    try:
+        binary = not isinstance(f, io.TextIOBase)
+        if orjson is not None:
+            dumps = functools.partial(orjson.dumps, option=orjson.OPT_APPEND_NEWLINE, default=dict)
+        else:
+            def dumps(rec):
+                return (json.dumps(rec, ensure_ascii=False, default=dict) + '\n').encode('utf-8')
+        buf = []
+        size = 0
+        count = 0
+        for rec in inrecords:
+            if infields:
+                rec = {fieldname: rec.get(fieldname) for fieldname in infields}
+            line = dumps(rec)
+            buf.append(line)
+            size += len(line)
+            count += 1
+            if size >= _WRITE_BUFFER:
+                data = b''.join(buf)
+                f.write(data if binary else data.decode('utf-8'))
+                buf = []
+                size = 0
+        if buf:
+            data = b''.join(buf)
+            f.write(data if binary else data.decode('utf-8'))
+    finally:
+        if close:
+            f.close()
+    return count
+
+
+def write_csv(inrecords, outfile, infields=None):
+    """
+    Запись плоских словарей в CSV по мере их получения. Заголовок - infields (остальные поля не выводятся),
+    а если они не заданы - поля первой записи (поля, которых нет в заголовке, вызывают ValueError)
+    :param inrecords: Итерируемый объект плоских словарей
+    :param outfile: Путь или текстовый файловый объект, открытый с newline=''
+    :param infields: Список полей (колонок)
+    :return: Кол-во записанных записей
+    :type inrecords: iterable
+    :type outfile: str|os.PathLike|file
+    :type infields: list
+    :rtype: int
+    """
+    iterator = iter(inrecords)
+    extrasaction = 'ignore'
+    if not infields:
+        first = next(iterator, None)
+        if first is None:
+            return 0
+        infields = list(first)
+        iterator = itertools.chain([first], iterator)
+        extrasaction = 'raise'
+    f, close = _open_output(outfile, False)
+    try:
+        writer = csv.DictWriter(f, fieldnames=infields, restval='', extrasaction=extrasaction)
+        writer.writeheader()
+        count = 0
+        for batch in _batches(iterator, 1024):
+            writer.writerows(batch)
+            count += len(batch)
+    finally:
+        if close:
+            f.close()
+    return count
+
+
+def write_parquet(inrecords, outfile, infields=None, inbatchsize=_BATCH_SIZE):
+    """
+    Запись плоских словарей в Parquet пакетами по inbatchsize записей (необходим pyarrow).
+    Все колонки строковые. Схема - infields (остальные поля не выводятся), а если они не заданы - поля
+    первого пакета (поля, которых нет в схеме, вызывают ValueError)
+    :param inrecords: Итерируемый объект плоских словарей
+    :param outfile: Путь или бинарный файловый объект
+    :param infields: Список полей (колонок)
+    :param inbatchsize: Кол-во записей в пакете (группе строк)
+    :return: Кол-во записанных записей
+    :rtype: int
+    """
+    import pyarrow
+    import pyarrow.parquet
+
+    schema = None
+    writer = None
+    strict = not infields
+    count = 0
+    try:
+        for batch in _batches(inrecords, inbatchsize):
+            columns = Columns.from_records(batch)
+            if schema is None:
+                infields = list(infields) if infields else columns.fields
+                schema = pyarrow.schema([(fieldname, pyarrow.string()) for fieldname in infields])
+                writer = pyarrow.parquet.ParquetWriter(outfile, schema)
+            extra = set(columns.fields).difference(infields)
+            if strict and extra:
+                raise ValueError('Поля отсутствуют в схеме: {}'.format(', '.join(sorted(extra))))
+            arrays = [pyarrow.array(columns[fieldname] if fieldname in columns.columns else [None] * len(columns),
+                                    type=pyarrow.string()) for fieldname in infields]
+            writer.write_batch(pyarrow.record_batch(arrays, schema=schema))
+            count += len(columns)
+    finally:
+        if writer is not None:
+            writer.close()
+    return count
+
+
+_WORKER_FLATTENER = None  # Flattener процесса-обработчика (см. _init_worker)
+
+OUTPUT_FORMATS = {'jsonl': '.jsonl', 'csv': '.csv', 'json': '.json', 'parquet': '.parquet'}
+
+
+def _collect_files(inpaths):
+    """
+    Список XML файлов по переданным путям: файлы, маски (glob) и каталоги (рекурсивно, *.xml).
+    Для каждого файла - путь относительно переданного пути (для каталога - путь внутри каталога, перед которым
+    при нескольких переданных путях добавляется имя каталога, для маски - от каталога перед первым шаблоном,
+    для файла - имя файла), чтобы файлы с одинаковыми именами из разных каталогов не записывались в один
+    файл результата
+    :param inpaths: Список путей
+    :type inpaths: list
+    :return: Список (путь, относительный путь)
+    :rtype: list
+    """
+    res = []
+    for path in inpaths:
+        if os.path.isdir(path):
+            # Для нескольких каталогов (in/a, in/b) имя каталога сохраняется: out/a/x.jsonl, out/b/x.jsonl
+            root = os.path.dirname(os.path.normpath(path)) if len(inpaths) > 1 else path
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                res.extend((os.path.join(dirpath, filename),
+                            os.path.relpath(os.path.join(dirpath, filename), root or os.curdir))
+                           for filename in sorted(filenames) if filename.lower().endswith('.xml'))
+        elif glob.has_magic(path):
+            root = path
+            while glob.has_magic(root):
+                root = os.path.dirname(root)
+            res.extend((filename, os.path.relpath(filename, root or os.curdir))
+                       for filename in sorted(glob.glob(path, recursive=True)))
+        else:
+            res.append((path, os.path.basename(path)))
+    return res
+
+
+def _unique_names(innames, inoutputdir, informat):
+    """
+    Пути результата без совпадений: к совпавшему с уже занятым добавляется номер (x.jsonl, x_2.jsonl, ...)
+    :param innames: Относительные пути XML файлов (см. _collect_files)
+    :type innames: list
+    :rtype: list
+    """
+    res = []
+    used = set()
+    for name in innames:
+        base, ext = os.path.splitext(name)
+        number = 1
+        while True:
+            outpath = os.path.normcase(os.path.normpath(_output_path(name, inoutputdir, informat)))
+            if outpath not in used:
+                break
+            number += 1
+            name = '{}_{}{}'.format(base, number, ext)
+        used.add(outpath)
+        res.append(name)
+    return res
+
+
+def _write_records(inrecords, outfile, informat, infields=None):
+    """
+    Запись плоских словарей в файл в нужном формате
+    :param inrecords: Итерируемый объект словарей (для json - список)
+    :param outfile: Путь или файловый объект
+    :param informat: Формат: jsonl, csv, json, parquet
+    :param infields: Список полей (колонок)
+    :type inrecords: iterable
+    :type informat: str
+    """
+    if informat == 'jsonl':
+        write_jsonl(inrecords, outfile, infields=infields)
+    elif informat == 'csv':
+        write_csv(inrecords, outfile, infields=infields)
+    elif informat == 'parquet':
+        write_parquet(inrecords, outfile, infields=infields)
+    else:
+        f, close = _open_output(outfile, False)
+        try:
+            json.dump(list(inrecords), f, ensure_ascii=False, indent=4, sort_keys=True)
+        finally:
+            if close:
+                f.close()
+
+
+def _output_path(inname, inoutputdir, informat):
+    """
+    Путь к файлу результата: относительный путь XML файла (см. _collect_files) внутри inoutputdir
+    """
+    return os.path.join(inoutputdir, os.path.splitext(inname)[0] + OUTPUT_FORMATS[informat])
+
+
+def _init_worker(inoptions):
+    """
+    Инициализация процесса-обработчика: план преобразования создается один раз на процесс
+    """
+    global _WORKER_FLATTENER
+    _WORKER_FLATTENER = Flattener(**inoptions)
+
+
+def _convert_file(inpath, inname=None, inoutputdir=None, informat='jsonl', instats=None):
+    """
+    Преобразование одного файла в процессе-обработчике. Ошибки не прерывают обработку остальных файлов
+    :param inpath: Путь к XML файлу
+    :param inname: Путь файла результата относительно inoutputdir без расширения. None - имя XML файла
+    :param inoutputdir: Каталог для результата. None - записи возвращаются вызывающему процессу
+    :param informat: Формат результата
+    :param instats: Статистика по этапам (только в текущем процессе)
+    :return: (путь, записи или их кол-во при записи в каталог, текст ошибки или None)
+    :rtype: tuple
+    """
+    try:
+        records = _WORKER_FLATTENER.convert(pathlib.Path(inpath), stats=instats)
+        if inoutputdir is None:
+            return inpath, records, None
+        outpath = _output_path(os.path.basename(inpath) if inname is None else inname, inoutputdir, informat)
+        os.makedirs(os.path.dirname(outpath) or os.curdir, exist_ok=True)
+        _write_records(records, outpath, informat)
+        return inpath, len(records), None
+    except Exception as e:
+        return inpath, None, '{}: {}'.format(type(e).__name__, e)
+
+
+def convert_files(inpaths, intagname, infields=[], inmaxlevel=0, inuseattrs=True, inskipfirsttag=False,
+                  parser='bs4', outputdir=None, outputformat='jsonl', workers=None, chunksize=1, repeated='first',
+                  separator='; ', stats=None):
+    """
+    Пакетное преобразование XML файлов в несколько процессов
+    :param inpaths: Файлы, маски или каталоги
+    :param intagname: Наименование тега или путь к тегу tag1/tag2
+    :param infields: Список полей, которые должны быть выведены в результате. Пустой список - все поля
+    :param inmaxlevel: Максимальный уровень погружения. 0 - без ограничений
+    :param inuseattrs: Выводить аттрибуты или нет
+    :param inskipfirsttag: Убрать из начала ключа словаря имя искомого тега
+    :param parser: Парсер XML: 'bs4', 'lxml' или 'etree'
+    :param outputdir: Каталог для результата по каждому файлу. None - записи возвращаются. Для файлов из каталогов
+        сохраняются подкаталоги (см. _collect_files), к совпадающим путям результата добавляется номер
+    :param outputformat: Формат файлов результата: jsonl, csv, json
+    :param workers: Кол-во процессов. None - по числу ядер, 1 - без дочерних процессов
+    :param chunksize: Кол-во файлов, передаваемых процессу за раз
+    :param repeated: Обработка одинаковых соседних тегов (см. xml_to_json_flat)
+    :param separator: Разделитель значений для repeated='join'
+    :param stats: Статистика по этапам (см. ConversionStats). Если задана, файлы обрабатываются в текущем процессе
+    :return: Генератор (путь, записи или их кол-во, текст ошибки или None) в порядке файлов
+    :rtype: generator
+    """
+    options = dict(intagname=intagname, infields=infields, inmaxlevel=inmaxlevel, inuseattrs=inuseattrs,
+                   inskipfirsttag=inskipfirsttag, parser=parser, repeated=repeated, separator=separator)
+    files = _collect_files(inpaths)
+    paths = [path for path, name in files]
+    names = [name for path, name in files]
+    if outputdir is not None:
+        names = _unique_names(names, outputdir, outputformat)
+    convert = functools.partial(_convert_file, inoutputdir=outputdir, informat=outputformat, instats=stats)
+    if workers == 1 or len(paths) <= 1 or stats is not None:
+        _init_worker(options)
+        for res in map(convert, paths, names):
+            yield res
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(options,)) as executor:
+        for res in executor.map(convert, paths, names, chunksize=chunksize):
+            yield res
+
+# Теги, комментарии, CDATA, инструкции и DOCTYPE. Группы: 1 - '/' закрывающего тега, 2 - имя тега, 3 - '/' пустого тега
+_TAG_RE = re.compile(rb'<(?:!--.*?-->|!\[CDATA\[.*?\]\]>|\?.*?\?>|!(?:[^>\[]|\[[^\]]*\])*>'
+                     rb'|(/?)([^\s/>]+)(?:[^>"\']|"[^"]*"|\'[^\']*\')*?(/?)>)', re.S)
+_PROLOG_RE = re.compile(rb'\s*<\?xml[^>]*\?>')
+_ENCODING_RE = re.compile(rb'encoding\s*=\s*["\']([A-Za-z0-9._-]+)["\']')
+
+
+def _xml_encoding(indata):
+    """
+    Кодировка документа из объявления <?xml ... encoding="..."?>. По умолчанию utf-8
+    :param indata: Начало документа
+    :type indata: bytes
+    :return: (кодировка, объявление XML или b'')
+    :rtype: tuple
+    """
+    prolog = _PROLOG_RE.match(indata[:1024])
+    if not prolog:
+        return 'utf-8', b''
+    encoding = _ENCODING_RE.search(prolog.group(0))
+    return (encoding.group(1).decode('ascii') if encoding else 'utf-8'), prolog.group(0).lstrip()
+
+
+def _scan_records(indata, intagname, inencoding='utf-8', instart=0, inparents=(), inpartial=False):
+    """
+    Поиск границ тегов intagname в байтах XML без построения дерева.
+    Для каждого внешнего найденного тега возвращаются смещения начала и конца и открывающие теги всех его
+    родителей (нужны чтобы разобрать фрагмент отдельно с сохранением пространств имен и проверки родителей)
+    :param indata: XML в байтах (bytes, mmap)
+    :param intagname: Наименование тега или путь к тегу tag1/tag2
+    :param inencoding: Кодировка документа
+    :param instart: Смещение, с которого начинается просмотр (граница между тегами)
+    :param inparents: Открывающие теги, открытые на смещении instart
+    :param inpartial: Документ может быть дописан не до конца: незакрытый тег в конце завершает просмотр
+        (иначе - ValueError)
+    :return: Генератор (начало, конец, кортеж открывающих тегов родителей)
+    :rtype: generator
+    """
+    tagnamesplit = intagname.split('/')
+    tagname = tagnamesplit[-1].encode(inencoding)
+    parenttags = [name.encode(inencoding) for name in tagnamesplit[:-1]]
+    # Внутри найденного тега ищутся только теги с тем же именем (для подсчета вложенности)
+    innersearch = re.compile(rb'<(?:!--.*?-->|!\[CDATA\[.*?\]\]>|(/?)((?:[^\s/>:]+:)?' + re.escape(tagname) +
+                             rb')(?=[\s/>])(?:[^>"\']|"[^"]*"|\'[^\']*\')*?(/?)>)', re.S).search
+    search = _TAG_RE.search
+    path = [b'[document]']  # Имена открытых тегов без префикса пространства имен
+    path.extend(_TAG_RE.match(starttag).group(2).rpartition(b':')[2] for starttag in inparents)
+    starttags = list(inparents)  # Открывающие теги открытых тегов
+    pos = instart
+    while True:
+        match = search(indata, pos)
+        if match is None:
+            break
+        pos = match.end()
+        name = match.group(2)
+        if name is None:
+            continue
+        if match.group(1):
+            path.pop()
+            starttags.pop()
+            continue
+        localname = name.rpartition(b':')[2]
+        if localname == tagname and _check_path(path, parenttags):
+            start = match.start()
+            depth = 0 if match.group(3) else 1
+            while depth:
+                inner = innersearch(indata, pos)
+                if inner is None:
+                    if inpartial:
+                        return
+                    raise ValueError('Не найден закрывающий тег {} (смещение {})'.format(name, start))
+                pos = inner.end()
+                if inner.group(2) is not None:
+                    if inner.group(1):
+                        depth -= 1
+                    elif not inner.group(3):
+                        depth += 1
+            yield start, pos, tuple(starttags)
+        elif not match.group(3):
+            path.append(localname)
+            starttags.append(match.group(0))
+
+def _split_chunks(inspans, inchunkcount):
+    """
+    Разбиение найденных тегов на примерно равные по размеру части с сохранением порядка
+    :param inspans: Список (начало, конец, родители)
+    :param inchunkcount: Желаемое кол-во частей
+    :return: Список частей, часть - список групп (родители, [(начало, конец), ...]) с одинаковыми родителями
+    :rtype: list
+    """
+    total = sum(end - start for start, end, parents in inspans)
+    chunksize = max(1, total // max(1, inchunkcount))
+    chunks = []
+    chunk = []
+    size = 0
+    for start, end, parents in inspans:
+        if chunk and chunk[-1][0] == parents:
+            chunk[-1][1].append((start, end))
+        else:
+            chunk.append((parents, [(start, end)]))
+        size += end - start
+        if size >= chunksize:
+            chunks.append(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _convert_chunk(inchunk, insource=None, inprolog=b''):
+    """
+    Преобразование части файла в процессе-обработчике (см. _chunk_records)
+    :rtype: list
+    """
+    return _chunk_records(_WORKER_FLATTENER, inchunk, insource, inprolog)
+
+
+def _chunk_records(inflattener, inchunk, insource=None, inprolog=b''):
+    """
+    Преобразование части файла. Каждая группа фрагментов оборачивается открывающими тегами родителей,
+    поэтому проверка родительских тегов и пространства имен работают как в исходном документе
+    :param inflattener: План преобразования
+    :param inchunk: Список групп (родители, [(начало, конец) или фрагмент в байтах, ...])
+    :param insource: Путь к файлу, из которого читаются фрагменты, заданные смещениями
+    :param inprolog: Объявление XML исходного документа
+    :return: Список плоских словарей в порядке документа
+    :rtype: list
+    """
+    res = []
+    f = open(insource, 'rb') if insource is not None else None
+    try:
+        for parents, spans in inchunk:
+            parts = [inprolog]
+            parts.extend(parents)
+            for span in spans:
+                if isinstance(span, bytes):
+                    parts.append(span)
+                else:
+                    f.seek(span[0])
+                    parts.append(f.read(span[1] - span[0]))
+            for starttag in reversed(parents):
+                parts.append(b'</' + _TAG_RE.match(starttag).group(2) + b'>')
+            parser = _get_parser(inflattener.parser)
+            res.extend(inflattener.records(parser.parse(b''.join(parts)), parser))
+    finally:
+        if f is not None:
+            f.close()
+    return res
+
+
+def xml_to_json_flat_parallel(source, intagname, infields=[], inmaxlevel=0, inuseattrs=True, inskipfirsttag=False,
+                              parser='bs4', workers=None, chunks=None, repeated='first', separator='; '):
+    """
+    Преобразование одного большого XML в несколько процессов. Байты документа просматриваются без разбора,
+    находятся границы тегов intagname, теги делятся на части примерно равного размера, каждая часть
+    обрабатывается отдельным процессом. Результат совпадает с xml_to_json_flat и идет в порядке документа.
+    Файл отображается в память (mmap), процессы-обработчики читают из файла только свои фрагменты
+    :param source: Путь к файлу или XML в байтах (bytes, mmap, memoryview)
+    :param intagname: Наименование тега или путь к тегу tag1/tag2. Пустое значение - тег верхнего уровня
+        и селекторы с *, // и условиями на атрибуты (см. _Selector) обрабатываются в одном процессе
+    :param infields: Список полей, которые должны быть выведены в результате. Пустой список - все поля
+    :param inmaxlevel: Максимальный уровень погружения. 0 - без ограничений
+    :param inuseattrs: Выводить аттрибуты или нет
+    :param inskipfirsttag: Убрать из начала ключа словаря имя искомого тега
+    :param parser: Парсер XML: 'bs4', 'lxml' или 'etree' (lxml и etree в несколько раз быстрее)
+    :param workers: Кол-во процессов. None - по числу ядер
+    :param chunks: Кол-во частей. None - по 4 на процесс
+    :param repeated: Обработка одинаковых соседних тегов (см. xml_to_json_flat)
+    :param separator: Разделитель значений для repeated='join'
+    :return: Список плоских словарей
+    :type source: str|os.PathLike|bytes|mmap.mmap|memoryview
+    :type workers: int
+    :type chunks: int
+    :type repeated: str
+    :type separator: str
+    :rtype: list
+    """
+    options = dict(intagname=intagname, infields=infields, inmaxlevel=inmaxlevel, inuseattrs=inuseattrs,
+                   inskipfirsttag=inskipfirsttag, parser=parser, repeated=repeated, separator=separator)
+    workers = workers or os.cpu_count() or 1
+    path = os.fspath(source) if isinstance(source, (str, os.PathLike)) else None
+    f = None
+    data = source
+    if path is not None:
+        f = open(path, 'rb')
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+    try:
+        encoding, prolog = _xml_encoding(data[:1024])
+        if (not intagname or not _Selector(intagname).simple or data[:2] in (b'\xff\xfe', b'\xfe\xff') or
+                encoding.lower().startswith('utf-16')):
+            # Тег верхнего уровня, селекторы с *, // и условиями и UTF-16 не делятся на части
+            return Flattener(**options).convert(data)
+        spans = list(_scan_records(data, intagname, encoding))
+        chunklist = _split_chunks(spans, chunks or workers * 4)
+        if path is None:
+            # Данные в памяти: процессам передаются только их фрагменты
+            chunklist = [[(parents, [bytes(data[start:end]) for start, end in items]) for parents, items in chunk]
+                         for chunk in chunklist]
+        convert = functools.partial(_convert_chunk, insource=path, inprolog=prolog)
+        records = []
+        if workers == 1 or len(chunklist) <= 1:
+            _init_worker(options)
+            for res in map(convert, chunklist):
+                records.extend(res)
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(options,)) as executor:
+                for res in executor.map(convert, chunklist):
+                    records.extend(res)
+    finally:
+        if f is not None:
+            if not isinstance(data, bytes):
+                data.close()
+            f.close()
+    return _json_fields_sync(records)
+
+
+_CHECKPOINT_VERSION = 1
+_CHECKPOINT_BLOCK = 1 << 16  # Размер начала файла и блока перед смещением, по хэшам которых проверяется файл
+
+
+def _block_hash(indata, instart, inend):
+    """
+    Хэш части данных (blake2b)
+    :rtype: str
+    """
+    return hashlib.blake2b(indata[instart:inend], digest_size=16).hexdigest()
+
+
+def _load_checkpoint(incheckpoint, inoptions):
+    """
+    Контрольная точка из файла. None - файла нет, он поврежден или сохранен с другими параметрами
+    :rtype: dict
+    """
+    if not os.path.exists(incheckpoint):
+        return None
+    try:
+        with open(incheckpoint, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except ValueError:
+        return None
+    if state.get('version') != _CHECKPOINT_VERSION or state.get('options') != inoptions:
+        return None
+    return state
+
+
+def xml_to_json_flat_incremental(source, intagname, checkpoint, infields=[], inmaxlevel=0, inuseattrs=True,
+                                 inskipfirsttag=False, parser='bs4', repeated='first', separator='; '):
+    """
+    Преобразование дописываемого XML (журналы, ленты): возвращаются только записи, появившиеся после
+    предыдущего вызова. После последней полной записи в файл checkpoint сохраняются смещение и открывающие теги
+    ее родителей, следующий вызов просматривает файл с этого места (как xml_to_json_flat_parallel - без разбора
+    всего документа). Незаконченная запись в конце файла остается до следующего вызова.
+    Если файл стал короче смещения, изменилось начало файла или блок перед смещением (файл перезаписан),
+    или изменились параметры - файл обрабатывается с начала
+    Пример:
+        new_records = xml_to_json_flat_incremental('feed.xml', 'feed/record', 'feed.checkpoint.json')
+    :param source: Путь к файлу
+    :param intagname: Наименование тега или путь к тегу tag1/tag2. Селекторы с *, // и условиями на атрибуты
+        и пустое значение не поддерживаются
+    :param checkpoint: Путь к файлу контрольной точки (json)
+    :param infields: Список полей, которые должны быть выведены в результате. Пустой список - все поля
+    :param inmaxlevel: Максимальный уровень погружения. 0 - без ограничений
+    :param inuseattrs: Выводить аттрибуты или нет
+    :param inskipfirsttag: Убрать из начала ключа словаря имя искомого тега
+    :param parser: Парсер XML: 'bs4', 'lxml' или 'etree' (lxml и etree в несколько раз быстрее)
+    :param repeated: Обработка одинаковых соседних тегов (см. xml_to_json_flat)
+    :param separator: Разделитель значений для repeated='join'
+    :return: Список плоских словарей новых записей
+    :type source: str|os.PathLike
+    :type checkpoint: str
+    :rtype: list
+    """
+    if not intagname or not _Selector(intagname).simple:
+        raise ValueError('Для дописываемого XML нужен тег или путь к тегу tag1/tag2: {!r}'.format(intagname))
+    options = dict(intagname=intagname, infields=list(infields), inmaxlevel=inmaxlevel, inuseattrs=inuseattrs,
+                   inskipfirsttag=inskipfirsttag, parser=parser, repeated=repeated, separator=separator)
+    path = os.fspath(source)
+    state = _load_checkpoint(checkpoint, options)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        try:
+            if data[:2] in (b'\xff\xfe', b'\xfe\xff'):
+                raise ValueError('Документы в UTF-16 не поддерживаются')
+            encoding, prolog = _xml_encoding(data[:1024])
+            offset, parents = 0, ()
+            if state is not None:
+                # Файл дописан: совпадают начало и блок перед смещением
+                statoffset = state['offset']
+                if (statoffset <= size and state['encoding'] == encoding and
+                        state['head'] == _block_hash(data, 0, min(statoffset, _CHECKPOINT_BLOCK)) and
+                        state['tail'] == _block_hash(data, max(0, statoffset - _CHECKPOINT_BLOCK), statoffset)):
+                    offset = statoffset
+                    parents = tuple(parent.encode(encoding, 'surrogateescape') for parent in state['parents'])
+            spans = list(_scan_records(data, intagname, encoding, instart=offset, inparents=parents,
+                                       inpartial=True))
+            records = _chunk_records(Flattener(**options), _split_chunks(spans, 1)[0], path, prolog) if spans else []
+            if spans:
+                offset, parents = spans[-1][1], spans[-1][2]
+            # Хэши по уже обработанной части файла: она не меняется при дописывании
+            newstate = {
+                'version': _CHECKPOINT_VERSION,
+                'options': options,
+                'encoding': encoding,
+                'offset': offset,
+                'parents': [parent.decode(encoding, 'surrogateescape') for parent in parents],
+                'head': _block_hash(data, 0, min(offset, _CHECKPOINT_BLOCK)),
+                'tail': _block_hash(data, max(0, offset - _CHECKPOINT_BLOCK), offset),
+            }
+        finally:
+            if not isinstance(data, bytes):
+                data.close()
+    tmppath = '{}.{}.tmp'.format(checkpoint, os.getpid())
+    with open(tmppath, 'w', encoding='utf-8') as fw:
+        json.dump(newstate, fw, ensure_ascii=False, indent=4)
+    os.replace(tmppath, checkpoint)
+    return _json_fields_sync(records)
+
+# Ошибки разбора XML парсерами etree и lxml (bs4 ошибки разбора не выдает)
+_PARSE_ERRORS = (ET.ParseError,) if lxml_etree is None else (ET.ParseError, lxml_etree.XMLSyntaxError)
+
+
+class BoundedResult(object):
+    """
+    Результат xml_to_json_flat_bounded: записи в памяти, а после превышения Limits.maxmemory - во временном
+    файле. При переборе записи отдаются по одной с синхронизированными колонками, в порядке документа.
+    Записи, превысившие ограничения, не выводятся и перечислены в oversized со смещениями в документе
+    Пример:
+        with xml_to_json_flat_bounded('big.xml', 'tag1/tag2', limits=Limits(maxmemory=256 << 20)) as res:
+            write_jsonl(res, 'result.jsonl')
+            for item in res.oversized:
+                print(item['start'], item['end'], item['reason'])
+    """
+
+    def __init__(self, spilldir=None):
+        """
+        :param spilldir: Каталог для временного файла. None - системный каталог временных файлов
+        :type spilldir: str
+        """
+        self.spilldir = spilldir
+        self.oversized = []  # {'start': смещение, 'end': смещение, 'reason': ограничение или 'parse', 'message': текст}
+        self.spilled = 0  # Кол-во записей во временном файле
+        self._fields = {}  # Порядок колонок - порядок первого появления
+        self._records = []
+        self._size = 0  # Примерный размер self._records в байтах
+        self._file = None
+
+    @property
+    def fields(self):
+        """
+        Поля записей в порядке первого появления
+        :rtype: list
+        """
+        return list(self._fields)
+
+    def append(self, inrec, inmaxmemory=0):
+        """
+        Добавление записи. При превышении inmaxmemory записи из памяти выгружаются во временный файл
+        :param inrec: Плоский словарь
+        :param inmaxmemory: Размер записей в памяти в байтах. 0 - без ограничения
+        :type inrec: dict
+        :type inmaxmemory: int
+        """
+        self._fields.update(dict.fromkeys(inrec))
+        self._records.append(inrec)
+        if inmaxmemory:
+            # Ключи общие для всех записей (см. _PathNode), учитываются словарь и значения
+            self._size += sys.getsizeof(inrec) + sum(map(sys.getsizeof, inrec.values()))
+            if self._size >= inmaxmemory:
+                self.spill()
+
+    def spill(self):
+        """
+        Выгрузка записей из памяти во временный файл
+        """
+        if not self._records:
+            return
+        if self._file is None:
+            import tempfile
+            self._file = tempfile.TemporaryFile(dir=self.spilldir)
+        self._file.seek(0, os.SEEK_END)
+        pickle.dump(self._records, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.spilled += len(self._records)
+        self._records = []
+        self._size = 0
+
+    def __len__(self):
+        return self.spilled + len(self._records)
+
+    def __iter__(self):
+        fields = list(self._fields)
+        if self._file is not None:
+            self._file.seek(0)
+            while True:
+                try:
+                    batch = pickle.load(self._file)
+                except EOFError:
+                    break
+                for rec in batch:
+                    yield {fieldname: rec.get(fieldname) for fieldname in fields}
+        for rec in self._records:
+            yield {fieldname: rec.get(fieldname) for fieldname in fields}
+
+    def to_records(self):
+        """
+        Все записи списком (как результат xml_to_json_flat)
+        :rtype: list
+        """
+        return list(self)
+
+    def close(self):
+        """
+        Удаление временного файла
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._records = []
+        self.spilled = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def xml_to_json_flat_bounded(source, intagname, infields=[], inmaxlevel=0, inuseattrs=True, inskipfirsttag=False,
+                             parser='bs4', repeated='first', separator='; ', limits=None):
+    """
+    Преобразование XML с произвольным содержимым с ограничением расхода памяти. Байты документа просматриваются
+    без разбора (как в xml_to_json_flat_parallel), каждый тег intagname разбирается отдельно, поэтому в памяти
+    находится только одна запись. Записи больше limits.maxrecordsize не разбираются, записи глубже
+    limits.maxdepth, с полями сверх limits.maxfields или с ошибкой разбора (reason='parse', например глубже предела
+    libxml2 для parser='lxml') не выводятся: они перечисляются в oversized результата со смещениями в документе,
+    обработка продолжается. Записи сверх limits.maxmemory выгружаются во временный файл
+    :param source: Путь к файлу или XML в байтах (bytes, mmap, memoryview)
+    :param intagname: Наименование тега или путь к тегу tag1/tag2. Селекторы с *, // и условиями на атрибуты
+        и пустое значение не поддерживаются
+    :param infields: Список полей, которые должны быть выведены в результате. Пустой список - все поля
+    :param inmaxlevel: Максимальный уровень погружения. 0 - без ограничений
+    :param inuseattrs: Выводить аттрибуты или нет
+    :param inskipfirsttag: Убрать из начала ключа словаря имя искомого тега
+    :param parser: Парсер XML: 'bs4', 'lxml' или 'etree' (lxml и etree в несколько раз быстрее)
+    :param repeated: Обработка одинаковых соседних тегов (см. xml_to_json_flat)
+    :param separator: Разделитель значений для repeated='join'
+    :param limits: Ограничения (см. Limits). None - без ограничений
+    :return: Записи (см. BoundedResult)
+    :type source: str|os.PathLike|bytes|mmap.mmap|memoryview
+    :type limits: Limits
+    :rtype: BoundedResult
+    """
+    if not intagname or not _Selector(intagname).simple:
+        raise ValueError('Для ограниченной обработки нужен тег или путь к тегу tag1/tag2: {!r}'.format(intagname))
+    if limits is None:
+        limits = Limits()
+    flattener = Flattener(intagname, infields=infields, inmaxlevel=inmaxlevel, inuseattrs=inuseattrs,
+                          inskipfirsttag=inskipfirsttag, parser=parser, repeated=repeated, separator=separator,
+                          limits=limits)
+    result = BoundedResult(limits.spilldir)
+    path = os.fspath(source) if isinstance(source, (str, os.PathLike)) else None
+    f = None
+    data = source
+    if path is not None:
+        f = open(path, 'rb')
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+    try:
+        if data[:2] in (b'\xff\xfe', b'\xfe\xff'):
+            raise ValueError('Документы в UTF-16 не поддерживаются')
+        encoding, prolog = _xml_encoding(data[:1024])
+        maxrecordsize = limits.maxrecordsize
+        for start, end, parents in _scan_records(data, intagname, encoding):
+            try:
+                if maxrecordsize and end - start > maxrecordsize:
+                    raise LimitExceeded('size', 'Размер записи больше {} байт'.format(maxrecordsize))
+                records = _chunk_records(flattener, [(parents, [bytes(data[start:end])])], None, prolog)
+            except LimitExceeded as e:
+                result.oversized.append({'start': start, 'end': end, 'reason': e.reason, 'message': str(e)})
+                continue
+            except _PARSE_ERRORS as e:
+                # Запись, которую не разобрал парсер (например глубже предела libxml2), пропускается как и
+                # превысившие ограничения
+                result.oversized.append({'start': start, 'end': end, 'reason': 'parse',
+                                         'message': '{}: {}'.format(type(e).__name__, e)})
+                continue
+            for rec in records:
+                result.append(rec, limits.maxmemory)
+    except BaseException:
+        result.close()
+        raise
+    finally:
+        if f is not None:
+            if not isinstance(data, bytes):
+                data.close()
+            f.close()
+    return result
+
+_ASYNC_READ_SIZE = 1 << 16  # Размер части при чтении асинхронного потока
+_ASYNC_OFFLOAD_SIZE = 1 << 20  # Документы от этого размера AsyncConverter.convert обрабатывает в пуле процессов,
+# меньшие - в пуле потоков
+
+
+async def _aiter_chunks(stream, insize=_ASYNC_READ_SIZE):
+    """
+    Части XML из асинхронного источника
+    :param stream: Объект с методом async read(n) (asyncio.StreamReader), асинхронный итератор частей
+        в байтах или XML в байтах
+    :param insize: Размер части для read
+    :rtype: async_generator
+    """
+    if isinstance(stream, (bytes, bytearray, memoryview)):
+        for chunk in _iter_xml_chunks(memoryview(stream), insize):
+            yield chunk
+    elif hasattr(stream, 'read'):
+        while True:
+            chunk = await stream.read(insize)
+            if not chunk:
+                break
+            yield chunk
     else:
-        tags = soup.contents
-        parenttags = []
+        async for chunk in stream:
+            if chunk:
+                yield chunk
 
-    json_list = _get_records(tags, inparenttags=parenttags, infields=infields, inmaxlevel=inmaxlevel,
-                             inuseattrs=inuseattrs, inskipfirsttag=inskipfirsttag)
-    json_list = _json_fields_sync(json_list)
-    return json_list
 
+async def _aiter_event_records(stream, inplans, inparentkey=False, inchunksize=_ASYNC_READ_SIZE):
+    """
+    Записи из асинхронного источника: части XML передаются в XMLPullParser по мере получения,
+    записи отдаются сразу после закрытия тега (см. _event_records)
+    :rtype: async_generator
+    """
+    pullparser = ET.XMLPullParser(events=('start-ns', 'start', 'end'))
+    closed = False
 
-def main():
-    os.chdir(os.path.dirname(__file__))
-    #intagname = 'tag2'  # Ищем все теги tag2 независимо в какие родительские теги он входит
-    intagname: str = 'tag1/tag2'  # Ищем теги с именем tag2, который вложен в тег tag1
-    #intagname = ''
-    #infields = ['tag1_tag2_item1', 'tag1_tag2_itemlist_item3']
-    infields = []
+    def events():
+        while True:
+            yield from pullparser.read_events()
+            if closed:
+                return
+            yield _NEED_DATA
 
-    with open(r'xml_examples/example01.xml', 'r', encoding='utf-8') as f:
-    #with open(r'xml_examples/asfzd_sogl.xml', 'r', encoding='utf-8') as f:
-        inxml = f.read()
+    records = _event_records(events(), inplans, inparentkey=inparentkey)
+    chunks = _aiter_chunks(stream, inchunksize)
+    while not closed:
+        try:
+            pullparser.feed(await chunks.__anext__())
+        except StopAsyncIteration:
+            pullparser.close()
+            closed = True
+        for item in records:
+            if item is None:
+                break
+            yield item
+        # Разбор каждой части занимает цикл событий ненадолго, между частями выполняются другие задачи
+        await asyncio.sleep(0)
 
-    json_list = xml_to_json_flat(inxml, intagname, infields=infields, inmaxlevel=0, inuseattrs=True, inskipfirsttag=True)
 
-    pprint(json_list)
-    
-    with open(r'xml_examples/example01a.json', 'w') as fw:
-        json.dump(json_list, fw, ensure_ascii=False, indent=4, sort_keys=True)
+async def aiter_xml_to_json_flat(stream, intagname, infields=[], inmaxlevel=0, inuseattrs=True, inskipfirsttag=False,
+                                 repeated='first', separator='; ', chunksize=_ASYNC_READ_SIZE):
+    """
+    Асинхронный вариант iter_xml_to_json_flat: XML читается из асинхронного потока по частям и передается
+    в потоковый парсер (XMLPullParser), записи отдаются асинхронным итератором по мере разбора.
+    Следующая часть читается только когда получены записи из предыдущей
+    Пример:
+        reader, writer = await asyncio.open_connection(host, port)
+        async for rec in aiter_xml_to_json_flat(reader, 'tag1/tag2'):
+            ...
+    :param stream: Объект с методом async read(n) (asyncio.StreamReader), асинхронный итератор частей
+        в байтах или XML в байтах
+    :param intagname: Наименование тега, путь к тегу tag1/tag2 или селектор (см. _Selector).
+        Пустое значение - тег верхнего уровня
+    :param infields: Список полей, которые должны быть выведены в результате. Пустой список - все поля
+    :param inmaxlevel: Максимальный уровень погружения. 0 - без ограничений
+    :param inuseattrs: Выводить аттрибуты или нет
+    :param inskipfirsttag: Убрать из начала ключа словаря имя искомого тега
+    :param repeated: Обработка одинаковых соседних тегов (см. xml_to_json_flat)
+    :param separator: Разделитель значений для repeated='join'
+    :param chunksize: Размер части при чтении из stream
+    :return: Асинхронный генератор плоских словарей (колонки не синхронизируются)
+    :type stream: asyncio.StreamReader|collections.abc.AsyncIterable|bytes
+    :type chunksize: int
+    :rtype: async_generator
+    """
+    flattener = Flattener(intagname, infields=infields, inmaxlevel=inmaxlevel, inuseattrs=inuseattrs,
+                          inskipfirsttag=inskipfirsttag, repeated=repeated, separator=separator)
+    async for name, rec in _aiter_event_records(stream, [(None, flattener, None)], inchunksize=chunksize):
+        yield rec
+
+
+async def aiter_xml_to_json_flat_multi(stream, inselectors, parentkey=False, chunksize=_ASYNC_READ_SIZE):
+    """
+    Асинхронный вариант iter_xml_to_json_flat_multi
+    :param stream: Асинхронный поток (см. aiter_xml_to_json_flat)
+    :param inselectors: Словарь имя набора -> селектор или словарь параметров (см. xml_to_json_flat_multi)
+    :param parentkey: Добавить в записи ключи _id, _parent, _parent_id (см. xml_to_json_flat_multi)
+    :param chunksize: Размер части при чтении из stream
+    :return: Асинхронный генератор (имя набора, запись)
+    :rtype: async_generator
+    """
+    async for item in _aiter_event_records(stream, _multi_plans(inselectors), inparentkey=parentkey,
+                                           inchunksize=chunksize):
+        yield item
+
+
+def _convert_options(inxml, intagname, inoptions):
+    """
+    xml_to_json_flat в процессе пула AsyncConverter
+    :rtype: list|Columns
+    """
+    return xml_to_json_flat(inxml, intagname, **inoptions)
+
+
+class AsyncConverter(object):
+    """
+    Асинхронное преобразование для сервисов на asyncio: не больше concurrency преобразований одновременно
+    (остальные ждут своей очереди). Преобразование не выполняется в цикле событий: большие документы
+    обрабатываются в пуле из workers процессов, остальные - в пуле потоков
+    Пример:
+        async with AsyncConverter(workers=4, concurrency=8) as converter:
+            res = await converter.convert(payload, 'tag1/tag2', parser='lxml')
+            async for rec in converter.iter_records(reader, 'tag1/tag2'):
+                ...
+    """
+
+    def __init__(self, workers=None, concurrency=None, offloadsize=_ASYNC_OFFLOAD_SIZE):
+        """
+        :param workers: Кол-во процессов пула. None - по числу ядер
+        :param concurrency: Кол-во одновременных преобразований. None - равно workers
+        :param offloadsize: Размер документа (байт или символов), начиная с которого convert выполняется в пуле
+            процессов. Документы меньше - в пуле потоков цикла событий (цикл не останавливается, но из-за GIL
+            преобразования в потоках не выполняются параллельно). None - всегда в потоках
+        :type workers: int
+        :type concurrency: int
+        :type offloadsize: int
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.concurrency = concurrency or self.workers
+        self.offloadsize = offloadsize
+        self._semaphore = None  # Создается в работающем цикле событий
+        self._executor = None  # Пул создается при первом большом документе
+
+    def _limit(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def convert(self, inxml, intagname, **options):
+        """
+        Преобразование XML целиком (как xml_to_json_flat)
+        :param inxml: XML текст или байты
+        :param intagname: Наименование тега, путь к тегу или селектор
+        :param options: Параметры xml_to_json_flat (infields, parser, output, repeated, ...)
+        :type inxml: str|bytes
+        :type intagname: str
+        :rtype: list|Columns
+        """
+        async with self._limit():
+            loop = asyncio.get_running_loop()
+            if self.offloadsize is None or len(inxml) < self.offloadsize:
+                # Небольшие документы - в потоке, без передачи XML и результата в другой процесс
+                return await loop.run_in_executor(None, functools.partial(xml_to_json_flat, inxml, intagname,
+                                                                          **options))
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return await loop.run_in_executor(self._executor, _convert_options, inxml, intagname, options)
+
+    async def iter_records(self, stream, intagname, **options):
+        """
+        Записи из асинхронного потока по мере разбора (см. aiter_xml_to_json_flat), с учетом concurrency
+        :param stream: Асинхронный поток
+        :param intagname: Наименование тега, путь к тегу или селектор
+        :param options: Параметры aiter_xml_to_json_flat (infields, repeated, chunksize, ...)
+        :rtype: async_generator
+        """
+        async with self._limit():
+            async for rec in aiter_xml_to_json_flat(stream, intagname, **options):
+                yield rec
+
+    async def close(self):
+        """
+        Остановка пула процессов
+        """
+        if self._executor is not None:
+            executor, self._executor = self._executor, None
+            await asyncio.get_running_loop().run_in_executor(None, executor.shutdown)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+def main(argv=None):
+    """
+    Командная строка: python -m xml_to_json_flat FILES -t tag1/tag2 [-o result.jsonl | -d outdir]
+    :return: Код возврата: 0 - все файлы обработаны, 1 - есть ошибки
+    :rtype: int
+    """
+    argparser = argparse.ArgumentParser(prog='python -m xml_to_json_flat',
+                                        description='Преобразование XML в плоский вид json')
+    argparser.add_argument('paths', nargs='+', help='XML файлы, маски или каталоги')
+    argparser.add_argument('-t', '--tagname', default='', help='Тег или путь к тегу tag1/tag2')
+    argparser.add_argument('-f', '--fields', action='append', default=[],
+                           help='Поле результата (можно несколько или через запятую)')
+    argparser.add_argument('--maxlevel', type=int, default=0, help='Максимальный уровень погружения')
+    argparser.add_argument('--no-attrs', action='store_true', help='Не выводить атрибуты')
+    argparser.add_argument('--skip-first-tag', action='store_true', help='Убрать из ключей имя искомого тега')
+    argparser.add_argument('--parser', default='bs4', choices=sorted(PARSERS), help='Парсер XML')
+    argparser.add_argument('--repeated', default='first', choices=list(REPEATED_MODES),
+                           help='Одинаковые соседние теги: first, index, join, explode')
+    argparser.add_argument('--separator', default='; ', help='Разделитель значений для --repeated join')
+    argparser.add_argument('--format', default='jsonl', choices=sorted(OUTPUT_FORMATS), help='Формат результата')
+    argparser.add_argument('--schema', help='Файл схемы (см. discover_schema): колонки результата')
+    argparser.add_argument('-o', '--output', help='Общий файл результата. По умолчанию stdout')
+    argparser.add_argument('-d', '--output-dir', help='Каталог для результата по каждому файлу')
+    argparser.add_argument('-j', '--workers', type=int, default=None, help='Кол-во процессов (по числу ядер)')
+    argparser.add_argument('--chunksize', type=int, default=1, help='Кол-во файлов на процесс за раз')
+    argparser.add_argument('--profile', metavar='FILE',
+                           help='Профилировать обработку (в одном процессе): дамп cProfile в FILE '
+                                '(см. python -m pstats FILE), статистика по этапам - в stderr')
+    args = argparser.parse_args(argv)
+
+    if args.profile:
+        import cProfile
+        stats = ConversionStats()
+        profiler = cProfile.Profile()
+        try:
+            res = profiler.runcall(_main, args, stats)
+        finally:
+            profiler.dump_stats(args.profile)
+            print(stats.report(), file=sys.stderr)
+            print('Профиль сохранен: {}'.format(args.profile), file=sys.stderr)
+        return res
+    return _main(args)
+
+
+def _main(args, instats=None):
+    """
+    Обработка файлов по разобранным параметрам командной строки (см. main)
+    :param args: Параметры командной строки
+    :param instats: Статистика по этапам. Если задана, файлы обрабатываются в текущем процессе
+    :rtype: int
+    """
+    fields = [field for item in args.fields for field in item.split(',') if field]
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    results = convert_files(args.paths, args.tagname, infields=fields, inmaxlevel=args.maxlevel,
+                            inuseattrs=not args.no_attrs, inskipfirsttag=args.skip_first_tag, parser=args.parser,
+                            outputdir=args.output_dir, outputformat=args.format, workers=args.workers,
+                            chunksize=args.chunksize, repeated=args.repeated, separator=args.separator,
+                            stats=instats)
+    errors = []
+
+    def merged():
+        # Записи всех файлов по мере готовности
+        for path, res, error in results:
+            if error:
+                errors.append(path)
+                print('ОШИБКА {}: {}'.format(path, error), file=sys.stderr)
+            elif not args.output_dir:
+                for rec in res:
+                    yield rec
+
+    output = args.output
+    if output is None:
+        # parquet - двоичный формат, пишется в байтовый поток stdout
+        output = sys.stdout.buffer if args.format == 'parquet' else sys.stdout
+    columns = load_schema(args.schema) if args.schema else fields
+    if args.output_dir:
+        for rec in merged():
+            pass
+    elif args.format == 'jsonl' or (args.format in ('csv', 'parquet') and columns):
+        # Запись сразу, без накопления результата. Без -f/--schema строки jsonl содержат только найденные поля
+        _write_records(merged(), output, args.format, infields=columns)
+    else:
+        # Колонки неизвестны заранее: записи синхронизируются после обработки всех файлов
+        _write_records(_json_fields_sync(list(merged())), output, args.format)
+    return 1 if errors else 0
 
 
 if __name__ == '__main__':
-    #test_check_parent()
-    main()
\ No newline at end of file
+    sys.exit(main())
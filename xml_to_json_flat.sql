@@ -1,3 +1,169 @@
+CREATE OR REPLACE FUNCTION public._xml_to_json_flat_init()
+  RETURNS void AS
+
+$BODY$
+    """ Загрузка модулей и вспомогательных функций xml_to_json_flat в GD.
+        Выполняется один раз на сессию при первом вызове xml_to_json_flat, xml_to_json_flat_rows
+        или xml_to_json_flat_table. Повторный вызов пересоздает функции (например после обновления скрипта)
+    """
+    import json
+    from bs4 import BeautifulSoup
+    from bs4.element import Tag
+
+    class PathNode(object):
+        """
+        Узел плана преобразования: путь к тегу внутри записи с заранее вычисленными ключами
+        """
+        __slots__ = ('preffix', 'key', 'children', 'attrkeys', 'infields', 'usetext')
+
+        def __init__(self, inpreffix, infields, infieldpreffixes):
+            self.preffix = inpreffix  # Префикс в том виде, в котором он сверяется с infields
+            self.key = inpreffix.lstrip(' _')  # Ключ в результирующем словаре
+            self.children = {}  # Имя дочернего тега -> PathNode
+            self.attrkeys = {}  # Имя атрибута -> ключ в результирующем словаре
+            self.infields = not infields or inpreffix in infields  # Значение тега попадает в результат
+            self.usetext = not infields or inpreffix in infieldpreffixes  # В поддереве есть поля из infields
+
+    class Flattener(object):
+        """
+        Скомпилированный план преобразования (см. Flattener в xml_to_json_flat.py).
+        Создается один раз для набора параметров, ключи записей вычисляются один раз для каждого пути
+        """
+
+        def __init__(self, intagname, infields=[], inmaxlevel=0, inuseattrs=True, inskipfirsttag=False, inmaxdepth=0,
+                     inmaxfields=0):
+            self.fields = list(infields)
+            self.inmaxlevel = inmaxlevel
+            self.inuseattrs = inuseattrs
+            self.inskipfirsttag = inskipfirsttag
+            self.inmaxdepth = inmaxdepth  # Ограничения (0 - без ограничения), при превышении - plpy.error
+            self.inmaxfields = inmaxfields
+            if intagname:
+                tagnamesplit = intagname.split('/')
+                self.tagname = tagnamesplit[-1]
+                self.parenttags = tagnamesplit[:-1]
+            else:
+                self.tagname = None
+                self.parenttags = []
+            self.preffix = '_'.join(self.parenttags) + '_' if self.parenttags else ''
+            self._fields = frozenset(infields)
+            fieldpreffixes = set(self._fields)
+            for field in self._fields:
+                pos = field.find('_')
+                while pos != -1:
+                    fieldpreffixes.add(field[:pos])
+                    pos = field.find('_', pos + 1)
+            self._fieldpreffixes = frozenset(fieldpreffixes)
+            self._roots = {}
+
+        def _path(self, inpreffix):
+            path = self._roots.get(inpreffix)
+            if path is None:
+                path = self._roots[inpreffix] = PathNode(inpreffix, self._fields, self._fieldpreffixes)
+            return path
+
+        def flatten(self, inxmlobj):
+            inmaxlevel = self.inmaxlevel
+            inuseattrs = self.inuseattrs
+            inmaxdepth = self.inmaxdepth
+            fields = self._fields
+            fieldpreffixes = self._fieldpreffixes
+            data = {}
+
+            if self.inskipfirsttag:
+                path = self._path('')
+            else:
+                path = self._path(self.preffix + inxmlobj.name)
+            # Обход без рекурсии: (тег, путь, уровень), уровень 0 - атрибуты тега после его поддерева
+            stack = [(inxmlobj, path, 1)]
+            while stack:
+                inxmlobj, inpath, level = stack.pop()
+                if level:
+                    items = inxmlobj.find_all(recursive=False)
+                    if items:
+                        if inmaxlevel == 0 or inmaxlevel >= level:
+                            if inmaxdepth and level >= inmaxdepth:
+                                plpy.error('xml_to_json_flat: глубина записи больше {} (inmaxdepth)'.format(inmaxdepth))
+                            if inuseattrs:
+                                stack.append((inxmlobj, inpath, 0))
+                            pathchildren = inpath.children
+                            pending = []
+                            for item in items:
+                                itempath = pathchildren.get(item.name)
+                                if itempath is None:
+                                    itempath = pathchildren[item.name] = PathNode(inpath.preffix + '_' + item.name,
+                                                                                  fields, fieldpreffixes)
+                                if itempath.usetext or inuseattrs:
+                                    pending.append((item, itempath, level + 1))
+                            pending.reverse()
+                            stack.extend(pending)
+                            continue
+                    elif inpath.infields and inpath.preffix not in data:  # Добавлять только если данных нет
+                        data[inpath.key] = inxmlobj.text
+                if inuseattrs and inxmlobj.attrs:
+                    attrkeys = inpath.attrkeys
+                    for attr in inxmlobj.attrs:
+                        key = attrkeys.get(attr)
+                        if key is None:
+                            key = attrkeys[attr] = '{}_attr_{}'.format(inpath.preffix, attr).lstrip(' _')
+                        data[key] = inxmlobj.attrs[attr]
+            if self.inmaxfields and len(data) > self.inmaxfields:
+                plpy.error('xml_to_json_flat: полей в записи больше {} (inmaxfields)'.format(self.inmaxfields))
+            return data
+
+        def check_parent(self, inxmlobj):
+            parenttag = inxmlobj.parent
+            for parenttagname in self.parenttags[::-1]:
+                if parenttag is not None and parenttag.name == parenttagname:
+                    parenttag = parenttag.parent
+                else:
+                    return False
+            return True
+
+        def records(self, inxml, inmaxsize=0):
+            """ Плоские записи по одной, без синхронизации колонок. inmaxsize - наибольшая длина XML в символах """
+            if inmaxsize and len(inxml) > inmaxsize:
+                plpy.error('xml_to_json_flat: длина XML {} больше {} (inmaxsize)'.format(len(inxml), inmaxsize))
+            soup = BeautifulSoup(inxml, 'xml')
+            if self.tagname is None:
+                tags = [item for item in soup.contents if isinstance(item, Tag)]
+            else:
+                tags = soup.find_all(self.tagname)
+            for item in tags:
+                if self.check_parent(item):
+                    yield self.flatten(item)
+
+    def json_fields_sync(inlist):
+        """ Синхронизация колонок (приведение к одинаковому количеству во всех строках) """
+        fields = {}
+        for rec in inlist:
+            fields.update(dict.fromkeys(rec))
+        return [{fieldname: rec.get(fieldname) for fieldname in fields} for rec in inlist]
+
+    plans = {}
+
+    def get_plan(intagname, infields, inmaxlevel, inuseattrs, inskipfirsttag, inmaxdepth=0, inmaxfields=0):
+        """ План преобразования из кэша. infields - текст jsonb, разбирается только при создании плана """
+        key = (intagname, infields, inmaxlevel, inuseattrs, inskipfirsttag, inmaxdepth, inmaxfields)
+        plan = plans.get(key)
+        if plan is None:
+            if len(plans) >= 100:
+                plans.clear()
+            plan = plans[key] = Flattener(intagname, json.loads(infields) if infields else [], inmaxlevel or 0,
+                                          inuseattrs, inskipfirsttag, inmaxdepth or 0, inmaxfields or 0)
+        return plan
+
+    GD['xml_to_json_flat'] = {
+        'dumps': json.dumps,
+        'get_plan': get_plan,
+        'json_fields_sync': json_fields_sync,
+    }
+$BODY$
+  LANGUAGE plpython3u VOLATILE
+  COST 100;
+
+
+
 CREATE OR REPLACE FUNCTION public.xml_to_json_flat(
     inxml text,
     intagname character varying,
@@ -8,7 +174,7 @@ CREATE OR REPLACE FUNCTION public.xml_to_json_flat(
   RETURNS jsonb AS
 
 $BODY$
-    """ Получение из xml списка элементов по тегу tagname в виде json 
+    """ Получение из xml списка элементов по тегу tagname в виде json
         inxml - Текст XML
         intagname - Тег, который необходимо найти в XML
         infields - Поля в виде json. Если передан NULL, то возвращаются все найденные поля
@@ -18,189 +184,215 @@ $BODY$
     Использование:
     SELECT value->>'tag2_item1' AS item1, value->>'tag2_item2' AS item2 FROM jsonb_array_elements(
         xml_to_json_flat(inxml, 'tag2', '["tag2_item1","tag2_item2"]'::jsonb, 0)
-    ) 
+    )
     SELECT value->>'tag2_item1' AS item1, value->>'tag2_item2' AS item2 FROM jsonb_array_elements(
         xml_to_json_flat(inxml, 'tag2')
-    ) 
+    )
+    Модули и план преобразования кэшируются в GD (см. _xml_to_json_flat_init)
+    """
+    if 'xml_to_json_flat' not in GD:
+        plpy.execute('SELECT public._xml_to_json_flat_init()')
+    lib = GD['xml_to_json_flat']
+
+    if inxml is None:
+        return None
+    plan = lib['get_plan'](intagname, infields, inmaxlevel, inuseattrs, inskipfirsttag)
+    res = lib['json_fields_sync'](list(plan.records(inxml)))
+
+    # Если тег не нашелся, возвращаем NULL
+    if not res:
+        return None
+
+    res = lib['dumps'](res, ensure_ascii=False, sort_keys=True)
+    #plpy.info(res)
+
+    return res
+$BODY$
+  LANGUAGE plpython3u VOLATILE
+  COST 100;
+
+
 
+CREATE OR REPLACE FUNCTION public.xml_to_json_flat_rows(
+    inxml text,
+    intagname character varying,
+    infields jsonb DEFAULT '[]'::jsonb,
+    inmaxlevel integer DEFAULT 0,
+    inuseattrs boolean DEFAULT true,
+    inskipfirsttag boolean DEFAULT false)
+  RETURNS SETOF jsonb AS
+
+$BODY$
+    """ Получение из xml элементов по тегу tagname: одна строка jsonb на элемент.
+        Параметры как у xml_to_json_flat. Записи отдаются по одной, без общего массива jsonb.
+        Колонки не синхронизируются: отсутствующие поля не выводятся (value->>'поле' вернет NULL)
+    Использование:
+    SELECT value->>'tag2_item1' AS item1, value->>'tag2_item2' AS item2 FROM xml_to_json_flat_rows(inxml, 'tag2') AS value
     """
-    import json
-    from bs4 import BeautifulSoup
-    
-    def _xmlobj_to_jsonobj_flat(inxmlobj, inpreffix='', infields=[], inmaxlevel=0, inuseattrs=True, inskipfirsttag=False):
-        """
-        Получение одной плоской записи из тега
-        Пример XML: <parent1><parent2><item1>123</item1></parent2><parent21>456</parent21></parent1>
-        Результат при передаче тега parent1: {"parent1_parent2_item1": "123", "parent1_parent21": "456"}
-        :param inxmlobj: XML-тег
-        :type inxmlobj: bs4.element.Tag
-        :param inpreffix: Строка префикса для json поля
-        :type inpreffix: str
-        :param infields: Список наименований полей которые должны быть в результате. Пустой список - все поля
-        :type infields: list
-        :param inmaxlevel: Максимальное кол-во погружения в xml
-        :type inmaxlevel: int
-        :param inuseattrs: Выводить аттрибуты или нет
-        :type inuseattrs: bool
-        :param inskipfirsttag: Убрать из начала ключа словаря имя искомого тега
-        :type inskipfirsttag: bool
-        :return: Плоский словарь с полями из имен тегов через _
-        :rtype: dict
-        """
-        # Получаем json из одного тега в плоском виде
-        data = {}
-        def get_json_rec(inxmlobj, inpreffix, level):
-            if inxmlobj.findChildren(recursive=False):
-                if inmaxlevel == 0 or inmaxlevel >= level:
-                    for item in inxmlobj.findChildren(recursive=False):
-                        get_json_rec(item, inpreffix + '_'+item.name, level+1)
-            else:
-                if inpreffix not in data:  # Добавлять только если данных нет
-                    if not infields or inpreffix in infields:  # Добавлять только если поле есть в infields
-                        key = inpreffix.lstrip(' _')
-                        data[key] = inxmlobj.text
-            if inuseattrs and inxmlobj.attrs:
-                for attr in inxmlobj.attrs:
-                    key = '{}_attr_{}'.format(inpreffix, attr).lstrip(' _')
-                    data[key] = inxmlobj.attrs[attr]
-        if inskipfirsttag:
-            get_json_rec(inxmlobj, '', 1)
-        else:
-            get_json_rec(inxmlobj, inpreffix + inxmlobj.name, 1)
-        return data
-
-
-    def _check_parent(inxmlobj, inparenttags):
-        """
-        Проверка что тег inxmlobj вложен в родительские теги inparenttags
-        Пример XML: <parent1><parent2><item1>123</item1></parent2><parent21>456</parent21></parent1>
-        Результат при передаче тега item1, inparenttags='parent1/parent2': True
-        :param inxmlobj: XML-тег
-        :type inxmlobj: bs4.element.Tag
-        :param inparenttags: Родительские теги в виде списка или текста разделенного слэшами /
-        :type inparenttags: str|list
-        :return: Тег inxmlobj вложен в родительские теги inparenttags
-        :rtype: bool
-        """
+    if 'xml_to_json_flat' not in GD:
+        plpy.execute('SELECT public._xml_to_json_flat_init()')
+    lib = GD['xml_to_json_flat']
 
-        if type(inparenttags) == str:
-            if inparenttags:
-                inparenttags = inparenttags.split('/') # Приводим inparenttags к списку, если передана строка
-            else:
-                inparenttags = []
-        parenttag = inxmlobj.parent
-        for parenttagname in inparenttags[::-1]:
-            if parenttag and parenttag.name == parenttagname:
-                parenttag = parenttag.parent
-            else:
-                return False
-        return True
+    if inxml is None:
+        return
+    plan = lib['get_plan'](intagname, infields, inmaxlevel, inuseattrs, inskipfirsttag)
+    dumps = lib['dumps']
+    for rec in plan.records(inxml):
+        yield dumps(rec, ensure_ascii=False, sort_keys=True)
+$BODY$
+  LANGUAGE plpython3u VOLATILE
+  COST 100
+  ROWS 100;
 
 
-    def _get_records(xml_item_list, inparenttags=[], infields=[], inmaxlevel=0, inuseattrs=True, inskipfirsttag=False):
-        """
-        Получение записей c проверкой на соответствие переданным родительским тегам
-        :param xml_item_list: Список XML-объектов, которые необходимо преобразовать в JSON
-        :param inparenttags: Список родительских тегов которые должен иметь рассматриваемый тег
-        :param infields: Список имен полей, которые должны попасть в результат
-        :param inmaxlevel: Максимальный уровень погружения. 0 - без ограничений
-        :param inuseattrs: Добавлять данные из атрибутов
-        :param inskipfirsttag: Убрать из начала ключа словаря имя искомого тега
-        :return: Список плоских словарей с данными
-        :type xml_item_list: list
-        :type inparenttags: list
-        :type infields: list
-        :type inmaxlevel: int
-        :type inuseattrs: bool
-        :type inskipfirsttag: bool
-        :rtype: list
-        """
-        res = []
-        for item in xml_item_list:
-            # Проверяем соответствуют ли родительские теги переданным
-            if _check_parent(item, inparenttags):
-                preffix = ''
-                if inparenttags:
-                    preffix = '_'.join(inparenttags) + '_'
-                rec = _xmlobj_to_jsonobj_flat(item, preffix, infields=infields, inmaxlevel=inmaxlevel,
-                                              inuseattrs=inuseattrs, inskipfirsttag=inskipfirsttag)
-                res.append(rec)
-        return res
-
-
-    def _json_fields_sync(inlist):
-        """
-        Синхронизация колонок (приведение к одинаковому количеству во всех строках)
-        :param inlist: Список словарей
-        :return: Список словарей с одинаковым кол-вом ключей
-        :type inlist: list
-        :rtype: list
-        """
 
-        res = []
-        fields = set()
-        for rec in inlist:
-            fields.update(rec.keys())
-        for rec in inlist:
-            new_rec = {}
-            for fieldname in fields:
-                if fieldname in rec:
-                    new_rec[fieldname] = rec[fieldname]
-                else:
-                    new_rec[fieldname] = None
-            res.append(new_rec)
-        return res
+CREATE OR REPLACE FUNCTION public.xml_to_json_flat_table(
+    inxml text,
+    intagname character varying,
+    infields jsonb,
+    inmaxlevel integer DEFAULT 0,
+    inuseattrs boolean DEFAULT true,
+    inskipfirsttag boolean DEFAULT false)
+  RETURNS SETOF record AS
 
+$BODY$
+    """ Получение из xml элементов по тегу tagname в виде таблицы. Колонки - поля из infields в том же порядке
+        (в том числе поля атрибутов), типы колонок задаются при вызове
+    Использование:
+    SELECT * FROM xml_to_json_flat_table(inxml, 'tag2', '["tag2_item1","tag2_item3_attr_prop2"]'::jsonb)
+        AS t(item1 text, item3prop text)
+    """
+    if 'xml_to_json_flat' not in GD:
+        plpy.execute('SELECT public._xml_to_json_flat_init()')
+    lib = GD['xml_to_json_flat']
 
-    def xml_to_json_flat(inxml, intagname, infields=[], inmaxlevel=0, inuseattrs=True, inskipfirsttag=False):
-        """
-        Основная функция принимает XML в виде текста. Ищет теги с именем intagname и выводит список
-            найденного в виде плоского словаря
-        Внимание: Если внутри тега есть несколько рядом стоящих одинаковых тегов, то будет использован только первый
-        :param inxm: XML текст
-        :param intagname: Наименование тега, список которых необходимо найти в xml. Если значение пустое, использовать
-            тег верхнего уровня
-        :param infields: Список полей, которые должны быть выведены в результате. Пустой список - все поля
-        :param inmaxlevel: Максимальный уровень погружения. 0 - без ограничений
-        :param inuseattrs: Выводить аттрибуты или нет
-        :param inskipfirsttag: Убрать из начала ключа словаря имя искомого тега
-        :return: Список json строк
-        :type intagname: str
-        :type infields: list
-        :type inmaxlevel: int
-        :type inuseattrs: bool
-        :type inxm: str
-        :type inskipfirsttag: bool
-        :rtype: list
-        """
-        soup = BeautifulSoup(inxml, 'xml')
-        if intagname:
-            # Разделяем parent-тег
-            tagnamesplit = intagname.split('/')
-            tagname = tagnamesplit[-1]
-            parenttags = tagnamesplit[:-1]
-            tags = soup.find_all(tagname)  # Список тегов
-        else:
-            tags = soup.contents
-            parenttags = []
-
-        json_list = _get_records(tags, inparenttags=parenttags, infields=infields, inmaxlevel=inmaxlevel,
-                                 inuseattrs=inuseattrs, inskipfirsttag=inskipfirsttag)
-        json_list = _json_fields_sync(json_list)
-        return json_list
-
-
-    fields = json.loads(infields)
-    res = xml_to_json_flat(inxml, intagname, infields=fields, inmaxlevel=inmaxlevel, inuseattrs=inuseattrs, inskipfirsttag=inskipfirsttag)
+    if inxml is None:
+        return
+    plan = lib['get_plan'](intagname, infields, inmaxlevel, inuseattrs, inskipfirsttag)
+    fields = plan.fields
+    for rec in plan.records(inxml):
+        yield [rec.get(fieldname) for fieldname in fields]
+$BODY$
+  LANGUAGE plpython3u VOLATILE
+  COST 100
+  ROWS 100;
+
+
+
+
+CREATE OR REPLACE FUNCTION public.xml_to_json_flat(
+    inxml text,
+    intagname character varying,
+    infields jsonb,
+    inmaxlevel integer,
+    inuseattrs boolean,
+    inskipfirsttag boolean,
+    inmaxdepth integer,
+    inmaxfields integer,
+    inmaxsize integer)
+  RETURNS jsonb AS
+
+$BODY$
+    """ xml_to_json_flat с ограничениями, чтобы документ не исчерпал память процесса. Все параметры обязательны
+        (перегрузка без значений по умолчанию, вызовы с 2-6 параметрами выполняет xml_to_json_flat без ограничений)
+        inmaxdepth - Максимальная глубина записи
+        inmaxfields - Максимальное кол-во полей в записи
+        inmaxsize - Максимальная длина XML в символах
+        При превышении - ошибка. 0 - без ограничения
+    Использование:
+    SELECT value->>'tag2_item1' AS item1 FROM jsonb_array_elements(
+        xml_to_json_flat(inxml, 'tag2', '[]'::jsonb, 0, true, false, 256, 10000, 52428800)
+    )
+    """
+    if 'xml_to_json_flat' not in GD:
+        plpy.execute('SELECT public._xml_to_json_flat_init()')
+    lib = GD['xml_to_json_flat']
+
+    if inxml is None:
+        return None
+    plan = lib['get_plan'](intagname, infields, inmaxlevel, inuseattrs, inskipfirsttag, inmaxdepth, inmaxfields)
+    res = lib['json_fields_sync'](list(plan.records(inxml, inmaxsize)))
 
     # Если тег не нашелся, возвращаем NULL
     if not res:
         return None
 
-    res = json.dumps(res, ensure_ascii=False, sort_keys=True)
+    res = lib['dumps'](res, ensure_ascii=False, sort_keys=True)
     #plpy.info(res)
 
     return res
 $BODY$
   LANGUAGE plpython3u VOLATILE
-  COST 100;
\ No newline at end of file
+  COST 100;
+
+
+
+CREATE OR REPLACE FUNCTION public.xml_to_json_flat_rows(
+    inxml text,
+    intagname character varying,
+    infields jsonb,
+    inmaxlevel integer,
+    inuseattrs boolean,
+    inskipfirsttag boolean,
+    inmaxdepth integer,
+    inmaxfields integer,
+    inmaxsize integer)
+  RETURNS SETOF jsonb AS
+
+$BODY$
+    """ xml_to_json_flat_rows с ограничениями inmaxdepth, inmaxfields, inmaxsize (см. xml_to_json_flat).
+        Все параметры обязательны
+    Использование:
+    SELECT value->>'tag2_item1' AS item1
+    FROM xml_to_json_flat_rows(inxml, 'tag2', '[]'::jsonb, 0, true, false, 256, 10000, 52428800) AS value
+    """
+    if 'xml_to_json_flat' not in GD:
+        plpy.execute('SELECT public._xml_to_json_flat_init()')
+    lib = GD['xml_to_json_flat']
+
+    if inxml is None:
+        return
+    plan = lib['get_plan'](intagname, infields, inmaxlevel, inuseattrs, inskipfirsttag, inmaxdepth, inmaxfields)
+    dumps = lib['dumps']
+    for rec in plan.records(inxml, inmaxsize):
+        yield dumps(rec, ensure_ascii=False, sort_keys=True)
+$BODY$
+  LANGUAGE plpython3u VOLATILE
+  COST 100
+  ROWS 100;
+
+
+
+CREATE OR REPLACE FUNCTION public.xml_to_json_flat_table(
+    inxml text,
+    intagname character varying,
+    infields jsonb,
+    inmaxlevel integer,
+    inuseattrs boolean,
+    inskipfirsttag boolean,
+    inmaxdepth integer,
+    inmaxfields integer,
+    inmaxsize integer)
+  RETURNS SETOF record AS
+
+$BODY$
+    """ xml_to_json_flat_table с ограничениями inmaxdepth, inmaxfields, inmaxsize (см. xml_to_json_flat).
+        Все параметры обязательны
+    Использование:
+    SELECT * FROM xml_to_json_flat_table(inxml, 'tag2', '["tag2_item1"]'::jsonb, 0, true, false, 256, 10000, 52428800)
+        AS t(item1 text)
+    """
+    if 'xml_to_json_flat' not in GD:
+        plpy.execute('SELECT public._xml_to_json_flat_init()')
+    lib = GD['xml_to_json_flat']
+
+    if inxml is None:
+        return
+    plan = lib['get_plan'](intagname, infields, inmaxlevel, inuseattrs, inskipfirsttag, inmaxdepth, inmaxfields)
+    fields = plan.fields
+    for rec in plan.records(inxml, inmaxsize):
+        yield [rec.get(fieldname) for fieldname in fields]
+$BODY$
+  LANGUAGE plpython3u VOLATILE
+  COST 100
+  ROWS 100;